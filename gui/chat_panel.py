@@ -1,13 +1,16 @@
-import base64
 import os
 import time
+import threading
 from datetime import datetime
-import uuid
 import wx
 import wx.html2
 import json
+import pathlib
+from html import escape as html_escape
 
 from utils.file_handler import FileHandler
+from utils.message_ids import new_message_id, base_message_id
+from utils.message_status import status_rank
 from .message_input import MessageInput, EVT_MESSAGE_SEND  # Import the custom event
 
 
@@ -21,7 +24,7 @@ class ChatPanel(wx.Panel):
         self.header = None
         self.refresh_timer = None
         self.last_loaded_chat_id = None
-        self.config = None
+        self.config = config
         self.db = db
         self.messenger = messenger
         self.current_chat_id = None
@@ -30,13 +33,19 @@ class ChatPanel(wx.Panel):
         # Flag to track if the panel has been initialized
         self.is_initialized = False
 
-        # Register status update callback with messenger
-        if hasattr(self.messenger, 'set_status_update_callback'):
+        # Register status update callback with messenger; batches are applied with one database update each
+        if hasattr(self.messenger, 'set_status_batch_callback'):
+            self.messenger.set_status_batch_callback(self.on_message_statuses)
+        elif hasattr(self.messenger, 'set_status_update_callback'):
             print("DEBUG: Registering status update callback with messenger")
             self.messenger.set_status_update_callback(self.on_message_status_update)
         else:
             print("WARNING: Messenger does not support status update callbacks")
 
+        # Receipts arrive in batches and are applied with one database update each
+        if hasattr(self.messenger, 'set_receipt_callback'):
+            self.messenger.set_receipt_callback(self.on_message_receipts)
+
         self.init_ui()
         self.is_initialized = True
 
@@ -93,6 +102,10 @@ class ChatPanel(wx.Panel):
             # Get contact info
             contact = self.db.get_contact(contact_id)
             if contact:
+                # Start building the Tor circuit now so the first message goes out without waiting for it
+                if contact.get('onion_address') and hasattr(self.messenger, 'prewarm'):
+                    self.messenger.prewarm(contact['onion_address'])
+
                 self.contact_name.SetLabel(contact['name'])
                 self.contact_status.SetLabel(contact.get('status', ''))
 
@@ -108,7 +121,7 @@ class ChatPanel(wx.Panel):
                 self.update_messages(messages)
 
                 # Mark messages as read
-                self.db.mark_messages_as_read(contact_id)
+                self.mark_chat_read(contact_id)
             else:
                 print(f"ERROR: Contact not found for ID: {contact_id}")
         except Exception as e:
@@ -183,7 +196,7 @@ class ChatPanel(wx.Panel):
         self.last_loaded_chat_id = self.current_chat_id
 
         # Mark messages as read
-        self.db.mark_messages_as_read(self.current_chat_id)
+        self.mark_chat_read(self.current_chat_id)
 
     def scroll_to_bottom(self):
         """Scroll the message view to the bottom"""
@@ -317,19 +330,35 @@ class ChatPanel(wx.Panel):
             try:
                 inner_content = json.loads(message["content"])
             except json.JSONDecodeError:
-                inner_content["type"] = "txt"
-                inner_content["content"] = message["content"]
+                pass
+            if not isinstance(inner_content, dict) or not inner_content:
+                inner_content = {"type": "txt", "content": message["content"]}
             #print(inner_content)
             # json_message= json.loads(str(message))
             # content = json_message["content"]
             # print(json_message["content"])
             #print(content["type"])
-            if inner_content["type"] == "img" :
+            content_type = inner_content.get("type")
+            if content_type in ("img", "file") and "path" in inner_content:
+                # Streamed attachments are referenced from disk rather than inlined
+                file_uri = self._attachment_uri(inner_content["path"], message['type'] == 'sent')
+                name = html_escape(str(inner_content.get("name") or "attachment"))
+                if file_uri and content_type == "img":
+                    html += f'<div class="image"><img src="{file_uri}" style="max-width: 300px; height: 300px" /></div>'
+                elif file_uri:
+                    try:
+                        size_kb = float(inner_content.get("size", 0)) / 1024
+                    except (TypeError, ValueError):
+                        size_kb = 0
+                    html += f'<div class="file"><a href="{file_uri}">📄 {name}</a> ({size_kb:.0f} KB)</div>'
+                else:
+                    html += f'<div class="file">📄 {name} (not available)</div>'
+            elif content_type == "img":
                 # with open(inner_content["content"] , 'rb') as image_file:
                 #     image_data = base64.b64encode(image_file.read()).decode('utf-8')
-                html += f'<div class="image"><img src="data:image/jpeg;base64,{inner_content["content"]}" style="max-width: 300px; height: 300px" /></div>'
+                html += f'<div class="image"><img src="data:image/jpeg;base64,{inner_content.get("content", "")}" style="max-width: 300px; height: 300px" /></div>'
             else:
-                html += f'<div class="content">{inner_content["content"]}</div>'
+                html += f'<div class="content">{inner_content.get("content", "")}</div>'
 
             # Put timestamp and status on the same line
             html += '<div class="meta-info">'
@@ -348,6 +377,33 @@ class ChatPanel(wx.Panel):
         """
         return html
 
+    def _attachment_uri(self, path, sent):
+        """
+        The file URI for an attachment, or None if it must not be shown
+
+        The path comes from the message, which a contact can write anything into, so it
+        is only used if it lies in our media directory: for a received message, where a
+        completed transfer put it.
+        """
+        if not isinstance(path, str) or not path:
+            return None
+
+        path = os.path.realpath(path)
+        if sent:
+            media_dir = os.path.realpath(self.file_handler.media_dir)
+            try:
+                inside = os.path.commonpath([path, media_dir]) == media_dir
+            except ValueError:
+                # On another drive
+                inside = False
+            if not inside or not os.path.isfile(path):
+                return None
+        else:
+            store = getattr(self.messenger, 'attachment_store', None)
+            if not store or not store.is_received_file(path):
+                return None
+        return pathlib.Path(path).as_uri()
+
     def on_message_send(self, event):
         """Handle message send event"""
         print(f"DEBUG: current_chat_id: {self.current_chat_id}")
@@ -358,25 +414,14 @@ class ChatPanel(wx.Panel):
         attachments = event.attachments
         message_json = {}
 
-        # Convert attachments to JSON
+        # Attachments are streamed to the contact in chunks; any text goes as its own message
         if attachments:
-            print("***********8")
-            print(attachments)
-            with open(attachments[0]["path"], 'rb') as image_file:
-                image_data = base64.b64encode(image_file.read()).decode('utf-8')
-            filename = os.path.basename(attachments[0]["path"])
-            message_json['type'] = "img"
-            print("===here goes image content==")
-            print(image_data)
-            message_json['content'] = image_data
-            #attachments_json = json.dumps(attachments)
-            cc=self.db.get_contact(self.current_chat_id)
-            #message_json['content'] = self.file_handler.save_sent_image(cc['onion_address'], image_data, filename)
-            #self.file_handler.save_sent_image(cc['onion_address'], image_data, filename)
-        else:
-            message_json['type'] = "txt"
-            message_json['content'] = message_text
-            #attachments_json = None
+            self.send_attachments(attachments)
+            if not message_text:
+                return
+
+        message_json['type'] = "txt"
+        message_json['content'] = message_text
         message = json.dumps(message_json)
 
         if message or attachments:
@@ -384,7 +429,7 @@ class ChatPanel(wx.Panel):
             contact = self.db.get_contact(self.current_chat_id)
             if contact and contact.get('onion_address') and contact.get('public_key'):
                 # Generate a unique message ID
-                message_id = f"msg_{str(uuid.uuid4())}"
+                message_id = new_message_id()
                 print(f"DEBUG: Generated message_id: {message_id}")
 
                 # Save to database with initial 'sending' status
@@ -454,6 +499,113 @@ class ChatPanel(wx.Panel):
                 wx.MessageBox("Contact information is incomplete.",
                               "Error", wx.OK | wx.ICON_ERROR)
 
+    def send_attachments(self, attachments):
+        """Copy attachments into the media directory and hand them to the messenger for chunked transfer"""
+        chat_id = self.current_chat_id
+        contact = self.db.get_contact(chat_id)
+        if not (contact and contact.get('onion_address') and contact.get('public_key')):
+            wx.MessageBox("Contact information is incomplete.",
+                          "Error", wx.OK | wx.ICON_ERROR)
+            return
+
+        if not hasattr(self.messenger, 'send_attachment'):
+            wx.MessageBox("Sending attachments is not available.",
+                          "Error", wx.OK | wx.ICON_ERROR)
+            return
+
+        # Copying and hashing a large file would freeze the window, so it happens on a worker thread
+        threading.Thread(target=self._prepare_attachments, args=(chat_id, contact, attachments),
+                         daemon=True).start()
+
+    def _prepare_attachments(self, chat_id, contact, attachments):
+        """Copy attachments into the media directory (runs on a worker thread)"""
+        for attachment in attachments:
+            file_type = attachment.get('type', 'file')
+            if os.path.isfile(attachment['path']) and not os.path.getsize(attachment['path']):
+                # Recipients don't accept empty attachments
+                wx.CallAfter(wx.MessageBox, f"{attachment['name']} is empty.",
+                             "Error", wx.OK | wx.ICON_ERROR)
+                continue
+            try:
+                saved_path = os.path.join(self.file_handler.media_dir,
+                                          self.file_handler.save_attachment(attachment['path'], file_type))
+            except Exception as e:
+                print(f"ERROR saving attachment {attachment['path']}: {e}")
+                wx.CallAfter(wx.MessageBox, f"Could not attach {attachment['name']}.",
+                             "Error", wx.OK | wx.ICON_ERROR)
+                continue
+
+            # save_attachment names the copy after the SHA-256 of its content
+            sha256 = os.path.splitext(os.path.basename(saved_path))[0]
+            wx.CallAfter(self._send_prepared_attachment, chat_id, contact, attachment['name'], saved_path,
+                         file_type, sha256, os.path.getsize(saved_path))
+
+    def _send_prepared_attachment(self, chat_id, contact, name, saved_path, file_type, sha256, size):
+        """Record a copied attachment in the chat and start its transfer (called in main thread)"""
+        # The message only references the file, so the chat history stays small
+        message_id = new_message_id()
+        message = json.dumps({
+            'type': 'img' if file_type == 'image' else 'file',
+            'path': saved_path,
+            'name': name,
+            'size': size,
+            'file_type': file_type
+        })
+
+        self.db.add_message(chat_id, message, 'sent', time.time(), 'sending', message_id)
+        print(f"DEBUG: Sending attachment {saved_path} with id: {message_id}")
+        self.messenger.send_attachment(
+            contact['onion_address'],
+            contact['public_key'],
+            saved_path,
+            message_id,
+            file_type,
+            sha256
+        )
+
+        if chat_id == self.current_chat_id:
+            self.update_messages()
+
+    def mark_chat_read(self, contact_id):
+        """Mark a chat's messages as read and send read receipts if they are enabled"""
+        message_ids = self.db.mark_messages_as_read(contact_id)
+        if not message_ids or not hasattr(self.messenger, 'send_read_receipts'):
+            return
+
+        if self.config and not self.config.get('privacy.read_receipts', True):
+            return
+
+        self.messenger.send_read_receipts(contact_id, message_ids)
+
+    def on_message_receipts(self, contact_id, new_status, message_ids):
+        """Apply a batch of delivery or read receipts from a contact (called in main thread)"""
+        # Receipts for group messages carry the id of the contact's copy, which maps to the group message
+        self.on_message_statuses({message_id: new_status for message_id in message_ids})
+
+    def on_message_statuses(self, statuses):
+        """Apply a batch of {message_id: status} changes to messages we sent (called in main thread)"""
+        updated = self.db.apply_message_statuses(statuses)
+        print(f"DEBUG: Applied {len(statuses)} status updates, {updated} messages changed")
+
+        if not updated or not self.current_chat_id:
+            return
+
+        # The view shows one element per message, with the furthest status any copy reached
+        shown = {}
+        for message_id, status in statuses.items():
+            message_id = base_message_id(message_id)
+            if message_id not in shown or status_rank(status) > status_rank(shown[message_id]):
+                shown[message_id] = status
+
+        # One script for the whole batch instead of one per message
+        js_script = (f"var statuses = {json.dumps(shown)}; Object.keys(statuses).forEach(function (id) "
+                     f"{{ updateMessageStatus(id, statuses[id]); }});")
+        try:
+            self.messages_view.RunScript(js_script)
+        except Exception as e:
+            print(f"DEBUG: Batch status script failed, refreshing entire view: {e}")
+            self.update_messages()
+
     def on_message_status_update(self, message_id, new_status):
         """Update message status in UI when callback is received"""
         print(f"DEBUG: Status update received for message {message_id}: {new_status}")
@@ -3,12 +3,15 @@ import wx.adv
 
 
 class ConnectionInfoDialog(wx.Dialog):
-    def __init__(self, parent, connection_info):
+    def __init__(self, parent, connection_info, messenger=None):
         super().__init__(parent, title="Your Connection Information",
-                         size=(500, 300))
+                         size=(600, 560) if messenger else (500, 300))
 
         self.user_text = None
+        self.latency_list = None
+        self.peer_choice = None
         self.connection_info = connection_info
+        self.messenger = messenger
         self.init_ui()
         self.Center()
 
@@ -91,10 +94,66 @@ class ConnectionInfoDialog(wx.Dialog):
         vbox.Add(header, 0, wx.ALL | wx.ALIGN_CENTER, 10)
         vbox.Add(info_grid, 0, wx.ALL | wx.EXPAND, 10)
         vbox.Add(note, 0, wx.ALL, 10)
+
+        if self.messenger and hasattr(self.messenger, 'get_latency_stats'):
+            vbox.Add(self.create_latency_section(panel), 1, wx.ALL | wx.EXPAND, 10)
+
         vbox.Add(btn_sizer, 0, wx.ALIGN_CENTER | wx.ALL, 10)
 
         panel.SetSizer(vbox)
 
+    def create_latency_section(self, panel):
+        """Per-stage delivery latency percentiles, for all peers or a single one"""
+        box = wx.StaticBoxSizer(wx.VERTICAL, panel, "Delivery Latency")
+
+        controls = wx.BoxSizer(wx.HORIZONTAL)
+        self.peer_choice = wx.Choice(panel, choices=["All peers"] + self.messenger.get_latency_peers())
+        self.peer_choice.SetSelection(0)
+        self.peer_choice.Bind(wx.EVT_CHOICE, lambda evt: self.refresh_latency())
+        refresh_btn = wx.Button(panel, label="Refresh")
+        refresh_btn.Bind(wx.EVT_BUTTON, lambda evt: self.refresh_latency())
+        controls.Add(self.peer_choice, 1, wx.EXPAND)
+        controls.Add(refresh_btn, 0, wx.LEFT, 5)
+
+        self.latency_list = wx.ListCtrl(panel, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
+        for index, (title, width) in enumerate([("Stage", 140), ("Count", 60), ("p50 (ms)", 80),
+                                                 ("p95 (ms)", 80), ("p99 (ms)", 80), ("Max (ms)", 80)]):
+            self.latency_list.InsertColumn(index, title, width=width)
+
+        self.receive_stats_label = wx.StaticText(panel, label="")
+
+        box.Add(controls, 0, wx.ALL | wx.EXPAND, 5)
+        box.Add(self.latency_list, 1, wx.ALL | wx.EXPAND, 5)
+        box.Add(self.receive_stats_label, 0, wx.ALL, 5)
+
+        self.refresh_latency()
+        return box
+
+    def refresh_latency(self):
+        """Reload the latency table for the selected peer"""
+        selection = self.peer_choice.GetSelection()
+        peer = self.peer_choice.GetString(selection) if selection > 0 else None
+        stats = self.messenger.get_latency_stats(peer)
+
+        def ms(value):
+            return "-" if value is None else f"{value * 1000:.1f}"
+
+        self.latency_list.DeleteAllItems()
+        for stage in sorted(stats):
+            summary = stats[stage]
+            row = self.latency_list.InsertItem(self.latency_list.GetItemCount(), stage)
+            self.latency_list.SetItem(row, 1, str(summary['count']))
+            self.latency_list.SetItem(row, 2, ms(summary['p50']))
+            self.latency_list.SetItem(row, 3, ms(summary['p95']))
+            self.latency_list.SetItem(row, 4, ms(summary['p99']))
+            self.latency_list.SetItem(row, 5, ms(summary['max']))
+
+        receive = self.messenger.get_receive_stats()
+        self.receive_stats_label.SetLabel(
+            f"Received {receive['accepted']}, duplicates {receive['duplicates']}, "
+            f"shed: {receive['shed_sender']} per-sender limit, {receive['shed_global']} global limit, "
+            f"{receive['shed_busy']} queue full")
+
     def copy_text(self, text):
         """Copy text to clipboard"""
         if wx.TheClipboard.Open():
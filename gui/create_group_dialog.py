@@ -444,6 +444,10 @@ class GroupInfoDialog(wx.Dialog):
         if dlg.ShowModal() == wx.ID_YES:
             self.db.remove_group_member(self.group_id, member.get('id'))
 
+            # The removed member holds our current sender key; later messages use a new one
+            if self.messenger and hasattr(self.messenger, 'rotate_group_key'):
+                self.messenger.rotate_group_key(self.group_id)
+
             # Refresh member list
             self.members = self.db.get_group_members(self.group_id)
             self.load_members()
@@ -1,5 +1,4 @@
 import json
-import uuid
 
 import wx
 import wx.lib.scrolledpanel as scrolled
@@ -7,6 +6,7 @@ import os
 import time
 from datetime import datetime
 
+from utils.message_ids import new_message_id
 from .message_input import MessageInput, EVT_MESSAGE_SEND
 
 
@@ -219,6 +219,10 @@ class GroupChatPanel(wx.Panel):
         # Load messages
         self.update_messages()
 
+        # Fetch anything sent while we were offline; synced messages refresh the view as they arrive
+        if self.messenger and hasattr(self.messenger, 'sync_group'):
+            self.messenger.sync_group(group_id, members)
+
         # Enable group info button
         self.info_btn.Enable()
 
@@ -282,7 +286,7 @@ class GroupChatPanel(wx.Panel):
         members = self.db.get_group_members(self.current_group_id)
 
         # Generate message ID
-        message_id = f"grp_{str(uuid.uuid4())}"
+        message_id = new_message_id()
         print(f"DEBUG: Generated base group message ID: {message_id}")
 
         # First save to local database
@@ -7,6 +7,7 @@ from .chat_panel import ChatPanel
 from .contact_list import ContactList
 from .settings_dialog import SettingsDialog
 from .profile_dialog import ProfileDialog
+from .connection_info_dialog import ConnectionInfoDialog
 from .group_message_bubble import GroupChatPanel
 import os
 
@@ -51,6 +52,9 @@ class MainWindow(wx.Frame):
         # Center the window
         self.Center()
 
+        # Catch up on group messages sent while we were offline
+        self.sync_groups()
+
         # Bind events
         self.Bind(wx.EVT_CLOSE, self.on_close)
 
@@ -177,6 +181,7 @@ class MainWindow(wx.Frame):
         # View menu
         view_menu = wx.Menu()
         self.dark_mode_item = view_menu.AppendCheckItem(wx.ID_ANY, "Dark Mode")
+        connection_info_item = view_menu.Append(wx.ID_ANY, "Connection Info")
 
         # Help menu
         help_menu = wx.Menu()
@@ -193,6 +198,7 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.on_logout, logout_item)
         self.Bind(wx.EVT_MENU, self.on_exit, exit_item)
         self.Bind(wx.EVT_MENU, self.on_toggle_dark_mode, self.dark_mode_item)
+        self.Bind(wx.EVT_MENU, self.on_connection_info, connection_info_item)
         self.Bind(wx.EVT_MENU, self.on_about, about_item)
 
     def create_status_bar(self):
@@ -201,6 +207,41 @@ class MainWindow(wx.Frame):
         self.status_bar.SetStatusWidths([-2, -1])
         self.update_status("Ready", "Online")
 
+        # Show how many outgoing messages are still on their way
+        if hasattr(self.messenger, 'get_backlog'):
+            self.backlog_timer = wx.Timer(self)
+            self.Bind(wx.EVT_TIMER, self.on_backlog_timer, self.backlog_timer)
+            self.backlog_timer.Start(5000)
+
+        # Tor bootstraps in the background; show its progress until our onion service is published
+        if hasattr(self.messenger, 'set_tor_status_callback'):
+            self.messenger.set_tor_status_callback(self.on_tor_status)
+
+    def on_backlog_timer(self, event):
+        backlog = self.messenger.get_backlog()
+        if not backlog['in_flight']:
+            self.status_bar.SetStatusText("Ready", 0)
+            return
+
+        oldest_minutes = int(backlog['oldest_age'] // 60)
+        waiting = f", oldest {oldest_minutes} min" if oldest_minutes else ""
+        self.status_bar.SetStatusText(f"{backlog['in_flight']} message(s) sending{waiting}", 0)
+
+    def on_tor_status(self, status):
+        """Show Tor bootstrap progress in the status bar (called in main thread)"""
+        if status['state'] == 'ready':
+            self.status_bar.SetStatusText("Online", 1)
+        elif status['state'] == 'failed':
+            self.status_bar.SetStatusText("Offline", 1)
+            answer = wx.MessageBox(f"Failed to start Tor: {status['summary']}\n"
+                                   "Messages you send are kept and sent once Tor is running.\n\n"
+                                   "Try starting Tor again?",
+                                   "Connection Error", wx.YES_NO | wx.ICON_ERROR)
+            if answer == wx.YES and hasattr(self.messenger, 'retry_tor'):
+                self.messenger.retry_tor()
+        else:
+            self.status_bar.SetStatusText(f"Connecting to Tor {status['progress']}%: {status['summary']}", 1)
+
     def update_status(self, message, connection_status):
         self.status_bar.SetStatusText(message, 0)
         self.status_bar.SetStatusText(connection_status, 1)
@@ -264,6 +305,11 @@ class MainWindow(wx.Frame):
             self.theme_manager.set_theme('dark' if is_dark else 'light')
             self.theme_manager.apply_theme_to_window(self)
 
+    def on_connection_info(self, event):
+        dialog = ConnectionInfoDialog(self, self.messenger.get_connection_info(), self.messenger)
+        dialog.ShowModal()
+        dialog.Destroy()
+
     def on_about(self, event):
         info = wx.adv.AboutDialogInfo()
         info.SetName("WhatsApp Clone")
@@ -293,29 +339,85 @@ class MainWindow(wx.Frame):
             self.logger.error(f"Error during shutdown: {e}")
             event.Skip()
 
+    def sync_groups(self):
+        """Ask an online member of each group for the messages we missed"""
+        if not hasattr(self.messenger, 'sync_group'):
+            return
+
+        try:
+            for group in self.db.get_groups():
+                self.messenger.sync_group(group['id'], self.db.get_group_members(group['id']))
+        except Exception as e:
+            self.logger.error(f"Error syncing groups: {e}")
+
     def handle_new_message(self, message_data):
         """Handle incoming messages"""
+        self.handle_new_messages([message_data])
+
+    def handle_new_messages(self, messages):
+        """Store a batch of incoming messages, then refresh the UI once for the whole batch"""
+        group_counts = {}
+        group_messages = []
+        direct_senders = []
+
+        for message_data in messages:
+            try:
+                # Check if this is a group invitation
+                if message_data.get('is_group_invitation'):
+                    self.handle_group_invitation(message_data)
+                    continue
+
+                # Check if this is a group message
+                if message_data.get('is_group_message'):
+                    # Handle group messages
+                    group_id = message_data.get('group_id')
+
+                    # Saved together after the loop, so a page of synced history is one transaction
+                    group_messages.append({
+                        'group_id': group_id,
+                        'sender_id': message_data['sender_id'],
+                        'content': message_data['message'],
+                        'message_type': 'received',
+                        'timestamp': message_data.get('timestamp', time.time()),
+                        'message_id': message_data.get('message_id')
+                    })
+                    group_counts[group_id] = group_counts.get(group_id, 0) + 1
+
+                else:
+                    # Handle direct messages
+                    sender_id = message_data['sender_id']
+                    message = message_data['message']
+                    sender_public_key = message_data['sender_public_key']
+
+                    contact = self.db.get_contact(sender_id)
+                    if not contact:
+                        # Add new contact to database
+                        self.db.add_contact(sender_public_key, sender_id)  # Use sender_id as name if not available
+
+                    # Add message to database
+                    self.db.add_message(
+                        sender_id,
+                        message,
+                        'received',
+                        status='unread',
+                        message_id=message_data.get('message_id')  # Sender's id, used to drop retried duplicates
+                    )
+                    if sender_id not in direct_senders:
+                        direct_senders.append(sender_id)
+
+            except Exception as e:
+                self.logger.error(f"Error handling new message: {e}")
+                import traceback
+                traceback.print_exc()
+
         try:
-            # Check if this is a group invitation
-            if message_data.get('is_group_invitation'):
-                self.handle_group_invitation(message_data)
-                return
-
-            # Check if this is a group message
-            if message_data.get('is_group_message'):
-                # Handle group messages
-                group_id = message_data.get('group_id')
-
-                # Save to database
-                self.db.add_group_message(
-                    group_id,
-                    message_data['sender_id'],
-                    message_data['message'],
-                    'received',
-                    None,  # No attachments for now
-                    message_data.get('timestamp', time.time())
-                )
+            self.db.add_group_messages(group_messages)
+        except Exception as e:
+            self.logger.error(f"Error saving group messages: {e}")
+            group_counts = {}
 
+        try:
+            for group_id, count in group_counts.items():
                 # Update UI if this is the current group chat
                 if self.chat_notebook.GetSelection() == 1 and \
                         hasattr(self.group_chat_panel, 'current_group_id') and \
@@ -330,39 +432,15 @@ class MainWindow(wx.Frame):
                             f"New message in {group['name'] if group else 'a group'}"
                         )
 
-                # Update group list to show unread message
-                self.contact_list.update_unread_count(group_id, 1, is_group=True)
-
-                # Refresh contact/group list
-                wx.CallAfter(self.contact_list.refresh_contacts)
+                # Update group list to show unread messages
+                self.contact_list.update_unread_count(group_id, count, is_group=True)
 
-            else:
-                # Handle direct messages
-                sender_id = message_data['sender_id']
-                message = message_data['message']
-                sender_public_key = message_data['sender_public_key']
-                timestamp = message_data.get('timestamp', time.time())
-
-                contact = self.db.get_contact(sender_id)
-                if not contact:
-                    # Add new contact to database
-                    self.db.add_contact(sender_public_key, sender_id)  # Use sender_id as name if not available
-
-                # Add message to database
-                self.db.add_message(
-                    sender_id,
-                    message,
-                    'received'
-                )
-
-                # Refresh contact list - try both methods for reliability
-                # Method 1: Direct call with CallAfter
-                wx.CallAfter(self.contact_list.refresh_contacts)
-
-                # Method 2: Event-based approach
+            if direct_senders:
+                # Event-based refresh of the contact list
                 event = wx.PyCommandEvent(wxEVT_CONTACT_LIST_UPDATE, self.GetId())
                 wx.PostEvent(self, event)
 
+            for sender_id in direct_senders:
                 # Update UI if this is the current chat
                 if self.chat_notebook.GetSelection() == 0 and \
                         hasattr(self.chat_panel, 'current_chat_id') and \
@@ -381,6 +459,10 @@ class MainWindow(wx.Frame):
                 self.contact_list.update_unread_count(sender_id,
                                                       self.db.get_unread_count(sender_id))
 
+            # Refresh contact/group list once for the whole batch
+            if group_counts or direct_senders:
+                wx.CallAfter(self.contact_list.refresh_contacts)
+
         except Exception as e:
             self.logger.error(f"Error handling new message: {e}")
             import traceback
@@ -428,6 +510,10 @@ class MainWindow(wx.Frame):
                         'member'
                     )
 
+                # Fetch the messages sent before we joined
+                if hasattr(self.messenger, 'sync_group'):
+                    self.messenger.sync_group(group_id, self.db.get_group_members(group_id))
+
                 # Show notification
                 if self.notification_handler:
                     self.notification_handler.show_notification(
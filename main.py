@@ -101,7 +101,15 @@ class JustSocial(wx.App):
                 from utils.tor_messenger import TorMessenger
                 self.messenger = TorMessenger(
                     credentials['user_id'],
-                    message_callback=self.on_message_received
+                    message_callback=self.on_message_received,
+                    message_batch_callback=self.on_messages_received,
+                    socks_port=self.config.get('network.receive_port', 5000),
+                    db=self.db,
+                    media_dir=self.file_handler.media_dir,
+                    send_engine=self.config.get('network.send_engine', 'threads'),
+                    group_relay_fanout=self.config.get('network.group_relay_fanout', 0),
+                    tor_control_port=self.config.get('network.tor_control_port'),
+                    tor_control_password=self.config.get('network.tor_control_password')
                 )
                 return True
             except Exception as e:
@@ -126,6 +134,13 @@ class JustSocial(wx.App):
         except Exception as e:
             self.logger.error(f"Error handling received message: {e}")
 
+    def on_messages_received(self, messages):
+        """Handle a batch of received messages, delivered at most once per frame"""
+        try:
+            self.frame.handle_new_messages(messages)
+        except Exception as e:
+            self.logger.error(f"Error handling received messages: {e}")
+
     def init_main_window(self):
         """Initialize and show the main application window"""
         try:
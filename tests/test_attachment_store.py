@@ -0,0 +1,129 @@
+import hashlib
+import os
+
+import pytest
+
+from utils import attachment_store
+from utils.attachment_store import AttachmentStore
+
+SENDER = 'a' * 64
+DATA = os.urandom(1000)
+
+
+def offer(data=DATA, **overrides):
+    return dict({
+        'transfer_id': os.urandom(16).hex(),
+        'name': 'photo.jpg',
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'file_type': 'image'
+    }, **overrides)
+
+
+def test_transfer_resumes_after_restart(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    transfer = offer()
+    transfer_id = bytes.fromhex(transfer['transfer_id'])
+    assert store.begin(SENDER, transfer) == 0
+    assert store.write_chunk(SENDER, transfer_id, 0, DATA[:400]) == (400, None)
+
+    # A new store over the same directory picks up the partial file
+    store = AttachmentStore(str(tmp_path))
+    assert store.begin(SENDER, transfer) == 400
+    offset, completed = store.write_chunk(SENDER, transfer_id, 400, DATA[400:])
+    assert offset == len(DATA)
+    with open(completed['path'], 'rb') as f:
+        assert f.read() == DATA
+    assert os.path.dirname(completed['path']) == os.path.join(str(tmp_path), 'images')
+
+    # A repeated offer is answered as complete
+    assert store.begin(SENDER, transfer) == len(DATA)
+    assert not store.transfer_locks and not store.pending
+
+
+def test_offset_mismatch_reports_where_to_resume(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    transfer = offer()
+    transfer_id = bytes.fromhex(transfer['transfer_id'])
+    store.begin(SENDER, transfer)
+    store.write_chunk(SENDER, transfer_id, 0, DATA[:100])
+
+    for offset in (0, 50, 200):
+        with pytest.raises(attachment_store.OffsetMismatch) as error:
+            store.write_chunk(SENDER, transfer_id, offset, DATA[offset:offset + 100])
+        assert error.value.offset == 100
+
+
+def test_invalid_chunks_are_rejected(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    transfer = offer()
+    transfer_id = bytes.fromhex(transfer['transfer_id'])
+
+    with pytest.raises(attachment_store.UnknownTransfer):
+        store.write_chunk(SENDER, transfer_id, 0, DATA)
+
+    store.begin(SENDER, transfer)
+    with pytest.raises(attachment_store.AttachmentError):
+        store.write_chunk('b' * 64, transfer_id, 0, DATA)
+    with pytest.raises(attachment_store.AttachmentError):
+        store.write_chunk(SENDER, transfer_id, 0, DATA + b'extra')
+
+
+def test_checksum_mismatch_discards_the_file(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    transfer = offer(sha256='0' * 64)
+    store.begin(SENDER, transfer)
+    with pytest.raises(attachment_store.AttachmentError):
+        store.write_chunk(SENDER, bytes.fromhex(transfer['transfer_id']), 0, DATA)
+    assert os.listdir(store.incoming_dir) == []
+
+
+def test_unfinished_transfers_are_capped_per_sender(tmp_path):
+    store = AttachmentStore(str(tmp_path), max_transfers=2, max_pending_bytes=2500)
+    store.begin(SENDER, offer())
+    store.begin(SENDER, offer())
+    with pytest.raises(attachment_store.TransferLimit):
+        store.begin(SENDER, offer())
+    store.begin('b' * 64, offer())
+
+    store = AttachmentStore(str(tmp_path), max_transfers=5, max_pending_bytes=2500)
+    with pytest.raises(attachment_store.TransferLimit):
+        store.begin(SENDER, offer())
+
+
+@pytest.mark.parametrize('overrides', [{'transfer_id': 'abc'}, {'sha256': None}, {'size': -1}, {'size': 0},
+                                       {'size': 10 ** 12}])
+def test_invalid_offers_are_rejected(tmp_path, overrides):
+    with pytest.raises(attachment_store.AttachmentError):
+        AttachmentStore(str(tmp_path)).begin(SENDER, offer(**overrides))
+
+
+def test_stalled_transfers_expire_when_offers_come_in(tmp_path):
+    store = AttachmentStore(str(tmp_path), max_transfers=1, stale_after=60, expire_interval=0)
+    stalled = offer()
+    store.begin(SENDER, stalled)
+    with pytest.raises(attachment_store.TransferLimit):
+        store.begin(SENDER, offer())
+
+    # No chunk for longer than stale_after releases the reservation without a restart
+    part_path = os.path.join(store.incoming_dir, stalled['transfer_id'] + '.part')
+    os.utime(part_path, (0, 0))
+    meta = store._load_meta(stalled['transfer_id'])
+    meta['started_at'] = 0
+    store._save_meta(meta)
+    assert store.begin(SENDER, offer()) == 0
+    assert not os.path.exists(part_path)
+
+
+def test_only_completed_transfers_count_as_received_files(tmp_path):
+    store = AttachmentStore(str(tmp_path))
+    transfer = offer()
+    store.begin(SENDER, transfer)
+    _, completed = store.write_chunk(SENDER, bytes.fromhex(transfer['transfer_id']), 0, DATA)
+    assert store.is_received_file(completed['path'])
+
+    outside = tmp_path / 'images' / '..' / '..' / ('0' * 16 + '_secret.txt')
+    outside.write_text('secret')
+    assert not store.is_received_file(str(outside))
+    assert not store.is_received_file(os.path.join(store.incoming_dir, transfer['transfer_id'] + '.json'))
+    assert not store.is_received_file(os.path.join(str(tmp_path), 'images', '0' * 16 + '_missing.jpg'))
@@ -0,0 +1,52 @@
+import zlib
+
+import pytest
+
+from utils import compression
+
+zstandard = pytest.importorskip('zstandard')
+
+MESSAGE = b'hello over tor ' * 100
+
+
+@pytest.mark.parametrize('codec', ['zstd', 'zlib'])
+def test_round_trip(codec):
+    payload, compressed = compression.compress(MESSAGE, (codec,))
+    assert compressed
+    assert compression.decompress(payload) == MESSAGE
+
+
+def test_small_or_unsupported_data_is_left_alone():
+    assert compression.compress(b'short', ('zstd', 'zlib')) == (b'short', False)
+    assert compression.compress(MESSAGE, ()) == (MESSAGE, False)
+
+
+def test_zstd_frame_declaring_too_much_is_rejected():
+    payload = bytes([compression.CODEC_ZSTD]) + zstandard.ZstdCompressor().compress(b'\0' * 2_000_000)
+    with pytest.raises(compression.CompressionError):
+        compression.decompress(payload, max_size=1_000_000)
+
+
+def test_zstd_frame_without_content_size_stops_at_limit():
+    body = zstandard.ZstdCompressor(write_content_size=False).compress(b'\0' * 2_000_000)
+    assert zstandard.frame_content_size(body) == -1
+    with pytest.raises(compression.CompressionError):
+        compression.decompress(bytes([compression.CODEC_ZSTD]) + body, max_size=1_000_000)
+
+
+def test_zstd_payload_at_limit_is_accepted():
+    payload = bytes([compression.CODEC_ZSTD]) + zstandard.ZstdCompressor(write_content_size=False).compress(MESSAGE)
+    assert compression.decompress(payload, max_size=len(MESSAGE)) == MESSAGE
+
+
+def test_zlib_bomb_is_rejected():
+    payload = bytes([compression.CODEC_ZLIB]) + zlib.compress(b'\0' * 2_000_000)
+    with pytest.raises(compression.CompressionError):
+        compression.decompress(payload, max_size=1_000_000)
+
+
+@pytest.mark.parametrize('payload', [b'', b'\x07abc', bytes([compression.CODEC_ZLIB]) + b'not zlib',
+                                     bytes([compression.CODEC_ZSTD]) + b'not zstd'])
+def test_corrupt_or_unknown_payloads_raise(payload):
+    with pytest.raises(compression.CompressionError):
+        compression.decompress(payload)
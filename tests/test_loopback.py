@@ -0,0 +1,84 @@
+import socket
+import time
+
+import pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('waitress')
+
+from utils.tor_messenger import TorMessenger
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@pytest.fixture
+def peers(tmp_path, monkeypatch):
+    # Key files are written to the working directory
+    monkeypatch.chdir(tmp_path)
+    messengers = []
+    for name in ('alice', 'bob'):
+        received = []
+        messenger = TorMessenger(name, message_callback=received.append, socks_port=free_port(),
+                                 transport='loopback', prewarm_peers=0)
+        messenger.received = received
+        messenger.statuses = {}
+        messenger.set_status_update_callback(lambda message_id, status, m=messenger: m.statuses.update({message_id: status}))
+        messengers.append(messenger)
+
+    assert wait_for(lambda: all(_listening(m.socks_port) for m in messengers))
+    yield messengers
+    for messenger in messengers:
+        messenger.close()
+
+
+def _listening(port):
+    with socket.socket() as s:
+        return s.connect_ex(('127.0.0.1', port)) == 0
+
+
+def contact(messenger):
+    info = messenger.get_connection_info()
+    return {'id': messenger.user_id, 'onion_address': messenger.onion_address, 'public_key': info['public_key']}
+
+
+def test_message_round_trip(peers):
+    alice, bob = peers
+    bob_contact = contact(bob)
+
+    assert alice.send_message(bob_contact['onion_address'], bob_contact['public_key'], 'hello bob', 'm1')
+    assert wait_for(lambda: bob.received)
+    assert bob.received[0]['message'] == 'hello bob'
+    assert bob.received[0]['sender_public_key'] == contact(alice)['public_key']
+    # Bob doesn't have alice as a contact; his receipt goes to the address she sent along
+    assert wait_for(lambda: alice.statuses.get('m1') == 'delivered')
+
+    alice_contact = contact(alice)
+    assert bob.send_message(alice_contact['onion_address'], alice_contact['public_key'], 'hi alice', 'm2')
+    assert wait_for(lambda: alice.received)
+    assert alice.received[0]['message'] == 'hi alice'
+
+
+def test_group_message_round_trip(peers):
+    alice, bob = peers
+    # The first message learns bob's features; the second is sealed once and signed
+    for text in ('first', 'second'):
+        alice.send_group_message('g1', [contact(bob)], text, f'g1-{text}')
+        assert wait_for(lambda: any(m['message'] == text for m in bob.received))
+        assert wait_for(lambda: alice.statuses.get(f'g1-{text}') == 'delivered')
+
+    assert all(m['is_group_message'] and m['group_id'] == 'g1' for m in bob.received)
+    # Bob got alice's sender key and signing key along the way
+    assert bob.group_keys.can_open(contact(alice)['public_key'], alice.group_keys.own_keys['g1'])
@@ -0,0 +1,32 @@
+import time
+
+from utils.message_ids import (base_message_id, lowest_message_id, message_id_time, new_message_id,
+                               recipient_message_id)
+
+
+def test_ids_sort_in_creation_order():
+    ids = [new_message_id() for _ in range(2000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_ids_sort_by_timestamp():
+    earlier = new_message_id(1_700_000_000)
+    later = new_message_id(1_700_000_000.002)
+    assert earlier < later
+    assert lowest_message_id(1_700_000_000) <= earlier < lowest_message_id(1_700_000_000.001)
+
+
+def test_id_time():
+    assert abs(message_id_time(new_message_id()) - time.time()) < 5
+    assert message_id_time(new_message_id(1_700_000_000.123)) == 1_700_000_000.123
+    assert message_id_time('not-a-ulid') is None
+
+
+def test_recipient_copies_map_back_to_the_base_id():
+    message_id = new_message_id()
+    copy = recipient_message_id(message_id, 'ABCDEF0123456789' * 4)
+    assert copy == f"{message_id}.abcdef012345"
+    assert base_message_id(copy) == message_id
+    assert message_id_time(copy) == message_id_time(message_id)
+    assert base_message_id('grp_1234_member') == 'grp_1234'
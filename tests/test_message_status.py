@@ -0,0 +1,63 @@
+from utils.message_status import MessageStatusTracker, is_forward, status_rank, statuses_after
+
+
+def test_status_ranks():
+    assert status_rank('sending') == status_rank('failed') == 0
+    assert status_rank('delivered') < status_rank('read')
+
+
+def test_only_forward_transitions_are_allowed():
+    assert is_forward(None, 'sending')
+    assert is_forward('sending', 'sent')
+    # The outbox retries, so failures and sends may alternate until delivery
+    assert is_forward('timeout', 'sending')
+    assert is_forward('sent', 'delivered')
+    assert is_forward('delivered', 'read')
+
+    assert not is_forward('delivered', 'sent')
+    assert not is_forward('delivered', 'failed')
+    assert not is_forward('read', 'delivered')
+    assert not is_forward('read', 'read')
+
+
+def test_statuses_after():
+    assert set(statuses_after('sent')) == {'delivered', 'read'}
+    assert statuses_after('delivered') == ('read',)
+    assert statuses_after('read') == ()
+
+
+def test_tracker_batches_forward_updates():
+    delivered = []
+    tracker = MessageStatusTracker(delivered.append, window=60)
+    try:
+        assert tracker.update('m1', 'sending')
+        assert tracker.update('m1.abcdef', 'delivered')
+        assert not tracker.update('m1', 'sent')
+        tracker.observe(['m2'], 'read')
+        assert not tracker.update('m2', 'delivered')
+        tracker.flush_all()
+    finally:
+        tracker.close()
+
+    # Recipient copies count as the base message, and the last accepted status wins
+    assert delivered == [{'m1': 'delivered'}]
+    assert tracker.status('m1.abcdef') == 'delivered'
+
+
+def test_database_applies_receipts_to_the_chat_that_sent_them(tmp_path, monkeypatch):
+    from utils import database
+    monkeypatch.setattr(database.appdirs, 'user_data_dir', lambda app_name: str(tmp_path))
+    db = database.Database()
+    db.initialize()
+
+    db.add_message('bob', 'hi', 'sent', status='sent', message_id='m1')
+    db.add_message('bob', 'hello', 'received', message_id='m2')
+    db.add_message('carol', 'hi', 'sent', status='read', message_id='m3')
+
+    # A group copy id updates the message it belongs to; read messages stay read
+    assert db.apply_message_statuses({'m1.abcdef': 'delivered', 'm2': 'delivered', 'm3': 'delivered'}) == 1
+    statuses = {message['message_id']: message['status']
+                for chat_id in ('bob', 'carol') for message in db.get_chat_messages(chat_id)}
+    assert statuses['m1'] == 'delivered'
+    assert statuses['m2'] != 'delivered'
+    assert statuses['m3'] == 'read'
@@ -0,0 +1,51 @@
+import pytest
+
+from utils import rate_limiter
+from utils.rate_limiter import ReceiveRateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(rate=10, burst=5, now=0)
+    assert all(bucket.take(0) for _ in range(5))
+    assert not bucket.take(0)
+
+    # 10 tokens per second: one more after 0.1 s, never more than the burst
+    assert bucket.take(0.1)
+    assert not bucket.take(0.1)
+    assert sum(bucket.take(100) for _ in range(10)) == 5
+
+
+def test_sender_limit_is_per_sender(clock):
+    limiter = ReceiveRateLimiter(sender_rate=1, sender_burst=3, global_rate=None)
+    assert [limiter.rejected_by('a') for _ in range(4)] == [None, None, None, 'sender']
+    assert limiter.rejected_by('b') is None
+
+    clock[0] += 1
+    assert limiter.rejected_by('a') is None
+    assert limiter.rejected_by('a') == 'sender'
+    assert limiter.get_shed_counts() == {'sender': 2}
+
+
+def test_global_limit_does_not_charge_the_sender(clock):
+    limiter = ReceiveRateLimiter(sender_rate=1, sender_burst=2, global_rate=1, global_burst=1)
+    assert limiter.rejected_by('a') is None
+    assert limiter.rejected_by('b') == 'global'
+
+    # b's token was given back, so once the global bucket refills b still has its full burst
+    clock[0] += 1
+    assert limiter.rejected_by('b') is None
+    assert limiter.get_shed_counts() == {'global': 1}
+
+
+def test_only_recent_senders_keep_a_bucket(clock):
+    limiter = ReceiveRateLimiter(sender_rate=1, sender_burst=1, global_rate=None, max_senders=2)
+    for sender in ('a', 'b', 'c'):
+        assert limiter.rejected_by(sender) is None
+    assert set(limiter.senders) == {'b', 'c'}
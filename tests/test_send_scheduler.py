@@ -0,0 +1,30 @@
+import threading
+import time
+
+from utils.send_scheduler import SendScheduler
+
+
+def test_peer_stats_are_capped():
+    scheduler = SendScheduler(min_workers=1, max_workers=1, max_peers=2)
+
+    def run(peer, reachable):
+        finished = threading.Event()
+        scheduler.submit(peer, lambda: finished.set() or reachable)
+        assert finished.wait(5)
+        # The worker records the result right after the task returns
+        deadline = time.time() + 5
+        while scheduler.get_stats()['in_flight'] and time.time() < deadline:
+            time.sleep(0.01)
+
+    try:
+        run('a', False)
+        assert scheduler.get_stats()['failing_peers'] == {'a': 1}
+        run('b', True)
+        run('c', True)
+    finally:
+        scheduler.shutdown()
+
+    # The least recently active peer is forgotten, along with its failures
+    stats = scheduler.get_stats()
+    assert set(stats['latency']) == {'b', 'c'}
+    assert stats['failing_peers'] == {}
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from utils import wire_format
+
+SENDER = os.urandom(wire_format.PUBLIC_KEY_SIZE)
+GROUP_KEY_ID = os.urandom(wire_format.KEY_ID_SIZE)
+
+
+def test_envelope_round_trip():
+    data = wire_format.encode_envelope(SENDER, b'ciphertext', True, GROUP_KEY_ID, b'wrapped',
+                                       compressed=True, message_id='01ABC')
+    envelope = wire_format.decode_envelope(data)
+
+    assert envelope['sender_public_key'] == SENDER
+    assert envelope['sender_key_id'] == wire_format.key_id(SENDER)
+    assert envelope['message_id'] == '01ABC'
+    assert envelope['group_key_id'] == GROUP_KEY_ID
+    assert envelope['wrapped_key'] == b'wrapped'
+    assert envelope['flags'] & wire_format.FLAG_COMPRESSED
+    assert envelope['ciphertext'] == b'ciphertext'
+
+
+def test_short_key_id_envelope():
+    envelope = wire_format.decode_envelope(wire_format.encode_envelope(SENDER, b'ciphertext', False))
+    assert envelope['sender_public_key'] is None
+    assert envelope['sender_key_id'] == wire_format.key_id(SENDER)
+    assert envelope['group_key_id'] is None
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'JS',
+    b'XX\x01\x01' + SENDER,
+    b'JS\x02\x01' + SENDER,
+])
+def test_malformed_envelopes_are_rejected(data):
+    with pytest.raises(wire_format.EnvelopeError):
+        wire_format.decode_envelope(data)
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'include_full_key': True},
+    {'include_full_key': False},
+    {'include_full_key': True, 'message_id': '01ABC'},
+    {'include_full_key': True, 'group_key_id': GROUP_KEY_ID, 'wrapped_key': b'wrapped'},
+])
+def test_truncated_headers_are_rejected(kwargs):
+    data = wire_format.encode_envelope(SENDER, b'', **kwargs)
+    # Every prefix that cuts into the header must fail instead of misreading the rest
+    for end in range(len(data)):
+        with pytest.raises(wire_format.EnvelopeError):
+            wire_format.decode_envelope(data[:end])
+
+
+def test_invalid_message_id_is_rejected():
+    data = bytearray(wire_format.encode_envelope(SENDER, b'ciphertext', message_id='ab'))
+    start = 4 + wire_format.PUBLIC_KEY_SIZE + 1
+    data[start:start + 2] = b'\xff\xfe'
+    with pytest.raises(wire_format.EnvelopeError):
+        wire_format.decode_envelope(bytes(data))
+
+
+def test_batch_round_trip_and_truncation():
+    envelopes = [wire_format.encode_envelope(SENDER, os.urandom(n)) for n in (0, 10, 300)]
+    data = wire_format.encode_batch(envelopes)
+    assert wire_format.decode_batch(data) == envelopes
+
+    for end in (0, 3, 6, len(data) - 1):
+        with pytest.raises(wire_format.EnvelopeError):
+            wire_format.decode_batch(data[:end])
+    with pytest.raises(wire_format.EnvelopeError):
+        wire_format.decode_batch(b'JS' + data[2:])
+
+
+def test_chunk_relay_and_sync_page_framing():
+    transfer_id = os.urandom(wire_format.TRANSFER_ID_SIZE)
+    assert wire_format.decode_chunk(wire_format.encode_chunk(transfer_id, 1234, b'data')) == \
+        (transfer_id, 1234, b'data')
+    with pytest.raises(wire_format.EnvelopeError):
+        wire_format.decode_chunk(transfer_id)
+
+    assert wire_format.decode_relay(wire_format.encode_relay(b'{}', b'envelope')) == (b'{}', b'envelope')
+    with pytest.raises(wire_format.EnvelopeError):
+        wire_format.decode_relay(wire_format.encode_relay(b'{"long": 1}', b'')[:8])
+
+    page = wire_format.encode_sync_page(b'{}', [b'one', b'two'])
+    assert wire_format.decode_sync_page(page) == (b'{}', [b'one', b'two'])
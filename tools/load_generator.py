@@ -0,0 +1,196 @@
+"""
+Spin up several TorMessenger peers on the loopback transport and push traffic between them
+
+No Tor daemon or wx is needed, so this runs on any Linux box and makes regressions
+in the send and receive paths visible. Example:
+
+    python tools/load_generator.py --peers 8 --messages 5000 --group-size 5 --group-messages 200
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.tor_messenger import TorMessenger
+from utils.latency_metrics import LatencyHistogram, LatencyMetrics
+
+
+class Peer:
+    """One messenger plus what it has received"""
+
+    def __init__(self, index, port, args, on_received):
+        self.id = f"peer{index}"
+        self.on_received = on_received
+        self.messenger = TorMessenger(
+            self.id,
+            socks_port=port,
+            transport='loopback',
+            send_engine=args.engine,
+            message_batch_callback=self.on_messages,
+            prewarm_peers=0,
+            group_relay_fanout=args.relay_fanout,
+            # Measure raw throughput rather than the receive rate limits
+            sender_rate_limit=None,
+            global_rate_limit=None
+        )
+        info = self.messenger.get_connection_info()
+        self.contact = {
+            'id': self.id,
+            'onion_address': info['onion_address'],
+            'public_key': info['public_key']
+        }
+
+    def on_messages(self, messages):
+        received_at = time.perf_counter()
+        for message_data in messages:
+            self.on_received(message_data, received_at)
+
+
+def make_payload(size):
+    """Message text carrying its send time, padded with random hex to roughly size bytes"""
+    payload = {'sent_at': time.perf_counter(), 'pad': ''}
+    padding = max(0, size - len(json.dumps(payload)))
+    payload['pad'] = os.urandom(padding // 2 + 1).hex()[:padding]
+    return json.dumps(payload)
+
+
+def wait_for_servers(peers, timeout=10):
+    deadline = time.time() + timeout
+    for peer in peers:
+        while peer.messenger.server is None and time.time() < deadline:
+            time.sleep(0.05)
+
+
+def run(args):
+    random.seed(args.seed)
+    # TorMessenger keeps its key files in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="justsocial-load-"))
+
+    latency = LatencyHistogram()
+    lock = threading.Lock()
+    received = [0]
+
+    def on_received(message_data, received_at):
+        try:
+            sent_at = json.loads(message_data['message'])['sent_at']
+        except (KeyError, TypeError, ValueError):
+            return
+        with lock:
+            latency.record(received_at - sent_at)
+            received[0] += 1
+
+    peers = [Peer(index, args.base_port + index, args, on_received) for index in range(args.peers)]
+    wait_for_servers(peers)
+
+    groups = []
+    if args.group_size > 1:
+        for index in range(max(1, args.peers // args.group_size)):
+            members = random.sample(peers, min(args.group_size, len(peers)))
+            groups.append((f"group{index}", members))
+
+    # Direct and group sends interleaved in a random order
+    plan = ['direct'] * args.messages + ['group'] * (args.group_messages if groups else 0)
+    random.shuffle(plan)
+    expected = args.messages
+    if groups:
+        # Each group message reaches every member but its sender
+        expected += sum(len(groups[index % len(groups)][1]) - 1 for index in range(args.group_messages))
+
+    interval = 1.0 / args.rate if args.rate else 0
+    started = time.perf_counter()
+    group_index = 0
+
+    for kind in plan:
+        if kind == 'direct':
+            sender, recipient = random.sample(peers, 2)
+            sender.messenger.send_message(recipient.contact['onion_address'], recipient.contact['public_key'],
+                                          make_payload(args.size))
+        else:
+            group_id, members = groups[group_index % len(groups)]
+            group_index += 1
+            sender = random.choice(members)
+            sender.messenger.send_group_message(group_id, [member.contact for member in members],
+                                                make_payload(args.size))
+
+        if interval:
+            time.sleep(interval)
+
+    sent_in = time.perf_counter() - started
+
+    deadline = time.time() + args.timeout
+    while received[0] < expected and time.time() < deadline:
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - started
+
+    stages = LatencyMetrics()
+    statuses = {}
+    for peer in peers:
+        stages.merge(peer.messenger.metrics)
+        for status, count in peer.messenger.get_pending_counts().items():
+            statuses[status] = statuses.get(status, 0) + count
+
+    report(args, expected, received[0], sent_in, elapsed, latency, stages.snapshot(), statuses)
+
+    for peer in peers:
+        peer.messenger.close()
+
+    return 0 if received[0] >= expected else 1
+
+
+def format_ms(seconds):
+    return "-" if seconds is None else f"{seconds * 1000:.2f}"
+
+
+def report(args, expected, received, sent_in, elapsed, latency, stages, statuses):
+    print(f"peers={args.peers} engine={args.engine} size={args.size}B "
+          f"direct={args.messages} group={args.group_messages} (group size {args.group_size}, "
+          f"relay fanout {args.relay_fanout})")
+    print(f"delivered {received}/{expected} in {elapsed:.2f}s (queued in {sent_in:.2f}s), "
+          f"{received / elapsed if elapsed else 0:.0f} msg/s")
+
+    summary = latency.summary()
+    print(f"end to end ms: p50={format_ms(summary['p50'])} p95={format_ms(summary['p95'])} "
+          f"p99={format_ms(summary['p99'])} max={format_ms(summary['max'])}")
+    print(f"statuses: {statuses}")
+
+    print(f"{'stage':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage in sorted(stages):
+        stage_summary = stages[stage]
+        print(f"{stage:<18}{stage_summary['count']:>8}{format_ms(stage_summary['p50']):>10}"
+              f"{format_ms(stage_summary['p95']):>10}{format_ms(stage_summary['p99']):>10}"
+              f"{format_ms(stage_summary['max']):>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the messenger over the loopback transport")
+    parser.add_argument('--peers', type=int, default=4, help="number of messengers to start")
+    parser.add_argument('--messages', type=int, default=1000, help="direct messages to send in total")
+    parser.add_argument('--group-size', type=int, default=0, help="members per group, 0 for no groups")
+    parser.add_argument('--group-messages', type=int, default=0, help="group messages to send in total")
+    parser.add_argument('--size', type=int, default=200, help="approximate message size in bytes")
+    parser.add_argument('--rate', type=float, default=0, help="messages per second, 0 for as fast as possible")
+    parser.add_argument('--relay-fanout', type=int, default=0,
+                        help="relay group messages to groups larger than this, 0 to send to every member")
+    parser.add_argument('--engine', choices=('threads', 'asyncio'), default='threads', help="send engine")
+    parser.add_argument('--base-port', type=int, default=6100, help="receive port of the first peer")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for deliveries")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the traffic pattern")
+    parser.add_argument('--verbose', action='store_true', help="show messenger logging")
+    args = parser.parse_args()
+
+    if args.peers < 2:
+        parser.error("--peers must be at least 2")
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
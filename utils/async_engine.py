@@ -0,0 +1,265 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+try:
+    import aiohttp
+    from aiohttp_socks import ProxyConnector, ProxyError, ProxyTimeoutError
+except ImportError:
+    aiohttp = None
+    ProxyConnector = ProxyError = ProxyTimeoutError = None
+
+
+class AsyncResponse:
+    """The parts of a requests.Response the send flows read, for a body aiohttp has already read"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode(errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class AsyncSendEngine:
+    """
+    Run send flows for many peers concurrently on a single asyncio event loop thread
+
+    A flow is a generator that yields request dicts ({'method', 'url', 'data',
+    'headers', 'timeout'}) and is sent back the response, so TorMessenger keeps one
+    copy of its send logic for both this engine and the thread scheduler. Network
+    errors are thrown into the flow as the matching requests exceptions.
+
+    Only the requests themselves run on the loop. The flow code between them writes
+    statuses to the database and encrypts, so each step is run on a small pool of
+    worker threads instead of blocking every other peer's flow.
+
+    Like SendScheduler, each peer gets at most per_peer_limit flows at once and a
+    peer whose last flow returned False gets one at a time until it recovers.
+    """
+
+    def __init__(self, proxy_port=9050, max_in_flight=1000, per_peer_limit=4, max_peers=256, idle_timeout=300,
+                 step_workers=8):
+        if aiohttp is None:
+            raise ImportError("The asyncio send engine needs the aiohttp and aiohttp_socks packages")
+
+        self.logger = logging.getLogger('TorMessenger')
+        self.proxy_port = proxy_port
+        self.max_in_flight = max_in_flight
+        self.per_peer_limit = per_peer_limit
+        self.max_peers = max_peers
+        self.idle_timeout = idle_timeout
+
+        # onion address -> {'session': aiohttp.ClientSession, 'last_used': float}
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+        # onion address -> {'slots', 'probe', 'failing', 'flows'}, only touched on the loop thread
+        self.peers = {}
+        self.in_flight = 0
+        self.completed = 0
+        self.closed = False
+
+        self.step_executor = ThreadPoolExecutor(max_workers=step_workers, thread_name_prefix="async-send-step")
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(ready,), name="async-send-engine", daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def _run(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    def submit(self, address, flow):
+        """Schedule a flow for a peer; safe to call from any thread"""
+        if self.closed:
+            raise RuntimeError("Send engine is shut down")
+        self.loop.call_soon_threadsafe(self._start, address, flow)
+
+    def _start(self, address, flow):
+        self.in_flight += 1
+        self.loop.create_task(self._run_flow(address, flow))
+
+    async def _run_flow(self, address, flow):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = {
+                'slots': asyncio.Semaphore(self.per_peer_limit),
+                'probe': asyncio.Lock(),
+                'failing': False,
+                'flows': 0
+            }
+        peer['flows'] += 1
+
+        try:
+            # A global slot is only taken once the peer lets this flow run, so flows queued
+            # behind a slow or unreachable peer don't hold slots other peers could use
+            async with peer['slots']:
+                if peer['failing']:
+                    # Probe an unreachable peer one flow at a time
+                    async with peer['probe'], self.slots:
+                        result = await self._drive(address, flow)
+                else:
+                    async with self.slots:
+                        result = await self._drive(address, flow)
+                peer['failing'] = result is False
+
+        except Exception as e:
+            self.logger.error(f"Error in send flow for {address}: {e}")
+
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            peer['flows'] -= 1
+            if not peer['flows']:
+                del self.peers[address]
+
+    async def _drive(self, address, flow):
+        """Perform each request a flow yields until it returns"""
+        done, request = await self._step(flow.send, None)
+        while not done:
+            try:
+                response = await self._request(address, request)
+            except (asyncio.TimeoutError, ProxyTimeoutError):
+                done, request = await self._step(flow.throw, requests.exceptions.Timeout(
+                    f"Request to {address} timed out"))
+            except (aiohttp.ClientError, ProxyError, OSError) as e:
+                # Includes Tor refusing the circuit, e.g. for an offline onion service
+                done, request = await self._step(flow.throw, requests.exceptions.ConnectionError(str(e)))
+            else:
+                done, request = await self._step(flow.send, response)
+        return request
+
+    async def _step(self, resume, value):
+        """Run a flow up to its next request on a worker thread, returning (done, request or result)"""
+        def run():
+            # StopIteration can't be set on a future, so it is turned into a result here
+            try:
+                return False, resume(value)
+            except StopIteration as stop:
+                return True, stop.value
+
+        return await self.loop.run_in_executor(self.step_executor, run)
+
+    async def _request(self, address, request):
+        session = self._get_session(address)
+        timeout = aiohttp.ClientTimeout(total=request.get('timeout', 60))
+        async with session.request(request['method'], request['url'], data=request.get('data'),
+                                   headers=request.get('headers'), timeout=timeout) as response:
+            content = await response.read()
+        return AsyncResponse(response.status, response.headers, content)
+
+    def _create_session(self):
+        """Create a session whose connections to a single peer go through the Tor SOCKS proxy"""
+        if not self.proxy_port:
+            # Loopback transport
+            return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.per_peer_limit))
+
+        # rdns lets Tor resolve the onion address
+        connector = ProxyConnector.from_url(f'socks5://127.0.0.1:{self.proxy_port}', rdns=True,
+                                            limit=self.per_peer_limit)
+        return aiohttp.ClientSession(connector=connector)
+
+    def _get_session(self, address):
+        """Return the keep-alive session for a peer, creating it if needed (loop thread only)"""
+        now = time.time()
+        stale = []
+
+        with self.lock:
+            # Drop sessions idle for longer than idle_timeout, then respect the peer cap
+            while self.sessions:
+                oldest_address, oldest = next(iter(self.sessions.items()))
+                if now - oldest['last_used'] < self.idle_timeout and len(self.sessions) < self.max_peers:
+                    break
+                if oldest_address == address:
+                    break
+                self.sessions.popitem(last=False)
+                stale.append(oldest['session'])
+
+            entry = self.sessions.get(address)
+            if entry:
+                self.sessions.move_to_end(address)
+            else:
+                entry = self.sessions[address] = {'session': self._create_session(), 'last_used': now}
+            entry['last_used'] = now
+
+        for session in stale:
+            self.loop.create_task(self._close_session(session))
+
+        return entry['session']
+
+    def is_warm(self, address):
+        """True if the peer's session was used recently enough that its connection is likely still open"""
+        with self.lock:
+            entry = self.sessions.get(address)
+            return bool(entry) and time.time() - entry['last_used'] < self.idle_timeout
+
+    def idle_for(self, address):
+        """Seconds since the peer's session was last used, or None if there is no session"""
+        with self.lock:
+            entry = self.sessions.get(address)
+            return time.time() - entry['last_used'] if entry else None
+
+    def discard(self, address):
+        """Drop the session for a peer, e.g. after its connection broke"""
+        with self.lock:
+            entry = self.sessions.pop(address, None)
+
+        if entry:
+            asyncio.run_coroutine_threadsafe(self._close_session(entry['session']), self.loop)
+
+    async def _close_session(self, session):
+        try:
+            await session.close()
+        except Exception as e:
+            self.logger.error(f"Error closing async session: {e}")
+
+    def get_stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'peers': len(self.peers),
+            'sessions': len(self.sessions)
+        }
+
+    def close(self, timeout=10):
+        """Wait for running flows to finish, close every session and stop the loop"""
+        if self.closed:
+            return
+        self.closed = True
+
+        future = asyncio.run_coroutine_threadsafe(self._shutdown(timeout), self.loop)
+        try:
+            future.result(timeout + 5)
+        except Exception as e:
+            self.logger.error(f"Error shutting down send engine: {e}")
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.step_executor.shutdown(wait=False)
+
+    async def _shutdown(self, timeout):
+        deadline = time.time() + timeout
+        while self.in_flight and time.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        with self.lock:
+            sessions = [entry['session'] for entry in self.sessions.values()]
+            self.sessions.clear()
+
+        for session in sessions:
+            await self._close_session(session)
@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+from contextlib import contextmanager
+
+# Payload type used for attachment transfers waiting in the outbox
+TRANSFER_TYPE = 'attachment_transfer'
+
+# Size of each encrypted slice posted to /attachment/chunk
+CHUNK_SIZE = 256 * 1024
+
+# Media subdirectory per attachment type, same layout as FileHandler
+MEDIA_SUBDIRS = {'image': 'images', 'video': 'videos'}
+
+# Completed transfers are named after the first 16 hex digits of their SHA-256
+RECEIVED_NAME = re.compile(r'[0-9a-f]{16}_.+')
+
+
+class AttachmentError(Exception):
+    """Raised when an offer or chunk can't be accepted"""
+
+
+class UnknownTransfer(AttachmentError):
+    """The chunk belongs to a transfer we have no offer for, e.g. after it expired"""
+
+
+class TransferLimit(AttachmentError):
+    """The sender already has as many unfinished transfers, or bytes in them, as we accept"""
+
+
+class OffsetMismatch(AttachmentError):
+    """The chunk doesn't start where our partial file ends; offset is where the sender should resume"""
+
+    def __init__(self, offset):
+        super().__init__(f"Expected offset {offset}")
+        self.offset = offset
+
+
+def file_sha256(path, block_size=CHUNK_SIZE):
+    """Hash a file without reading it into memory at once"""
+    sha256_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256_hash.update(block)
+    return sha256_hash.hexdigest()
+
+
+def describe_attachment(path, file_type=None, sha256=None):
+    """Build the outgoing transfer record for a local file, hashing it unless the caller already has"""
+    return {
+        'type': TRANSFER_TYPE,
+        'transfer_id': uuid.uuid4().hex,
+        'path': path,
+        'name': os.path.basename(path),
+        'size': os.path.getsize(path),
+        'sha256': sha256 or file_sha256(path),
+        'file_type': file_type or 'file'
+    }
+
+
+class AttachmentStore:
+    """
+    Receiving side of chunked attachment transfers
+
+    Chunks are appended to a partial file under media_dir/incoming, so the offset a
+    sender resumes from is simply the size of that file, even across restarts. Once
+    the last chunk arrives the file is checked against the offered hash and moved
+    into the images, videos or documents directory.
+
+    Each sender may have at most max_transfers unfinished transfers totalling
+    max_pending_bytes, so one contact can't fill the disk with offers. Transfers that
+    stalled for stale_after are dropped, checked at most every expire_interval when
+    offers come in, so their reservations are released without a restart.
+    """
+
+    def __init__(self, media_dir, max_size=2 * 1024 * 1024 * 1024, stale_after=7 * 24 * 3600,
+                 max_transfers=4, max_pending_bytes=4 * 1024 * 1024 * 1024, expire_interval=3600):
+        self.media_dir = media_dir
+        self.incoming_dir = os.path.join(media_dir, 'incoming')
+        self.max_size = max_size
+        self.stale_after = stale_after
+        self.max_transfers = max_transfers
+        self.max_pending_bytes = max_pending_bytes
+        self.expire_interval = expire_interval
+        self.last_expired = 0
+        self.lock = threading.Lock()
+        # transfer id -> [lock, number of threads using it], only while a transfer is being worked on
+        self.transfer_locks = {}
+        # sender public key -> {transfer id: offered size} of its unfinished transfers
+        self.pending = {}
+
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        self.expire()
+
+    def _paths(self, transfer_id):
+        base = os.path.join(self.incoming_dir, transfer_id)
+        return base + '.json', base + '.part'
+
+    @contextmanager
+    def _transfer_lock(self, transfer_id):
+        """Serialize work on one transfer; its lock is dropped again once no thread uses it"""
+        with self.lock:
+            entry = self.transfer_locks.setdefault(transfer_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.transfer_locks[transfer_id]
+
+    def _load_meta(self, transfer_id):
+        meta_path, _ = self._paths(transfer_id)
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_meta(self, meta):
+        meta_path, _ = self._paths(meta['transfer_id'])
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+
+    def begin(self, sender_public_key, offer):
+        """Register an offered attachment and return the offset to resume from"""
+        transfer_id = str(offer.get('transfer_id', ''))
+        try:
+            if len(bytes.fromhex(transfer_id)) != 16:
+                raise ValueError
+        except ValueError:
+            raise AttachmentError("Invalid transfer id")
+
+        sha256 = offer.get('sha256')
+        if not isinstance(sha256, str) or len(sha256) != 64:
+            raise AttachmentError("Missing attachment checksum")
+
+        # An empty file has no chunk that could complete it
+        size = int(offer.get('size', -1))
+        if size <= 0 or size > self.max_size:
+            raise AttachmentError(f"Attachment size {size} is not allowed")
+
+        if time.time() - self.last_expired >= self.expire_interval:
+            self.expire()
+
+        with self._transfer_lock(transfer_id):
+            meta = self._load_meta(transfer_id)
+            if meta:
+                if meta['sender'] != sender_public_key or meta['size'] != size or meta['sha256'] != sha256:
+                    raise AttachmentError("Transfer id already in use")
+                return meta['size'] if meta.get('path') else os.path.getsize(self._paths(transfer_id)[1])
+
+            self._reserve(sender_public_key, transfer_id, size)
+            self._save_meta({
+                'transfer_id': transfer_id,
+                'sender': sender_public_key,
+                'name': os.path.basename(str(offer.get('name', ''))) or 'attachment',
+                'size': size,
+                'sha256': sha256,
+                'file_type': offer.get('file_type', 'file'),
+                'started_at': time.time()
+            })
+            open(self._paths(transfer_id)[1], 'wb').close()
+            return 0
+
+    def _reserve(self, sender_public_key, transfer_id, size):
+        with self.lock:
+            pending = self.pending.setdefault(sender_public_key, {})
+            if len(pending) >= self.max_transfers or sum(pending.values()) + size > self.max_pending_bytes:
+                raise TransferLimit("Too many unfinished transfers from this sender")
+            pending[transfer_id] = size
+
+    def _release(self, sender_public_key, transfer_id):
+        with self.lock:
+            pending = self.pending.get(sender_public_key, {})
+            pending.pop(transfer_id, None)
+            if not pending:
+                self.pending.pop(sender_public_key, None)
+
+    def write_chunk(self, sender_public_key, transfer_id, offset, data):
+        """
+        Append a chunk to its partial file
+
+        Returns:
+            tuple: (new offset, completed transfer metadata with its final 'path', or None)
+        """
+        transfer_id = transfer_id.hex()
+        with self._transfer_lock(transfer_id):
+            meta = self._load_meta(transfer_id)
+            if not meta:
+                raise UnknownTransfer(f"Unknown transfer {transfer_id}")
+            if meta['sender'] != sender_public_key:
+                raise AttachmentError("Chunk from a different sender")
+            if meta.get('path'):
+                # Already complete; the sender missed our last response
+                raise OffsetMismatch(meta['size'])
+
+            part_path = self._paths(transfer_id)[1]
+            current = os.path.getsize(part_path)
+            if offset != current:
+                raise OffsetMismatch(current)
+            if current + len(data) > meta['size']:
+                raise AttachmentError("Chunk runs past the end of the attachment")
+
+            with open(part_path, 'ab') as f:
+                f.write(data)
+            current += len(data)
+
+            if current < meta['size']:
+                return current, None
+            return current, self._complete(meta)
+
+    def _complete(self, meta):
+        """Verify a fully received file and move it into the media directory"""
+        part_path = self._paths(meta['transfer_id'])[1]
+        self._release(meta['sender'], meta['transfer_id'])
+        if file_sha256(part_path) != meta['sha256']:
+            os.remove(part_path)
+            os.remove(self._paths(meta['transfer_id'])[0])
+            raise AttachmentError("Attachment checksum mismatch")
+
+        dest_dir = os.path.join(self.media_dir, MEDIA_SUBDIRS.get(meta['file_type'], 'documents'))
+        os.makedirs(dest_dir, exist_ok=True)
+        dest_path = os.path.join(dest_dir, f"{meta['sha256'][:16]}_{meta['name']}")
+        os.replace(part_path, dest_path)
+
+        # Keep the metadata around so a repeated offer or final chunk is answered as complete
+        meta['path'] = dest_path
+        meta['completed_at'] = time.time()
+        self._save_meta(meta)
+        return meta
+
+    def expire(self):
+        """Remove partial files that stalled, and completion records, older than stale_after"""
+        self.last_expired = time.time()
+        cutoff = self.last_expired - self.stale_after
+        for filename in os.listdir(self.incoming_dir):
+            if not filename.endswith('.json'):
+                continue
+
+            transfer_id = filename[:-len('.json')]
+            with self._transfer_lock(transfer_id):
+                meta = self._load_meta(transfer_id)
+                if meta and self._last_active(meta) >= cutoff:
+                    if not meta.get('path'):
+                        # Still counts against its sender's limits after a restart
+                        with self.lock:
+                            self.pending.setdefault(meta['sender'], {})[transfer_id] = meta['size']
+                    continue
+
+                if meta:
+                    self._release(meta['sender'], transfer_id)
+
+                for path in self._paths(transfer_id):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+    def _last_active(self, meta):
+        """When a transfer completed, or last received a chunk"""
+        if meta.get('path'):
+            return meta.get('completed_at', 0)
+        try:
+            return max(meta.get('started_at', 0), os.path.getmtime(self._paths(meta['transfer_id'])[1]))
+        except FileNotFoundError:
+            return meta.get('started_at', 0)
+
+    def is_received_file(self, path):
+        """Whether path is a file a completed transfer moved into the media directory"""
+        path = os.path.realpath(path)
+        media_dir = os.path.realpath(self.media_dir)
+        folders = set(MEDIA_SUBDIRS.values()) | {'documents'}
+        return (os.path.dirname(os.path.dirname(path)) == media_dir
+                and os.path.basename(os.path.dirname(path)) in folders
+                and RECEIVED_NAME.fullmatch(os.path.basename(path)) is not None
+                and os.path.isfile(path))
@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+from nacl.public import PublicKey, Box
+from nacl.encoding import HexEncoder
+
+
+class BoxCache:
+    """Bounded LRU cache of precomputed NaCl boxes keyed by peer public key (hex)"""
+
+    def __init__(self, private_key, max_size=256):
+        self.private_key = private_key
+        self.max_size = max_size
+        self.boxes = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, public_key_hex):
+        """Return the Box for a peer, computing the Curve25519 shared key only on a miss"""
+        key = public_key_hex.lower()
+
+        with self.lock:
+            box = self.boxes.get(key)
+            if box is not None:
+                self.boxes.move_to_end(key)
+                self.hits += 1
+                return box
+            self.misses += 1
+
+        # Box() runs the shared key computation, so do it outside the lock
+        box = Box(self.private_key, PublicKey(key.encode(), encoder=HexEncoder))
+
+        with self.lock:
+            self.boxes[key] = box
+            self.boxes.move_to_end(key)
+            while len(self.boxes) > self.max_size:
+                self.boxes.popitem(last=False)
+
+        return box
+
+    def invalidate(self, public_key_hex):
+        """Forget the box for a peer whose key changed or was removed"""
+        if not public_key_hex:
+            return
+        with self.lock:
+            self.boxes.pop(public_key_hex.lower(), None)
+
+    def clear(self):
+        with self.lock:
+            self.boxes.clear()
+
+
+class SenderKeyIndex:
+    """Bounded LRU map from envelope key ids to the full public keys (hex) they stand for"""
+
+    def __init__(self, key_id, max_size=4096):
+        self.key_id = key_id
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, public_key_hex):
+        public_key_hex = public_key_hex.lower()
+        key_id = self.key_id(bytes.fromhex(public_key_hex))
+        with self.lock:
+            self.keys[key_id] = public_key_hex
+            self.keys.move_to_end(key_id)
+            while len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+
+    def get(self, key_id):
+        with self.lock:
+            public_key_hex = self.keys.get(key_id)
+            if public_key_hex is not None:
+                self.keys.move_to_end(key_id)
+            return public_key_hex
+
+    def __len__(self):
+        return len(self.keys)
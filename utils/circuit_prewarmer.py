@@ -0,0 +1,39 @@
+import logging
+import threading
+
+
+class CircuitPrewarmer:
+    """
+    Keep Tor circuits and pooled connections open to the contacts we are most likely to message
+
+    Every interval the top_n most recently active contacts are looked up and
+    warm_callback(onion_address) is called for each of them. The callback is
+    expected to skip peers whose connection is still fresh, so a contact that is
+    already being talked to costs nothing extra.
+    """
+
+    def __init__(self, warm_callback, contacts_source, top_n=8, interval=60):
+        self.logger = logging.getLogger('TorMessenger')
+        self.warm_callback = warm_callback
+        self.contacts_source = contacts_source
+        self.top_n = top_n
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # Warm up right away so the first message after startup doesn't pay for the rendezvous
+        while True:
+            try:
+                for contact in self.contacts_source(self.top_n):
+                    self.warm_callback(contact['onion_address'])
+            except Exception as e:
+                self.logger.error(f"Error pre-warming circuits: {e}")
+
+            if self.stop_event.wait(self.interval):
+                return
+
+    def close(self):
+        self.stop_event.set()
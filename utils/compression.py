@@ -0,0 +1,79 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressed payloads start with one of these codec ids, inside the encryption
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+# Codecs we can decode, advertised to peers as features; zstd is preferred when both sides have it
+FEATURES = ('zstd', 'zlib') if zstandard else ('zlib',)
+
+# Below this size the codec header and framing outweigh any savings
+MIN_SIZE = 256
+
+# Refuse to inflate a payload beyond this, so a small message can't exhaust memory
+MAX_DECOMPRESSED_SIZE = 32 * 1024 * 1024
+
+
+class CompressionError(ValueError):
+    """Raised when a compressed payload is corrupt, uses an unknown codec or inflates too far"""
+
+
+def compress(data, peer_features=()):
+    """
+    Compress data with the best codec the peer advertised
+
+    Returns:
+        tuple: (payload, compressed); data is returned unchanged if it is small, the peer
+               supports no codec, or compression doesn't make it smaller
+    """
+    if len(data) < MIN_SIZE:
+        return data, False
+
+    if zstandard and 'zstd' in peer_features:
+        payload = bytes([CODEC_ZSTD]) + zstandard.ZstdCompressor(level=3).compress(data)
+    elif 'zlib' in peer_features:
+        payload = bytes([CODEC_ZLIB]) + zlib.compress(data, 6)
+    else:
+        return data, False
+
+    if len(payload) >= len(data):
+        return data, False
+    return payload, True
+
+
+def decompress(payload, max_size=MAX_DECOMPRESSED_SIZE):
+    """Inverse of compress() for a payload that was flagged as compressed"""
+    if not payload:
+        raise CompressionError("Empty compressed payload")
+
+    codec, body = payload[0], payload[1:]
+    try:
+        if codec == CODEC_ZLIB:
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(body, max_size)
+            if decompressor.unconsumed_tail:
+                raise CompressionError("Decompressed payload too large")
+            return data
+
+        if codec == CODEC_ZSTD and zstandard:
+            # One-shot decompression allocates whatever size the frame declares, so check
+            # that first, then stream so a frame that lies about its size can't go past it
+            declared = zstandard.frame_content_size(body)
+            if declared > max_size:
+                raise CompressionError("Decompressed payload too large")
+
+            with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+                data = reader.read(max_size + 1)
+            if len(data) > max_size:
+                raise CompressionError("Decompressed payload too large")
+            return data
+
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise CompressionError(f"Corrupt compressed payload: {e}")
+
+    raise CompressionError(f"Unsupported compression codec {codec}")
@@ -40,6 +40,17 @@ class Config:
             'storage': {
                 'download_location': os.path.expanduser("~/Downloads"),
                 'auto_download_media': True
+            },
+            'network': {
+                # 'asyncio' needs the aiohttp and aiohttp-socks packages
+                'send_engine': 'threads',
+                # Groups larger than this many members are sent along a relay tree, 0 sends to everyone directly
+                'group_relay_fanout': 0,
+                # ControlPort of an already running Tor (e.g. 9051) to publish through instead of starting our own
+                'tor_control_port': None,
+                'tor_control_password': None,
+                # Local port of the receive server; give each user sharing one Tor its own
+                'receive_port': 5000
             }
         }
 
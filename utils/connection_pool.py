@@ -0,0 +1,140 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class ConnectionPool:
+    """Keep-alive HTTP sessions through the Tor SOCKS proxy (or direct if proxy_port is None), one per onion peer"""
+
+    def __init__(self, proxy_port=9050, max_connections=64, connections_per_peer=4, idle_timeout=300,
+                 evict_interval=60):
+        self.logger = logging.getLogger('TorMessenger')
+        self.proxy_port = proxy_port
+        self.max_connections = max_connections
+        self.connections_per_peer = connections_per_peer
+        self.idle_timeout = idle_timeout
+        self.max_peers = max(1, max_connections // connections_per_peer)
+
+        # onion address -> {'session': requests.Session, 'last_used': float}
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Idle sessions hold a SOCKS connection and its circuit open, so close them even when nothing is sent
+        self.stop_event = threading.Event()
+        self.evict_thread = threading.Thread(target=self._evict_loop, args=(evict_interval,), daemon=True)
+        self.evict_thread.start()
+
+    def _create_session(self):
+        """Create a session that keeps its connections to a single peer open"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.connections_per_peer, pool_block=False)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        if self.proxy_port:
+            session.proxies = {
+                'http': f'socks5h://127.0.0.1:{self.proxy_port}',
+                'https': f'socks5h://127.0.0.1:{self.proxy_port}'
+            }
+        else:
+            # Loopback transport; don't pick up a proxy from the environment either
+            session.trust_env = False
+        return session
+
+    def get_session(self, address):
+        """Return the pooled session for an onion address, creating it if needed"""
+        now = time.time()
+        stale = []
+
+        with self.lock:
+            stale.extend(self._pop_idle(now))
+
+            entry = self.sessions.get(address)
+            if entry:
+                # Mark as most recently used
+                self.sessions.move_to_end(address)
+            else:
+                # Respect the connection cap by dropping the least recently used peers
+                while len(self.sessions) >= self.max_peers:
+                    _, oldest = self.sessions.popitem(last=False)
+                    stale.append(oldest['session'])
+
+                entry = {'session': self._create_session(), 'last_used': now}
+                self.sessions[address] = entry
+
+            entry['last_used'] = now
+            session = entry['session']
+
+        # Close evicted sessions outside the lock
+        for old_session in stale:
+            self._close_session(old_session)
+
+        return session
+
+    def is_warm(self, address):
+        """True if a session for the peer was used recently enough that its connection is likely still open"""
+        with self.lock:
+            entry = self.sessions.get(address)
+            return bool(entry) and time.time() - entry['last_used'] < self.idle_timeout
+
+    def idle_for(self, address):
+        """Seconds since the peer's session was last used, or None if there is no session"""
+        with self.lock:
+            entry = self.sessions.get(address)
+            return time.time() - entry['last_used'] if entry else None
+
+    def _pop_idle(self, now):
+        """Remove sessions that have been idle for longer than idle_timeout (lock must be held)"""
+        idle = []
+        while self.sessions:
+            address, entry = next(iter(self.sessions.items()))
+            if now - entry['last_used'] < self.idle_timeout:
+                break
+            self.sessions.popitem(last=False)
+            self.logger.debug(f"Evicting idle connection to {address}")
+            idle.append(entry['session'])
+        return idle
+
+    def evict_idle(self):
+        """Close every session that has been idle for longer than idle_timeout"""
+        with self.lock:
+            idle = self._pop_idle(time.time())
+
+        for session in idle:
+            self._close_session(session)
+
+        return len(idle)
+
+    def _evict_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                self.logger.error(f"Error evicting idle connections: {e}")
+
+    def discard(self, address):
+        """Drop the session for a peer, e.g. after its connection broke"""
+        with self.lock:
+            entry = self.sessions.pop(address, None)
+
+        if entry:
+            self._close_session(entry['session'])
+
+    def _close_session(self, session):
+        try:
+            session.close()
+        except Exception as e:
+            self.logger.error(f"Error closing pooled session: {e}")
+
+    def close(self):
+        """Close all pooled sessions"""
+        self.stop_event.set()
+        with self.lock:
+            sessions = [entry['session'] for entry in self.sessions.values()]
+            self.sessions.clear()
+
+        for session in sessions:
+            self._close_session(session)
@@ -4,6 +4,9 @@ import json
 
 import appdirs
 
+from .message_ids import base_message_id
+from .message_status import statuses_after
+
 
 class Database:
     def __init__(self):
@@ -97,6 +100,65 @@ class Database:
                         )
                     ''')
 
+            # Create group_keys table for symmetric sender keys (ours and other members')
+            cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS group_keys (
+                            group_id TEXT NOT NULL,
+                            owner_key TEXT NOT NULL,
+                            key_id TEXT NOT NULL,
+                            secret_key TEXT NOT NULL,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            PRIMARY KEY (owner_key, key_id)
+                        )
+                    ''')
+
+            # Create signing_keys table for the keys members sign group messages with
+            cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS signing_keys (
+                            owner_key TEXT PRIMARY KEY,
+                            verify_key TEXT NOT NULL
+                        )
+                    ''')
+
+            # Create outbox table for messages still waiting to be delivered
+            cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS outbox (
+                            message_id TEXT PRIMARY KEY,
+                            recipient_address TEXT NOT NULL,
+                            recipient_public_key TEXT NOT NULL,
+                            payload TEXT NOT NULL,
+                            attempts INTEGER DEFAULT 0,
+                            next_attempt_at REAL NOT NULL,
+                            deadline REAL NOT NULL,
+                            last_error TEXT,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    ''')
+
+            cursor.execute('''
+                        CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt
+                        ON outbox (next_attempt_at)
+                    ''')
+
+            # Create group_envelopes table: sealed group messages by sender and sequence number, for history sync.
+            # envelope is NULL for messages we only received sealed for us, which can't be passed on
+            cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS group_envelopes (
+                            group_id TEXT NOT NULL,
+                            sender_key TEXT NOT NULL,
+                            seq INTEGER NOT NULL,
+                            message_id TEXT,
+                            envelope BLOB,
+                            PRIMARY KEY (group_id, sender_key, seq)
+                        )
+                    ''')
+
+            # Received message ids are looked up for every incoming message to drop retried duplicates
+            cursor.execute('''
+                        CREATE INDEX IF NOT EXISTS idx_messages_message_id
+                        ON messages (message_id, chat_id)
+                    ''')
+
             conn.commit()
 
     def add_contact(self, contact_id, name, status="", avatar_path=""):
@@ -226,8 +288,15 @@ class Database:
             return list(reversed(messages))
 
     def mark_messages_as_read(self, chat_id):
+        """Mark received messages as read and return the sender's ids of the ones that were unread"""
         with self.get_connection() as conn:
             cursor = conn.cursor()
+            cursor.execute('''
+                SELECT message_id FROM messages
+                WHERE chat_id = ? AND type = 'received' AND status = 'unread' AND message_id IS NOT NULL
+            ''', (chat_id,))
+            message_ids = [row[0] for row in cursor.fetchall()]
+
             cursor.execute('''
                 UPDATE messages 
                 SET status = 'read'
@@ -241,58 +310,34 @@ class Database:
             ''', (chat_id,))
 
             conn.commit()
+            return message_ids
 
     def update_message_status(self, message_id, new_status):
-        """Update the status of a message by its message_id or database ID"""
+        """
+        Update the status of a message by its message_id or database ID
+
+        A recipient's copy of a group message (see utils/message_ids.py) updates the
+        group message it belongs to.
+        """
         with self.get_connection() as conn:
             cursor = conn.cursor()
 
             try:
-                # Use different approaches to find the message
-                updated = False
-
-                # Extract base message ID if this is an extended group message ID
-                base_message_id = message_id
-                if isinstance(message_id, str) and message_id.startswith('grp_') and '_' in message_id:
-                    # Extract the group message ID part (before the recipient ID)
-                    parts = message_id.split('_')
-                    base_message_id = f"grp_{parts[1]}"
-
-                # 1. Try with base message ID first
-                cursor.execute('''
-                    UPDATE messages
-                    SET status = ?
-                    WHERE message_id = ?
-                ''', (new_status, base_message_id))
-
-                if cursor.rowcount > 0:
-                    updated = True
-                    print(f"DEBUG: Updated message by base message_id: {base_message_id}")
-
-                # 2. If that fails, try with the full extended ID
-                if not updated:
+                if isinstance(message_id, int):
                     cursor.execute('''
                         UPDATE messages
                         SET status = ?
-                        WHERE message_id = ?
+                        WHERE id = ?
                     ''', (new_status, message_id))
-
-                    if cursor.rowcount > 0:
-                        updated = True
-                        print(f"DEBUG: Updated message by full message_id: {message_id}")
-
-                # 3. If message_id is an integer, try database ID update
-                if not updated and isinstance(message_id, int):
+                else:
+                    # One lookup on the message_id index
                     cursor.execute('''
                         UPDATE messages
                         SET status = ?
-                        WHERE id = ?
-                    ''', (new_status, message_id))
-
-                    if cursor.rowcount > 0:
-                        updated = True
-                        print(f"DEBUG: Updated message by database ID: {message_id}")
+                        WHERE message_id = ?
+                    ''', (new_status, base_message_id(message_id)))
 
+                updated = cursor.rowcount > 0
                 conn.commit()
 
                 # Debug the result
@@ -308,6 +353,53 @@ class Database:
                 conn.rollback()
                 return False
 
+    def apply_message_statuses(self, statuses):
+        """
+        Apply a batch of {message_id: status} changes to messages we sent, in one transaction
+
+        A message never moves back, e.g. from delivered to sent, and a recipient's copy of a
+        group message updates the group message it belongs to. Statuses don't say which chat
+        they belong to, so each one only changes rows in the chat where we first sent that
+        message id; received messages are never touched. Returns the number of rows changed.
+        """
+        by_status = {}
+        for message_id, status in statuses.items():
+            by_status.setdefault(status, set()).add(base_message_id(message_id))
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+
+            try:
+                updated = 0
+                for status, message_ids in by_status.items():
+                    message_ids = list(message_ids)
+                    later = statuses_after(status)
+                    guard = f"AND status NOT IN ({','.join('?' * len(later))})" if later else ""
+                    # Stay well under SQLite's limit on bound parameters
+                    for start in range(0, len(message_ids), 500):
+                        chunk = message_ids[start:start + 500]
+                        placeholders = ','.join('?' * len(chunk))
+                        cursor.execute(f'''
+                            UPDATE messages
+                            SET status = ?
+                            WHERE message_id IN ({placeholders}) AND type != 'received' {guard}
+                                AND chat_id = (
+                                    SELECT sent.chat_id FROM messages sent
+                                    WHERE sent.message_id = messages.message_id AND sent.type != 'received'
+                                    ORDER BY sent.id
+                                    LIMIT 1
+                                )
+                        ''', [status] + chunk + list(later))
+                        updated += cursor.rowcount
+
+                conn.commit()
+                return updated
+
+            except Exception as e:
+                print(f"ERROR in apply_message_statuses: {e}")
+                conn.rollback()
+                return 0
+
     def get_unread_count(self, chat_id):
         with self.get_connection() as conn:
             cursor = conn.cursor()
@@ -431,6 +523,45 @@ class Database:
                 conn.rollback()
                 raise
 
+    def add_group_messages(self, messages):
+        """
+        Add several group messages in one transaction
+
+        Args:
+            messages: List of dicts with the add_group_message arguments
+        """
+        if not messages:
+            return
+
+        import time
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                last_ids = {}
+                for message in messages:
+                    attachments = message.get('attachments')
+                    cursor.execute('''
+                        INSERT INTO messages (chat_id, content, type, attachments, timestamp, status, message_id, group_id)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ''', (message['sender_id'], message['content'], message['message_type'],
+                          json.dumps(attachments) if attachments else None,
+                          message.get('timestamp') or time.time(), message.get('status', 'sent'),
+                          message.get('message_id'), message['group_id']))
+                    last_ids[message['group_id']] = cursor.lastrowid
+
+                cursor.executemany('''
+                    UPDATE groups
+                    SET last_message_id = ?
+                    WHERE id = ?
+                ''', [(row_id, group_id) for group_id, row_id in last_ids.items()])
+
+                conn.commit()
+
+            except Exception as e:
+                print(f"ERROR in add_group_messages: {e}")
+                conn.rollback()
+                raise
+
     def get_group_messages(self, group_id, limit=50):
         """Get messages for a specific group ordered by timestamp"""
         with self.get_connection() as conn:
@@ -462,3 +593,260 @@ class Database:
 
             print(f"DEBUG: Found {len(messages)} messages for group ID: {group_id}")
             return messages
+
+    def add_outbox_message(self, message_id, recipient_address, recipient_public_key, payload,
+                           next_attempt_at, deadline):
+        """Persist an outgoing message until it is delivered or its deadline passes"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO outbox
+                    (message_id, recipient_address, recipient_public_key, payload, next_attempt_at, deadline)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (message_id, recipient_address, recipient_public_key, payload, next_attempt_at, deadline))
+            conn.commit()
+
+    def get_outbox_message(self, message_id):
+        """Get an outbox entry by message_id"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM outbox WHERE message_id = ?', (message_id,))
+            columns = [col[0] for col in cursor.description]
+            row = cursor.fetchone()
+            return dict(zip(columns, row)) if row else None
+
+    def get_due_outbox_messages(self, now, limit=50):
+        """Get outbox entries whose next attempt is due, oldest first"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM outbox
+                WHERE next_attempt_at <= ?
+                ORDER BY next_attempt_at ASC
+                LIMIT ?
+            ''', (now, limit))
+
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def reschedule_outbox_message(self, message_id, next_attempt_at, attempts=None, last_error=None):
+        """Move the next attempt of an outbox entry, optionally recording a failed attempt"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE outbox
+                SET next_attempt_at = ?,
+                    attempts = COALESCE(?, attempts),
+                    last_error = COALESCE(?, last_error)
+                WHERE message_id = ?
+            ''', (next_attempt_at, attempts, last_error, message_id))
+            conn.commit()
+
+    def reschedule_outbox_messages(self, message_ids, next_attempt_at):
+        """Move the next attempt of several outbox entries at once"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Stay well under SQLite's limit on bound parameters
+            for start in range(0, len(message_ids), 500):
+                chunk = list(message_ids[start:start + 500])
+                placeholders = ','.join('?' * len(chunk))
+                cursor.execute(f'''
+                    UPDATE outbox
+                    SET next_attempt_at = ?
+                    WHERE message_id IN ({placeholders})
+                ''', [next_attempt_at] + chunk)
+            conn.commit()
+
+    def remove_outbox_message(self, message_id):
+        """Remove a delivered or abandoned message from the outbox"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM outbox WHERE message_id = ?', (message_id,))
+            conn.commit()
+
+    def add_group_key(self, group_id, owner_key, key_id, secret_key):
+        """Store a group sender key (hex encoded) owned by owner_key"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO group_keys (group_id, owner_key, key_id, secret_key)
+                VALUES (?, ?, ?, ?)
+            ''', (group_id, owner_key, key_id, secret_key))
+            conn.commit()
+
+    def get_group_key(self, owner_key, key_id):
+        """Get a group sender key by its owner and key id"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM group_keys WHERE owner_key = ? AND key_id = ?
+            ''', (owner_key, key_id))
+            columns = [col[0] for col in cursor.description]
+            row = cursor.fetchone()
+            return dict(zip(columns, row)) if row else None
+
+    def get_latest_group_key(self, group_id, owner_key):
+        """Get the most recent sender key an owner uses for a group"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT * FROM group_keys
+                WHERE group_id = ? AND owner_key = ?
+                ORDER BY created_at DESC, rowid DESC
+                LIMIT 1
+            ''', (group_id, owner_key))
+            columns = [col[0] for col in cursor.description]
+            row = cursor.fetchone()
+            return dict(zip(columns, row)) if row else None
+
+    def set_signing_key(self, owner_key, verify_key):
+        """Store the key (hex encoded) owner_key signs group messages with"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO signing_keys (owner_key, verify_key)
+                VALUES (?, ?)
+            ''', (owner_key, verify_key))
+            conn.commit()
+
+    def get_signing_key(self, owner_key):
+        """Get the hex encoded key owner_key signs group messages with"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT verify_key FROM signing_keys WHERE owner_key = ?', (owner_key,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def get_active_contacts(self, limit=8, since=None):
+        """Contacts with an onion address, most recently active first, with their message count since `since`"""
+        if since is None:
+            import time
+            since = time.time() - 7 * 24 * 3600
+
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT c.id, c.onion_address, c.public_key,
+                       MAX(m.timestamp) AS last_activity,
+                       COUNT(m.id) AS message_count,
+                       COALESCE(ch.unread_count, 0) AS unread_count
+                FROM contacts c
+                JOIN messages m ON m.chat_id = c.id
+                LEFT JOIN chats ch ON ch.contact_id = c.id
+                WHERE c.onion_address IS NOT NULL AND c.onion_address != ''
+                    AND m.timestamp >= ?
+                GROUP BY c.id
+                ORDER BY last_activity DESC, message_count DESC
+                LIMIT ?
+            ''', (since, limit))
+            columns = [col[0] for col in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def has_received_message(self, sender_id, message_id):
+        """Whether a message with this id was already received from sender_id"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT 1 FROM messages
+                WHERE message_id = ? AND chat_id = ? AND type = 'received'
+                LIMIT 1
+            ''', (message_id, sender_id))
+            return cursor.fetchone() is not None
+
+    def add_group_envelope(self, group_id, sender_key, seq, message_id, envelope=None):
+        """Remember a group message by its sender's sequence number, with the sealed envelope if we can share it"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO group_envelopes (group_id, sender_key, seq, message_id, envelope)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (group_id, sender_key, seq, message_id, envelope))
+            conn.commit()
+
+    def get_last_group_seq(self, group_id, sender_key):
+        """Highest sequence number stored for a sender in a group, 0 if none"""
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT MAX(seq) FROM group_envelopes WHERE group_id = ? AND sender_key = ?
+            ''', (group_id, sender_key))
+            result = cursor.fetchone()
+            return result[0] or 0
+
+    def get_group_sync_cursors(self, group_id, max_gaps=20):
+        """
+        What we have of each sender's numbered messages in a group, for /group_sync
+
+        Returns:
+            dict: sender key -> {'after': highest sequence number we have,
+                                 'missing': up to max_gaps [first, last] ranges below it we don't have}
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            # Each contiguous run of sequence numbers starts where seq - 1 is missing and ends where seq + 1 is
+            runs = {}
+            for column, offset in (('starts', -1), ('ends', 1)):
+                cursor.execute('''
+                    SELECT e.sender_key, e.seq
+                    FROM group_envelopes e
+                    WHERE e.group_id = ? AND NOT EXISTS (
+                        SELECT 1 FROM group_envelopes n
+                        WHERE n.group_id = e.group_id AND n.sender_key = e.sender_key AND n.seq = e.seq + ?
+                    )
+                    ORDER BY e.sender_key, e.seq
+                ''', (group_id, offset))
+                for sender_key, seq in cursor.fetchall():
+                    runs.setdefault(sender_key, {'starts': [], 'ends': []})[column].append(seq)
+
+        cursors = {}
+        for sender_key, sender_runs in runs.items():
+            missing = []
+            previous_end = 0
+            for start, end in zip(sender_runs['starts'], sender_runs['ends']):
+                if start > previous_end + 1:
+                    missing.append([previous_end + 1, start - 1])
+                previous_end = end
+            cursors[sender_key] = {'after': previous_end, 'missing': missing[:max_gaps]}
+        return cursors
+
+    def get_group_envelopes_after(self, group_id, cursors, limit=100):
+        """
+        Shareable group envelopes a member doesn't have yet, oldest first per sender
+
+        Args:
+            cursors: sender key -> {'after', 'missing'} as returned by get_group_sync_cursors;
+                     everything is sent for senders that aren't listed
+
+        Returns:
+            tuple: (list of (sender_key, seq, envelope), True if there are more after these)
+        """
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT DISTINCT sender_key FROM group_envelopes WHERE group_id = ?
+            ''', (group_id,))
+            senders = [row[0] for row in cursor.fetchall()]
+
+            # One row past the limit tells whether another page follows
+            rows = []
+            for sender_key in senders:
+                remaining = limit + 1 - len(rows)
+                if remaining <= 0:
+                    break
+
+                sender_cursor = cursors.get(sender_key, {})
+                conditions = ['seq > ?']
+                params = [group_id, sender_key, sender_cursor.get('after', 0)]
+                for first, last in sender_cursor.get('missing', []):
+                    conditions.append('seq BETWEEN ? AND ?')
+                    params.extend((first, last))
+
+                cursor.execute(f'''
+                    SELECT sender_key, seq, envelope FROM group_envelopes
+                    WHERE group_id = ? AND sender_key = ? AND envelope IS NOT NULL AND ({' OR '.join(conditions)})
+                    ORDER BY seq
+                    LIMIT ?
+                ''', params + [remaining])
+                rows.extend(cursor.fetchall())
+
+            return rows[:limit], len(rows) > limit
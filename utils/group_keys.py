@@ -0,0 +1,192 @@
+import threading
+
+import nacl.utils
+from nacl.secret import SecretBox
+from nacl.signing import SigningKey, VerifyKey
+
+from . import wire_format
+
+# Every member holds a sender's group key, so the key alone doesn't tell who sealed a
+# message. Sealed payloads therefore start with the sender's Ed25519 signature over
+# this context, the sender's public key, the group key id and the rest of the payload.
+SIGNATURE_CONTEXT = b'JustSocial group message v1'
+SIGNATURE_SIZE = 64
+VERIFY_KEY_SIZE = 32
+
+
+def _signed_data(owner_public_key, key_id, plaintext):
+    return SIGNATURE_CONTEXT + bytes.fromhex(owner_public_key) + key_id + plaintext
+
+
+class GroupKeyStore:
+    """
+    Symmetric sender keys for group messages: our own key per group and keys received from members
+
+    Also holds the Ed25519 keys that sealed messages are signed with: ours, and members'
+    verify keys. A verify key is only taken from its owner, through something boxed by
+    the owner, never from a third member.
+    """
+
+    def __init__(self, own_public_key, db=None, signing_key=None):
+        self.own_public_key = own_public_key
+        self.db = db
+        self.signing_key = signing_key or SigningKey.generate()
+        self.lock = threading.Lock()
+
+        # (owner public key, key id) -> {'group_id': str, 'key': bytes}
+        self.keys = {}
+        # group_id -> key id of our current sender key
+        self.own_keys = {}
+        # (group_id, member public key) pairs known to already hold our sender key
+        self.distributed = set()
+        # owner public key -> VerifyKey
+        self.verify_keys = {}
+
+    def get_own_key(self, group_id):
+        """Return (key_id, key) of our sender key for a group, creating it on first use"""
+        with self.lock:
+            key_id = self.own_keys.get(group_id)
+            if key_id:
+                return key_id, self.keys[(self.own_public_key, key_id)]['key']
+
+        stored = self.db.get_latest_group_key(group_id, self.own_public_key) if self.db else None
+        if stored:
+            key = bytes.fromhex(stored['secret_key'])
+            key_id = bytes.fromhex(stored['key_id'])
+            with self.lock:
+                self.keys[(self.own_public_key, key_id)] = {'group_id': group_id, 'key': key}
+                self.own_keys[group_id] = key_id
+            return key_id, key
+
+        return self.rotate(group_id)
+
+    def rotate(self, group_id):
+        """
+        Start using a new sender key for a group, e.g. after a member was removed
+
+        Members get the new key wrapped with our next message to them, so a removed
+        member can't read what we send from now on.
+        """
+        key = nacl.utils.random(SecretBox.KEY_SIZE)
+        key_id = wire_format.key_id(key)
+        if self.db:
+            self.db.add_group_key(group_id, self.own_public_key, key_id.hex(), key.hex())
+
+        with self.lock:
+            self.keys[(self.own_public_key, key_id)] = {'group_id': group_id, 'key': key}
+            self.own_keys[group_id] = key_id
+            self.distributed = {pair for pair in self.distributed if pair[0] != group_id}
+
+        return key_id, key
+
+    def seal(self, group_id, plaintext):
+        """Sign and encrypt a payload with our sender key for a group, returning (key_id, key, ciphertext)"""
+        key_id, key = self.get_own_key(group_id)
+        signature = self.signing_key.sign(_signed_data(self.own_public_key, key_id, plaintext)).signature
+        return key_id, key, bytes(SecretBox(key).encrypt(signature + plaintext))
+
+    def open(self, owner_public_key, key_id, ciphertext):
+        """
+        Decrypt a sealed payload and check its owner's signature
+
+        Returns:
+            tuple: (group_id, plaintext), or None if we lack the sender key or the owner's verify key
+
+        Raises:
+            nacl.exceptions.CryptoError: if the payload was altered or not signed by its owner
+        """
+        entry = self.lookup(owner_public_key, key_id)
+        verify_key = self.get_verify_key(owner_public_key)
+        if not entry or not verify_key:
+            return None
+
+        signed = SecretBox(entry['key']).decrypt(ciphertext)
+        signature, plaintext = signed[:SIGNATURE_SIZE], signed[SIGNATURE_SIZE:]
+        verify_key.verify(_signed_data(owner_public_key, key_id, plaintext), signature)
+        return entry['group_id'], plaintext
+
+    def can_open(self, owner_public_key, key_id):
+        return bool(self.lookup(owner_public_key, key_id) and self.get_verify_key(owner_public_key))
+
+    def key_material(self, group_id, key):
+        """Our sender key, verify key and the group id, to be boxed for one member"""
+        return key + bytes(self.signing_key.verify_key) + group_id.encode()
+
+    def add_key_material(self, owner_public_key, material):
+        """Store the output of an owner's key_material() after unboxing it with the owner's key"""
+        key = material[:SecretBox.KEY_SIZE]
+        verify_key = material[SecretBox.KEY_SIZE:SecretBox.KEY_SIZE + VERIFY_KEY_SIZE]
+        group_id = material[SecretBox.KEY_SIZE + VERIFY_KEY_SIZE:].decode()
+        self.add_verify_key(owner_public_key, verify_key)
+        return self.add_peer_key(group_id, owner_public_key, key)
+
+    def own_verify_key(self):
+        return bytes(self.signing_key.verify_key)
+
+    def add_verify_key(self, owner_public_key, verify_key):
+        """Remember the key an owner signs group messages with; only pass keys that came from the owner itself"""
+        verify_key = VerifyKey(bytes(verify_key))
+        with self.lock:
+            if self.verify_keys.get(owner_public_key) == verify_key:
+                return
+            self.verify_keys[owner_public_key] = verify_key
+
+        if self.db:
+            self.db.set_signing_key(owner_public_key, bytes(verify_key).hex())
+
+    def get_verify_key(self, owner_public_key):
+        if owner_public_key == self.own_public_key:
+            return self.signing_key.verify_key
+
+        with self.lock:
+            verify_key = self.verify_keys.get(owner_public_key)
+        if verify_key:
+            return verify_key
+
+        stored = self.db.get_signing_key(owner_public_key) if self.db else None
+        if not stored:
+            return None
+
+        verify_key = VerifyKey(bytes.fromhex(stored))
+        with self.lock:
+            self.verify_keys[owner_public_key] = verify_key
+        return verify_key
+
+    def add_peer_key(self, group_id, owner_public_key, key):
+        """Store a sender key received from another group member"""
+        key_id = wire_format.key_id(key)
+        with self.lock:
+            self.keys[(owner_public_key, key_id)] = {'group_id': group_id, 'key': key}
+
+        if self.db:
+            self.db.add_group_key(group_id, owner_public_key, key_id.hex(), key.hex())
+
+        return key_id
+
+    def lookup(self, owner_public_key, key_id):
+        """Return {'group_id', 'key'} for a sender key, or None if we never received it"""
+        with self.lock:
+            entry = self.keys.get((owner_public_key, key_id))
+        if entry:
+            return entry
+
+        stored = self.db.get_group_key(owner_public_key, key_id.hex()) if self.db else None
+        if not stored:
+            return None
+
+        entry = {'group_id': stored['group_id'], 'key': bytes.fromhex(stored['secret_key'])}
+        with self.lock:
+            self.keys[(owner_public_key, key_id)] = entry
+        return entry
+
+    def is_distributed(self, group_id, member_public_key):
+        with self.lock:
+            return (group_id, member_public_key) in self.distributed
+
+    def mark_distributed(self, group_id, member_public_key):
+        with self.lock:
+            self.distributed.add((group_id, member_public_key))
+
+    def forget_distributed(self, group_id, member_public_key):
+        with self.lock:
+            self.distributed.discard((group_id, member_public_key))
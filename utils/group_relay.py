@@ -0,0 +1,26 @@
+def plan_relay_tree(routes, fanout):
+    """
+    Arrange group members into a forwarding tree in which nobody sends to more than fanout others
+
+    The sender posts to at most fanout members and each of them forwards to the
+    members below it, so every member is reached within about log(N) / log(fanout)
+    hops while the sender uploads the message only fanout times.
+
+    Args:
+        routes: Member dicts ({'key', 'address', 'wrapped_key'}) in the order to place them
+        fanout: Maximum number of members any one node forwards to
+
+    Returns:
+        list: The sender's direct routes, each a copy of its member dict with a 'routes' list
+              of the members that member should forward to
+    """
+    if not routes:
+        return []
+
+    # Split into fanout subtrees of nearly equal size; the first member of each is its root
+    size = -(-len(routes) // fanout)
+    tree = []
+    for start in range(0, len(routes), size):
+        subtree = routes[start:start + size]
+        tree.append(dict(subtree[0], routes=plan_relay_tree(subtree[1:], fanout)))
+    return tree
@@ -0,0 +1,24 @@
+import threading
+
+
+class GroupSequencer:
+    """
+    Numbers our own messages in each group 1, 2, 3, ...
+
+    Members remember the highest number they have from each sender without a gap,
+    which is the cursor they sync from after being offline (see TorMessenger.sync_group).
+    """
+
+    def __init__(self, own_public_key, db=None):
+        self.own_public_key = own_public_key
+        self.db = db
+        self.lock = threading.Lock()
+        # group_id -> last sequence number used
+        self.last = {}
+
+    def next(self, group_id):
+        with self.lock:
+            if group_id not in self.last:
+                self.last[group_id] = self.db.get_last_group_seq(group_id, self.own_public_key) if self.db else 0
+            self.last[group_id] += 1
+            return self.last[group_id]
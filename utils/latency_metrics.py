@@ -0,0 +1,133 @@
+import time
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Bucket upper bounds in seconds: 10us growing by 20% per bucket up to about five minutes
+BUCKET_BOUNDS = [0.00001 * 1.2 ** i for i in range(95)]
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of durations; percentiles are accurate to one bucket (about 20%)"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        """Add another histogram's samples to this one"""
+        for index, bucket_count in enumerate(other.counts):
+            self.counts[index] += bucket_count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile (0-100), or None if empty"""
+        if not self.count:
+            return None
+
+        rank = q / 100.0 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                # Never report more than the slowest sample actually seen
+                bound = BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else None
+        }
+
+
+class LatencyMetrics:
+    """
+    Registry of latency histograms per delivery stage, overall and per peer
+
+    Peers are onion addresses on the send side and sender public keys on the
+    receive side. Only the most recently active max_peers peers are kept.
+    """
+
+    def __init__(self, max_peers=256):
+        self.max_peers = max_peers
+        self.lock = threading.Lock()
+        # stage -> histogram over all peers
+        self.stages = {}
+        # peer -> {stage -> histogram}
+        self.peers = OrderedDict()
+
+    def record(self, stage, seconds, peer=None):
+        """Add one duration in seconds to a stage, and to that stage for the peer if given"""
+        with self.lock:
+            self.stages.setdefault(stage, LatencyHistogram()).record(seconds)
+
+            if peer is None:
+                return
+
+            peer_stages = self.peers.get(peer)
+            if peer_stages is None:
+                peer_stages = self.peers[peer] = {}
+                while len(self.peers) > self.max_peers:
+                    self.peers.popitem(last=False)
+            else:
+                self.peers.move_to_end(peer)
+            peer_stages.setdefault(stage, LatencyHistogram()).record(seconds)
+
+    @contextmanager
+    def span(self, stage, peer=None):
+        """Time the body of a with block as one sample of a stage"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, peer)
+
+    def summary(self, stage, peer=None):
+        """count, mean, p50, p95, p99 and max for a stage, or None if nothing was recorded"""
+        with self.lock:
+            histograms = self.stages if peer is None else self.peers.get(peer, {})
+            histogram = histograms.get(stage)
+            return histogram.summary() if histogram else None
+
+    def snapshot(self, peer=None):
+        """Summaries of every stage, overall or for one peer"""
+        with self.lock:
+            histograms = self.stages if peer is None else self.peers.get(peer, {})
+            return {stage: histogram.summary() for stage, histogram in histograms.items()}
+
+    def merge(self, other):
+        """Add another registry's overall stage histograms to this one, e.g. to combine several messengers"""
+        with other.lock:
+            stages = {stage: LatencyHistogram() for stage in other.stages}
+            for stage, histogram in other.stages.items():
+                stages[stage].merge(histogram)
+
+        with self.lock:
+            for stage, histogram in stages.items():
+                self.stages.setdefault(stage, LatencyHistogram()).merge(histogram)
+
+    def get_peers(self):
+        with self.lock:
+            return list(self.peers)
+
+    def reset(self):
+        with self.lock:
+            self.stages.clear()
+            self.peers.clear()
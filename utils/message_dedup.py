@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+
+
+class MessageDeduplicator:
+    """
+    Remembers which (sender, message id) pairs were already received
+
+    Recent ids are kept in an in-memory LRU. Anything older is checked with
+    lookup(sender, message_id), normally an indexed query on the messages table,
+    so a retry still gets caught after the LRU forgot it or the app restarted.
+    """
+
+    def __init__(self, lookup=None, max_entries=10000):
+        self.lookup = lookup
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.recent = OrderedDict()
+        self.duplicates = 0
+
+    def seen(self, sender, message_id):
+        """Whether this message was received before"""
+        key = (sender, message_id)
+        with self.lock:
+            if key in self.recent:
+                self.recent.move_to_end(key)
+                self.duplicates += 1
+                return True
+
+        if self.lookup and self.lookup(sender, message_id):
+            self._remember(key)
+            with self.lock:
+                self.duplicates += 1
+            return True
+
+        return False
+
+    def check_and_add(self, sender, message_id):
+        """Record a message as received; False if it already was"""
+        if self.seen(sender, message_id):
+            return False
+
+        with self.lock:
+            # Another worker may have taken the same message in the meantime
+            if (sender, message_id) in self.recent:
+                self.duplicates += 1
+                return False
+            self._add((sender, message_id))
+        return True
+
+    def _remember(self, key):
+        with self.lock:
+            self._add(key)
+
+    def _add(self, key):
+        """Insert a key (lock must be held)"""
+        self.recent[key] = None
+        self.recent.move_to_end(key)
+        while len(self.recent) > self.max_entries:
+            self.recent.popitem(last=False)
@@ -0,0 +1,85 @@
+import os
+import time
+import threading
+
+# Message ids are ULIDs: a 48 bit millisecond timestamp and 80 random bits written as
+# 26 characters of Crockford base32. They sort by creation time as plain strings, so
+# new rows land at the end of the message_id indexes and a time range is an index
+# range scan. Ids made within the same millisecond by this process still increase.
+#
+# One recipient's copy of a message sent to several people, e.g. a group member's, is
+# the base id followed by '.' and the start of the recipient's public key.
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+TIME_LENGTH = 10
+RANDOM_LENGTH = 16
+RECIPIENT_SEPARATOR = '.'
+RECIPIENT_TAG_LENGTH = 12
+
+_RANDOM_BITS = 80
+_lock = threading.Lock()
+_last_time = 0
+_last_random = 0
+
+
+def _encode(value, length):
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, 32)
+        chars.append(ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def new_message_id(timestamp=None):
+    """Create a new time-ordered message id, for the current time unless a timestamp in seconds is given"""
+    global _last_time, _last_random
+
+    milliseconds = int((time.time() if timestamp is None else timestamp) * 1000)
+    with _lock:
+        if milliseconds <= _last_time and timestamp is None:
+            # Same millisecond (or the clock went back): count up from the previous id
+            milliseconds = _last_time
+            random_part = _last_random + 1
+            if random_part >> _RANDOM_BITS:
+                milliseconds += 1
+                random_part = int.from_bytes(os.urandom(10), 'big')
+        else:
+            random_part = int.from_bytes(os.urandom(10), 'big')
+
+        if timestamp is None:
+            _last_time, _last_random = milliseconds, random_part
+
+    return _encode(milliseconds, TIME_LENGTH) + _encode(random_part, RANDOM_LENGTH)
+
+
+def lowest_message_id(timestamp):
+    """The smallest id that can be created at a time, as a bound for range queries"""
+    return _encode(int(timestamp * 1000), TIME_LENGTH) + ALPHABET[0] * RANDOM_LENGTH
+
+
+def message_id_time(message_id):
+    """Creation time in seconds of an id from new_message_id, or None for ids in an older format"""
+    base = base_message_id(message_id)
+    if not isinstance(base, str) or len(base) != TIME_LENGTH + RANDOM_LENGTH or \
+            any(char not in ALPHABET for char in base):
+        return None
+
+    milliseconds = 0
+    for char in base[:TIME_LENGTH]:
+        milliseconds = milliseconds * 32 + ALPHABET.index(char)
+    return milliseconds / 1000
+
+
+def recipient_message_id(message_id, recipient_public_key):
+    """The id of one recipient's copy of a message sent to several people"""
+    return f"{message_id}{RECIPIENT_SEPARATOR}{recipient_public_key[:RECIPIENT_TAG_LENGTH].lower()}"
+
+
+def base_message_id(message_id):
+    """The id of the message a recipient's copy belongs to, or the id itself"""
+    if not isinstance(message_id, str):
+        return message_id
+    if message_id.startswith('grp_'):
+        # Before ULIDs group copies were grp_<uuid>_<member id>
+        return '_'.join(message_id.split('_')[:2])
+    return message_id.partition(RECIPIENT_SEPARATOR)[0]
@@ -0,0 +1,114 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from .message_ids import base_message_id
+from .receive_pipeline import call_after
+from .send_coalescer import SendCoalescer
+
+# Outgoing message statuses only move forward. Until the recipient confirms a message it
+# can go back and forth between sending, sent and the failure statuses as the outbox
+# retries it; once delivered it can only become read, and read is final.
+STATUS_RANKS = {'delivered': 1, 'read': 2}
+
+
+def status_rank(status):
+    return STATUS_RANKS.get(status, 0)
+
+
+def is_forward(current, new):
+    """Whether a message in status current may change to status new"""
+    return current != new and (current is None or status_rank(new) >= status_rank(current))
+
+
+def statuses_after(status):
+    """Statuses a message must not be in for it to change to status"""
+    return tuple(other for other, rank in STATUS_RANKS.items() if rank > status_rank(status))
+
+
+class MessageStatusTracker:
+    """
+    Forward-only status of the messages we send, reported to the UI in batches
+
+    Updates are collected for a short window and delivered on the main thread as one
+    {message_id: status} dict, so a message that goes from sending to delivered within
+    the window is reported once. Recipients' copies of a group message count as the
+    group message itself (see message_ids.py).
+    """
+
+    def __init__(self, deliver, window=0.1, max_batch=1000, max_tracked=10000, metrics=None, stage=None):
+        self.logger = logging.getLogger('TorMessenger')
+        self.deliver = deliver
+        self.max_tracked = max_tracked
+        self.metrics = metrics
+        self.stage = stage
+
+        # message_id -> latest accepted status, for the most recently updated messages
+        self.lock = threading.Lock()
+        self.statuses = OrderedDict()
+        self.batches = SendCoalescer(self._flush, window=window, max_batch=max_batch)
+
+    def _advance(self, message_id, status):
+        """Record a transition if it moves forward; call with the lock held"""
+        if not is_forward(self.statuses.get(message_id), status):
+            return False
+
+        self.statuses[message_id] = status
+        self.statuses.move_to_end(message_id)
+        while len(self.statuses) > self.max_tracked:
+            self.statuses.popitem(last=False)
+        return True
+
+    def update(self, message_id, status):
+        """Queue a status change for the UI, unless the message is already that far along"""
+        message_id = base_message_id(message_id)
+        with self.lock:
+            if not self._advance(message_id, status):
+                return False
+        self.batches.add(None, (message_id, status, time.perf_counter()))
+        return True
+
+    def observe(self, message_ids, status):
+        """Record a change the UI learns about another way, such as a batch of receipts"""
+        with self.lock:
+            for message_id in message_ids:
+                self._advance(base_message_id(message_id), status)
+
+    def status(self, message_id):
+        with self.lock:
+            return self.statuses.get(base_message_id(message_id))
+
+    def _flush(self, _, items):
+        # Later updates for a message were accepted after earlier ones, so the last one wins
+        merged = {}
+        queued = {}
+        for message_id, status, queued_at in items:
+            merged[message_id] = status
+            queued.setdefault(message_id, queued_at)
+
+        with self.lock:
+            # Skip messages that receipts have taken further in the meantime
+            statuses = {message_id: status for message_id, status in merged.items()
+                        if self.statuses.get(message_id, status) == status}
+
+        if statuses:
+            call_after(self._deliver, statuses, [queued[message_id] for message_id in statuses])
+
+    def _deliver(self, statuses, queued):
+        """Runs on the main thread"""
+        try:
+            self.deliver(statuses)
+        except Exception as e:
+            self.logger.error(f"Error delivering status updates to the UI: {e}")
+        finally:
+            if self.metrics:
+                now = time.perf_counter()
+                for queued_at in queued:
+                    self.metrics.record(self.stage, now - queued_at)
+
+    def flush_all(self):
+        self.batches.flush_all()
+
+    def close(self):
+        self.batches.close()
@@ -0,0 +1,148 @@
+import time
+import threading
+from collections import Counter, OrderedDict
+
+# Statuses after which nothing more happens to a message unless the outbox retries it
+TERMINAL_STATUSES = ('delivered', 'read', 'failed', 'error')
+
+
+class PendingMessageTracker:
+    """
+    Bounded status tracker for outgoing messages
+
+    Only metadata is kept, never the message body. Messages in a terminal status
+    are forgotten ttl seconds after reaching it, and once max_entries is exceeded
+    the oldest finished messages go first, then the oldest in-flight ones.
+    """
+
+    def __init__(self, ttl=600, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+        # message_id -> {'status', 'recipient', 'timestamp', 'updated_at', ...}
+        self.entries = {}
+        # In-flight message ids in the order they were added, for oldest_in_flight()
+        self.in_flight = OrderedDict()
+        # Finished message id -> time it finished, oldest first, for TTL eviction
+        self.finished = OrderedDict()
+        self.counts = Counter()
+
+    def add(self, message_id, recipient, status='sending'):
+        """Start tracking a message"""
+        now = time.time()
+        with self.lock:
+            self._remove(message_id)
+            self.entries[message_id] = {
+                'status': status,
+                'recipient': recipient,
+                'timestamp': now,
+                'updated_at': now,
+                'queued_at': time.perf_counter()
+            }
+            self.in_flight[message_id] = None
+            self.counts[status] += 1
+            self._evict(now)
+
+    def update(self, message_id, status, error=None, final=None):
+        """
+        Record a status change
+
+        Args:
+            final: Whether the message is done; defaults to status being in TERMINAL_STATUSES
+
+        Returns:
+            dict: a copy of the entry after the update, or None if the message isn't tracked
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(message_id)
+            if entry is None:
+                return None
+
+            self.counts[entry['status']] -= 1
+            self.counts[status] += 1
+            entry['status'] = status
+            entry['updated_at'] = now
+            if status == 'delivered':
+                entry['delivered_at'] = now
+            if error:
+                entry['error'] = error
+
+            if final is None:
+                final = status in TERMINAL_STATUSES
+
+            if final:
+                self.in_flight.pop(message_id, None)
+                self.finished.pop(message_id, None)
+                self.finished[message_id] = now
+            elif message_id in self.finished:
+                # Retried after it had failed
+                del self.finished[message_id]
+                self.in_flight[message_id] = None
+
+            result = dict(entry)
+            self._evict(now)
+            return result
+
+    def get(self, message_id):
+        with self.lock:
+            entry = self.entries.get(message_id)
+            return dict(entry) if entry else None
+
+    def status(self, message_id):
+        with self.lock:
+            entry = self.entries.get(message_id)
+            return entry['status'] if entry else None
+
+    def pop_queued_at(self, message_id):
+        """Return the perf_counter time a message was queued, only for its first send attempt"""
+        with self.lock:
+            entry = self.entries.get(message_id)
+            return entry.pop('queued_at', None) if entry else None
+
+    def counts_by_status(self):
+        """Number of tracked messages per status"""
+        with self.lock:
+            self._evict(time.time())
+            return {status: count for status, count in self.counts.items() if count}
+
+    def in_flight_count(self):
+        with self.lock:
+            return len(self.in_flight)
+
+    def oldest_in_flight(self):
+        """Return (message_id, entry) of the oldest message not yet in a terminal status, or None"""
+        with self.lock:
+            if not self.in_flight:
+                return None
+            message_id = next(iter(self.in_flight))
+            return message_id, dict(self.entries[message_id])
+
+    def _remove(self, message_id):
+        entry = self.entries.pop(message_id, None)
+        if entry:
+            self.counts[entry['status']] -= 1
+            self.in_flight.pop(message_id, None)
+            self.finished.pop(message_id, None)
+
+    def _evict(self, now):
+        """Drop expired finished messages, then the oldest ones while over the cap (lock must be held)"""
+        cutoff = now - self.ttl
+        while self.finished:
+            message_id, finished_at = next(iter(self.finished.items()))
+            if finished_at > cutoff:
+                break
+            self._remove(message_id)
+
+        while len(self.entries) > self.max_entries:
+            oldest = self.finished or self.in_flight
+            self._remove(next(iter(oldest)))
+
+    def __contains__(self, message_id):
+        with self.lock:
+            return message_id in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
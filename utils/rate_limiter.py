@@ -0,0 +1,82 @@
+import time
+import threading
+from collections import Counter, OrderedDict
+
+
+class TokenBucket:
+    """Allows rate events per second on average, with bursts of up to burst events"""
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now, count=1):
+        """Spend count tokens if they are available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < count:
+            return False
+        self.tokens -= count
+        return True
+
+    def give_back(self, count=1):
+        self.tokens = min(self.burst, self.tokens + count)
+
+
+class ReceiveRateLimiter:
+    """
+    Admission control for incoming messages: a token bucket per sender public key plus one global bucket
+
+    Checked before anything is decrypted or queued, so a flooding sender costs a
+    dictionary lookup per message. Only the max_senders most recently seen senders
+    keep a bucket; the global bucket still bounds senders that rotate keys.
+    A rate of None turns that limit off.
+    """
+
+    def __init__(self, sender_rate=20, sender_burst=100, global_rate=200, global_burst=1000, max_senders=1024):
+        self.sender_rate = sender_rate
+        self.sender_burst = sender_burst
+        self.max_senders = max_senders
+        self.lock = threading.Lock()
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+        self.senders = OrderedDict()
+        self.shed = Counter()
+
+    def rejected_by(self, sender):
+        """
+        Take a token for one message from sender
+
+        Returns:
+            str: the limit that rejects the message, 'sender' or 'global', or None if it may proceed
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = None
+            if self.sender_rate:
+                bucket = self.senders.get(sender)
+                if bucket is None:
+                    bucket = self.senders[sender] = TokenBucket(self.sender_rate, self.sender_burst, now)
+                    while len(self.senders) > self.max_senders:
+                        self.senders.popitem(last=False)
+                else:
+                    self.senders.move_to_end(sender)
+
+                if not bucket.take(now):
+                    self.shed['sender'] += 1
+                    return 'sender'
+
+            if self.global_bucket and not self.global_bucket.take(now):
+                if bucket:
+                    # Don't charge the sender for a message we didn't take
+                    bucket.give_back()
+                self.shed['global'] += 1
+                return 'global'
+
+            return None
+
+    def get_shed_counts(self):
+        """Messages rejected so far, by the limit they hit"""
+        with self.lock:
+            return dict(self.shed)
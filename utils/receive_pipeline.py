@@ -0,0 +1,149 @@
+import time
+import queue
+import logging
+import threading
+
+try:
+    import wx
+except ImportError:
+    # Headless use such as tools/load_generator.py
+    wx = None
+
+
+def call_after(callback, *args):
+    """Run a callback on the wx main thread, or right away on this thread when there is no wx app"""
+    if wx and wx.GetApp():
+        wx.CallAfter(callback, *args)
+    else:
+        callback(*args)
+
+
+class ReceivePipeline:
+    """
+    Bounded queue between the HTTP handlers and a small pool of decrypt workers
+
+    Handlers only validate and submit, so a request is acknowledged as soon as the
+    message is queued. When the queue is full submit() returns False and the handler
+    answers 503, letting the sender's outbox retry later.
+    """
+
+    def __init__(self, process, workers=2, max_queue=1000):
+        self.logger = logging.getLogger('TorMessenger')
+        self.process = process
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.accepted = 0
+        self.rejected = 0
+        self.threads = []
+
+        for index in range(workers):
+            thread = threading.Thread(target=self._worker, name=f"receive-worker-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, item):
+        """Queue an accepted message for decryption; False if the queue is full"""
+        try:
+            self.queue.put_nowait((time.perf_counter(), item))
+        except queue.Full:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    def _worker(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+
+            queued_at, item = entry
+            try:
+                self.process(item, queued_at)
+            except Exception as e:
+                self.logger.error(f"Error processing received message: {e}")
+
+    def get_stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'accepted': self.accepted,
+            'rejected': self.rejected
+        }
+
+    def close(self):
+        """Let the workers finish what is already queued, then stop them"""
+        for _ in self.threads:
+            self.queue.put(None)
+
+
+class UIDispatcher:
+    """
+    Hand items to the wx main thread in batches, at most once per frame
+
+    Items put() from any thread are collected and delivered with a single
+    wx.CallAfter (see call_after). A new batch is only posted once the previous one has run, so a
+    busy UI receives fewer, larger batches instead of a growing backlog of callbacks.
+    """
+
+    def __init__(self, deliver, frame_interval=1 / 60, max_batch=500, metrics=None, stage=None):
+        self.logger = logging.getLogger('TorMessenger')
+        self.deliver = deliver
+        self.frame_interval = frame_interval
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self.stage = stage
+
+        self.condition = threading.Condition()
+        self.items = []
+        self.delivering = False
+        self.last_flush = 0.0
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, item, peer=None):
+        with self.condition:
+            self.items.append((time.perf_counter(), item, peer))
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.items or self.delivering):
+                    self.condition.wait()
+                if not self.running:
+                    return
+
+            # Wait for the next frame so everything arriving until then shares one callback
+            delay = self.last_flush + self.frame_interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.condition:
+                batch = self.items[:self.max_batch]
+                del self.items[:self.max_batch]
+                self.delivering = True
+                self.last_flush = time.perf_counter()
+
+            call_after(self._deliver, batch)
+
+    def _deliver(self, batch):
+        """Runs on the main thread"""
+        try:
+            self.deliver([item for _, item, _ in batch])
+        except Exception as e:
+            self.logger.error(f"Error delivering messages to the UI: {e}")
+        finally:
+            if self.metrics:
+                now = time.perf_counter()
+                for queued_at, _, peer in batch:
+                    self.metrics.record(self.stage, now - queued_at, peer)
+
+            with self.condition:
+                self.delivering = False
+                self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,82 @@
+import time
+import logging
+import threading
+
+
+class SendCoalescer:
+    """Collect outgoing messages per peer for a short window and flush them as one batch"""
+
+    def __init__(self, flush_callback, window=0.05, max_batch=32):
+        self.logger = logging.getLogger('TorMessenger')
+        self.flush_callback = flush_callback
+        self.window = window
+        self.max_batch = max_batch
+
+        # peer -> {'deadline': float, 'items': list}
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add(self, peer, item):
+        """Queue an item for a peer; it is flushed when the window closes or the batch is full"""
+        full_batch = None
+
+        with self.condition:
+            entry = self.pending.get(peer)
+            if entry is None:
+                entry = {'deadline': time.time() + self.window, 'items': []}
+                self.pending[peer] = entry
+                self.condition.notify()
+
+            entry['items'].append(item)
+            if len(entry['items']) >= self.max_batch:
+                full_batch = self.pending.pop(peer)['items']
+
+        if full_batch:
+            self._flush(peer, full_batch)
+
+    def _run(self):
+        while True:
+            due = []
+            with self.condition:
+                if not self.running:
+                    return
+
+                now = time.time()
+                for peer, entry in list(self.pending.items()):
+                    if entry['deadline'] <= now:
+                        due.append((peer, self.pending.pop(peer)['items']))
+
+                if not due:
+                    if self.pending:
+                        timeout = min(entry['deadline'] for entry in self.pending.values()) - now
+                    else:
+                        timeout = None
+                    self.condition.wait(timeout)
+                    continue
+
+            for peer, items in due:
+                self._flush(peer, items)
+
+    def _flush(self, peer, items):
+        try:
+            self.flush_callback(peer, items)
+        except Exception as e:
+            self.logger.error(f"Error flushing messages for {peer}: {e}")
+
+    def flush_all(self):
+        """Flush everything that is still waiting, regardless of its window"""
+        with self.condition:
+            pending = [(peer, entry['items']) for peer, entry in self.pending.items()]
+            self.pending.clear()
+
+        for peer, items in pending:
+            self._flush(peer, items)
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -0,0 +1,163 @@
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+
+
+class SendScheduler:
+    """
+    Worker pool for outgoing sends that caps in-flight work per peer
+
+    Tasks are queued per peer and picked round-robin, so a slow or dead onion
+    address can occupy at most per_peer_limit workers (one once it starts failing)
+    while every other peer keeps being served. The pool grows while all workers
+    are busy and sends are slow (average duration above grow_latency), and
+    shrinks back to min_workers after idle_timeout. Latency and failure counts are
+    only kept for the max_peers most recently active peers.
+    """
+
+    def __init__(self, min_workers=2, max_workers=32, per_peer_limit=2, idle_timeout=30, grow_latency=0.25,
+                 max_peers=1024):
+        self.logger = logging.getLogger('TorMessenger')
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.per_peer_limit = per_peer_limit
+        self.idle_timeout = idle_timeout
+        self.grow_latency = grow_latency
+        self.max_peers = max_peers
+
+        self.condition = threading.Condition()
+        self.queues = {}        # peer -> deque of (fn, args)
+        self.ready = deque()    # peers with queued tasks, in round-robin order
+        self.in_flight = {}     # peer -> running task count
+        self.failures = {}      # peer -> consecutive failed sends
+        self.latency = OrderedDict()  # peer -> moving average of task duration in seconds, most recent last
+        self.avg_latency = None  # moving average over all peers
+        self.workers = 0
+        self.idle_workers = 0
+        self.running = True
+
+    def submit(self, peer, fn, *args):
+        """Queue fn(*args) to run for a peer; fn returns False if the peer was unreachable"""
+        with self.condition:
+            if not self.running:
+                raise RuntimeError("SendScheduler has been shut down")
+
+            queue = self.queues.setdefault(peer, deque())
+            if not queue:
+                self.ready.append(peer)
+            queue.append((fn, args))
+
+            if self.idle_workers:
+                self.condition.notify()
+            elif self.workers < self.min_workers:
+                self._spawn_worker()
+            elif self.workers < self.max_workers and (self.avg_latency is None
+                                                      or self.avg_latency >= self.grow_latency):
+                # Every worker is busy waiting on slow Tor connections; fast sends drain the
+                # queue quickly enough without extra threads
+                self._spawn_worker()
+
+    def _spawn_worker(self):
+        self.workers += 1
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def _peer_limit(self, peer):
+        # A peer that keeps failing gets a single slot until it answers again
+        return 1 if self.failures.get(peer) else self.per_peer_limit
+
+    def _next_task(self):
+        """Pop the next task of the first peer that still has a free slot (lock must be held)"""
+        for _ in range(len(self.ready)):
+            peer = self.ready.popleft()
+            if self.in_flight.get(peer, 0) >= self._peer_limit(peer):
+                self.ready.append(peer)
+                continue
+
+            queue = self.queues[peer]
+            fn, args = queue.popleft()
+            if queue:
+                self.ready.append(peer)
+            else:
+                del self.queues[peer]
+
+            self.in_flight[peer] = self.in_flight.get(peer, 0) + 1
+            return peer, fn, args
+
+        return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                task = self._next_task()
+                while task is None:
+                    if not self.running:
+                        self.workers -= 1
+                        return
+
+                    self.idle_workers += 1
+                    notified = self.condition.wait(self.idle_timeout)
+                    self.idle_workers -= 1
+
+                    task = self._next_task()
+                    if task is None and not notified and self.workers > self.min_workers:
+                        self.workers -= 1
+                        return
+
+            peer, fn, args = task
+            started = time.time()
+            success = False
+            try:
+                success = fn(*args) is not False
+            except Exception as e:
+                self.logger.error(f"Error in send task for {peer}: {e}")
+            finally:
+                self._task_done(peer, time.time() - started, success)
+
+    def _task_done(self, peer, duration, success):
+        with self.condition:
+            self.in_flight[peer] -= 1
+            if not self.in_flight[peer]:
+                del self.in_flight[peer]
+
+            previous = self.latency.get(peer)
+            self.latency[peer] = duration if previous is None else 0.8 * previous + 0.2 * duration
+            self.latency.move_to_end(peer)
+            while len(self.latency) > self.max_peers:
+                # Every peer with a failure count has latency too, so this bounds both
+                idle_peer, _ = self.latency.popitem(last=False)
+                self.failures.pop(idle_peer, None)
+            if self.avg_latency is None:
+                self.avg_latency = duration
+            else:
+                self.avg_latency = 0.9 * self.avg_latency + 0.1 * duration
+
+            if success:
+                self.failures.pop(peer, None)
+            else:
+                self.failures[peer] = self.failures.get(peer, 0) + 1
+
+            # A slot opened up, which may make a waiting peer runnable
+            if self.ready and self.idle_workers:
+                self.condition.notify()
+
+    def get_stats(self):
+        """Snapshot of pool size, queued work and per-peer health"""
+        with self.condition:
+            return {
+                'workers': self.workers,
+                'idle_workers': self.idle_workers,
+                'avg_latency': self.avg_latency,
+                'queued': sum(len(queue) for queue in self.queues.values()),
+                'in_flight': dict(self.in_flight),
+                'failing_peers': dict(self.failures),
+                'latency': dict(self.latency)
+            }
+
+    def shutdown(self):
+        """Stop accepting tasks; idle workers exit and queued tasks are dropped"""
+        with self.condition:
+            self.running = False
+            self.queues.clear()
+            self.ready.clear()
+            self.condition.notify_all()
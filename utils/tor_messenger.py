@@ -4,46 +4,221 @@ import json
 import time
 import requests
 import threading
-import concurrent.futures
-from flask import Flask, request, jsonify
-from nacl.public import PrivateKey, PublicKey, Box
+from flask import Flask, Response, request, jsonify
+from nacl.public import PrivateKey
+from nacl.signing import SigningKey
 from nacl.encoding import HexEncoder
-import wx
+from nacl.exceptions import CryptoError
 import logging
 import base64
-import uuid
+import random
+from collections import OrderedDict, deque
+
+from .box_cache import BoxCache, SenderKeyIndex
+from .connection_pool import ConnectionPool
+from .group_keys import GroupKeyStore
+from .send_coalescer import SendCoalescer
+from .send_scheduler import SendScheduler
+from .async_engine import AsyncSendEngine
+from .latency_metrics import LatencyMetrics
+from .pending_tracker import PendingMessageTracker
+from .receive_pipeline import ReceivePipeline, UIDispatcher, call_after
+from .circuit_prewarmer import CircuitPrewarmer
+from .message_dedup import MessageDeduplicator
+from .rate_limiter import ReceiveRateLimiter
+from .group_relay import plan_relay_tree
+from .group_sync import GroupSequencer
+from .message_ids import new_message_id, recipient_message_id
+from .message_status import MessageStatusTracker
+from . import attachment_store
+from . import compression
+from . import wire_format
 
 
 class TorMessenger:
-    def __init__(self, user_id, message_callback=None, socks_port=5000, tor_port=9050, tor_binary=None):
+    # Capabilities advertised to peers in the features header of every response
+    SUPPORTED_FEATURES = ('envelope', 'batch', 'signed_group', 'message_id', 'receipts', 'reply_to', 'relay',
+                          'sync') + compression.FEATURES
+
+    # Upper bound on the body of a single /receive_batch request
+    MAX_BATCH_BYTES = 4 * 1024 * 1024
+    # How often waitress closes keep-alive connections idle for longer than keepalive_timeout
+    SERVER_CLEANUP_INTERVAL = 10
+
+    # Statuses after which the outbox schedules another attempt
+    RETRYABLE_STATUSES = ('timeout', 'connection_error')
+
+    # How long an outbox entry is left alone while an attempt is in flight
+    OUTBOX_IN_FLIGHT_GRACE = 120
+    OUTBOX_POLL_INTERVAL = 5
+    # Sends held until Tor is up; past this the oldest are dropped, persisted ones are retried from the outbox
+    MAX_WAITING_FOR_TRANSPORT = 1000
+
+    # Pre-warmed peers are pinged again once their connection has been idle this long
+    PREWARM_REFRESH = 120
+
+    # Delivery and read receipts for one peer are collected this long and sent as one message
+    RECEIPT_WINDOW = 2
+    MAX_RECEIPTS_PER_MESSAGE = 500
+    # Reply addresses remembered for senders that aren't in our contacts
+    MAX_REPLY_ADDRESSES = 4096
+
+    # Group history sync: envelopes per /group_sync page, and how often one group is synced at most
+    SYNC_PAGE_SIZE = 100
+    SYNC_MIN_INTERVAL = 60
+
+    def __init__(self, user_id, message_callback=None, socks_port=5000, tor_port=9050, tor_binary=None,
+                 server_threads=8, max_request_size=32 * 1024 * 1024, keepalive_timeout=300,
+                 batch_window=0.05, db=None, retry_deadline=24 * 3600, retry_base_delay=5, retry_max_delay=600,
+                 media_dir=None, message_batch_callback=None, receive_workers=2, receive_queue_size=1000,
+                 prewarm_peers=8, send_engine='threads', transport='tor', sender_rate_limit=(20, 100),
+                 global_rate_limit=(200, 1000), group_relay_fanout=0, status_window=0.1, tor_control_port=None,
+                 tor_control_password=None):
         self.status_update_callback = None
+        self.status_batch_callback = None
+        self.receipt_callback = None
+        self.tor_status_callback = None
         self.public_key = None
         self.private_key = None
         self.user_id = user_id
         self.message_callback = message_callback
+        self.message_batch_callback = message_batch_callback
         self.logger = logging.getLogger('TorMessenger')
         self.TOR_PORT = tor_port
         self.tor_available = True
         self.socks_port = socks_port
         self.keys_file = f"{user_id}_keys.json"
-        self.pending_messages = {}
-        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+        self.pending_messages = PendingMessageTracker()
+        self.metrics = LatencyMetrics()
+        self.scheduler = SendScheduler()
+        # 'loopback' skips Tor entirely and talks plain HTTP to peers on this machine, for tests and benchmarks
+        self.transport = transport
+        proxy_port = None if transport == 'loopback' else tor_port
+        self.connection_pool = ConnectionPool(proxy_port=proxy_port, idle_timeout=keepalive_timeout)
+
+        # Messages are sent from scheduler worker threads, or all from one event loop with
+        # send_engine='asyncio'; send_pool is whichever connection pool they go through
+        self.async_engine = None
+        if send_engine == 'asyncio':
+            try:
+                self.async_engine = AsyncSendEngine(proxy_port=proxy_port, idle_timeout=keepalive_timeout)
+            except ImportError as e:
+                self.logger.warning(f"{e}, sending from worker threads instead")
+        self.send_pool = self.async_engine or self.connection_pool
+        self.box_cache = None
+        self.group_keys = None
+        self.group_seq = None
+        self.last_group_sync = {}
+        self.sync_lock = threading.Lock()
+        self.attachment_store = None
+        self.media_dir = media_dir
+        self.coalescer = SendCoalescer(self._flush_peer_messages, window=batch_window)
+        self.receipts = SendCoalescer(self._flush_receipts, window=self.RECEIPT_WINDOW,
+                                      max_batch=self.MAX_RECEIPTS_PER_MESSAGE)
+
+        # Durable outbox: failed sends are retried with backoff until retry_deadline
+        self.db = db
+        self.retry_deadline = retry_deadline
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.outbox_stop_event = threading.Event()
+        self.outbox_thread = None
+
+        # Circuit pre-warming for the most active contacts and freshly opened chats
+        self.prewarmer = None
+        self.warming = set()
+        self.warming_lock = threading.Lock()
+
+        # Wire format negotiation: features each peer advertised, peers that already
+        # have our full public key, and key ids of senders we can resolve locally
+        self.peer_features = {}
+        self.peers_knowing_key = set()
+        self.known_sender_keys = SenderKeyIndex(wire_format.key_id)
+        # Sender public key -> address it asked receipts to go to, most recently used last
+        self.reply_addresses = OrderedDict()
+        self.reply_addresses_lock = threading.Lock()
+
+        # Group messages to more members than this are forwarded along a relay tree
+        # (see group_relay.py) instead of being posted to every member by us; 0 turns it off
+        self.group_relay_fanout = group_relay_fanout
+
+        # Receive side: handlers only validate and enqueue, workers decrypt and classify,
+        # and the dispatcher hands messages to the UI once per frame
+        self.receive_pipeline = ReceivePipeline(self._process_received, receive_workers, receive_queue_size)
+        self.ui_dispatcher = UIDispatcher(self._deliver_to_ui, metrics=self.metrics, stage='receive_callback')
+
+        # Status changes of sent messages only move forward and reach the UI in batches
+        self.message_statuses = MessageStatusTracker(self._deliver_statuses, window=status_window,
+                                                     metrics=self.metrics, stage='status_callback')
+
+        # Senders retry after timeouts, so each message id is only accepted once per sender
+        self.deduplicator = MessageDeduplicator(db.has_received_message if db else None)
+
+        # Admission control: (messages per second, burst) per sender public key and for
+        # everyone together, checked before decryption; None turns a limit off
+        sender_rate, sender_burst = sender_rate_limit or (None, None)
+        global_rate, global_burst = global_rate_limit or (None, None)
+        self.rate_limiter = ReceiveRateLimiter(sender_rate, sender_burst, global_rate, global_burst)
+
+        # Receive server settings
+        self.server = None
+        self.server_threads = server_threads
+        self.max_request_size = max_request_size
+        self.keepalive_timeout = keepalive_timeout
+
+        # Sends wait here until Tor has published our onion service; history, the receive
+        # server and the outbox are usable right away
+        self.transport_ready = threading.Event()
+        self.transport_lock = threading.Lock()
+        self.waiting_for_transport = deque()
+        # Outbox entries queued before Tor was up; their in-flight grace starts once it is
+        self.queued_before_transport = []
+        self.tor_status = {'state': 'starting', 'progress': 0, 'summary': 'Starting Tor'}
 
         try:
-            # Initialize Tor Service
-            from . import TorService
-            self.tor_service = TorService(socks_port=socks_port, tor_binary=tor_binary)
-            self.onion_address = self.tor_service.start()
-            self.logger.info(f"Tor service initialized with address: {self.onion_address}")
+            if transport == 'loopback':
+                # Peers reach us directly on the receive port
+                self.tor_service = None
+                self.onion_address = f"127.0.0.1:{socks_port}"
+                self.logger.info(f"Loopback transport listening on {self.onion_address}")
+                self._on_tor_ready(self.onion_address)
+            else:
+                # Bootstrap Tor in the background; progress is reported through the tor status callback.
+                # With a control port we publish on that already running Tor instead of starting our own
+                from . import TorService
+                if tor_control_port:
+                    self.tor_service = TorService(socks_port=socks_port, control_port=tor_control_port,
+                                                  use_existing_tor=True, control_password=tor_control_password,
+                                                  key_file=f"{user_id}_onion_key", local_port=socks_port,
+                                                  user_hidden_service_dir=f"{user_id}_hidden_service")
+                else:
+                    self.tor_service = TorService(socks_port=socks_port, tor_binary=tor_binary, local_port=socks_port,
+                                                  user_hidden_service_dir=f"{user_id}_hidden_service")
+                self.onion_address = None
+                self.tor_service.start_in_background(self._on_tor_progress, self._on_tor_ready, self._on_tor_error)
 
             # Load or generate encryption keys
             self.load_or_generate_keys()
+            self.box_cache = BoxCache(self.private_key)
+            self.group_keys = GroupKeyStore(self.public_key.encode(HexEncoder).decode(), db, self.signing_key)
+            self.group_seq = GroupSequencer(self.public_key.encode(HexEncoder).decode(), db)
+            if media_dir:
+                self.attachment_store = attachment_store.AttachmentStore(media_dir)
             self.logger.info(f"Public Key (Hex): {self.public_key.encode(HexEncoder).decode()}")
 
             # Start message server
             self.server_thread = threading.Thread(target=self.start_message_server, daemon=True)
             self.server_thread.start()
 
+            # Resume delivery of anything left in the outbox by a previous run
+            if self.db:
+                self.outbox_thread = threading.Thread(target=self._outbox_loop, daemon=True)
+                self.outbox_thread.start()
+
+            # Keep circuits open to the contacts we talk to most
+            if self.db and prewarm_peers:
+                self.prewarmer = CircuitPrewarmer(self.prewarm, self.db.get_active_contacts, prewarm_peers)
+
             self.logger.info("TorMessenger initialization complete")
 
         except Exception as e:
@@ -64,12 +239,20 @@ class TorMessenger:
                 self.private_key = PrivateKey(private_key_bytes)
                 self.public_key = self.private_key.public_key
 
+                # Group messages are signed with a separate Ed25519 key; older key files don't have one yet
+                if keys_data.get('signing_key'):
+                    self.signing_key = SigningKey(base64.b64decode(keys_data['signing_key']))
+                else:
+                    self.signing_key = SigningKey.generate()
+                    self.save_keys()
+
                 self.logger.info("Keys loaded successfully")
             else:
                 self.logger.info("Generating new keys")
                 # Generate new keys
                 self.private_key = PrivateKey.generate()
                 self.public_key = self.private_key.public_key
+                self.signing_key = SigningKey.generate()
 
                 # Save the keys
                 self.save_keys()
@@ -78,6 +261,7 @@ class TorMessenger:
             # If loading fails, generate new keys
             self.private_key = PrivateKey.generate()
             self.public_key = self.private_key.public_key
+            self.signing_key = SigningKey.generate()
             self.save_keys()
 
     def save_keys(self):
@@ -90,6 +274,7 @@ class TorMessenger:
             # Create JSON structure
             keys_data = {
                 'private_key': private_key_b64,
+                'signing_key': base64.b64encode(bytes(self.signing_key)).decode('ascii'),
                 'public_key': self.public_key.encode(HexEncoder).decode(),
                 'generated_at': time.strftime('%Y-%m-%d %H:%M:%S')
             }
@@ -107,100 +292,660 @@ class TorMessenger:
         self.logger.info(f"Setting status update callback: {callback}")
         self.status_update_callback = callback
 
+    def set_status_batch_callback(self, callback):
+        """
+        Set callback({message_id: status}) for batches of message status changes
+
+        Takes the place of the status update callback, which is otherwise called once per message.
+        """
+        self.status_batch_callback = callback
+
+    def set_receipt_callback(self, callback):
+        """
+        Set callback(sender_public_key, status, message_ids) for batches of delivery or read receipts
+
+        Without one, receipts are reported through the status update callback one message at a time.
+        """
+        self.receipt_callback = callback
+
+    def set_tor_status_callback(self, callback):
+        """
+        Set callback(status) for Tor bootstrap progress, see get_tor_status
+
+        Called on the main thread, once right away with the current status.
+        """
+        self.tor_status_callback = callback
+        if callback:
+            call_after(callback, self.get_tor_status())
+
+    def get_tor_status(self):
+        """
+        Where Tor is in starting up
+
+        Returns:
+            dict: state ('starting', 'bootstrapping', 'ready' or 'failed'), progress in percent and a summary
+        """
+        return dict(self.tor_status)
+
+    def _set_tor_status(self, state, progress, summary):
+        self.tor_status = {'state': state, 'progress': progress, 'summary': summary}
+        if self.tor_status_callback:
+            call_after(self.tor_status_callback, self.get_tor_status())
+
+    def _on_tor_progress(self, progress, summary):
+        # Known before publication when the hidden service directory already exists
+        self.onion_address = self.onion_address or self.tor_service.get_onion_address()
+        self._set_tor_status('bootstrapping', progress, summary)
+
+    def _on_tor_ready(self, onion_address):
+        """Our onion service is published: send everything that waited for it"""
+        self.onion_address = onion_address
+        self.logger.info(f"Ready to send, reachable at: {self.onion_address}")
+
+        with self.transport_lock:
+            if self.queued_before_transport:
+                # The sends below are their first attempt, so the outbox loop must not retry them right away
+                try:
+                    self.db.reschedule_outbox_messages(self.queued_before_transport,
+                                                       time.time() + self.OUTBOX_IN_FLIGHT_GRACE)
+                except Exception as e:
+                    self.logger.error(f"Error updating outbox after Tor started: {e}")
+                self.queued_before_transport = []
+            self.transport_ready.set()
+            waiting, self.waiting_for_transport = self.waiting_for_transport, deque()
+        for submit, args in waiting:
+            try:
+                submit(*args)
+            except Exception as e:
+                self.logger.error(f"Error starting a send that waited for Tor: {e}")
+
+        self._set_tor_status('ready', 100, 'Connected')
+
+    def _on_tor_error(self, error):
+        self.logger.error(f"Error starting Tor: {error}")
+        self.tor_available = False
+        self._set_tor_status('failed', self.tor_status['progress'], str(error))
+
+    def retry_tor(self):
+        """
+        Start Tor again after it failed to start; everything waiting for it is sent once it is up
+
+        Returns:
+            bool: True if Tor is being started again
+        """
+        if not self.tor_service or self.tor_status['state'] != 'failed':
+            return False
+        self.logger.info("Starting Tor again")
+        self.tor_available = True
+        self._set_tor_status('starting', 0, 'Starting Tor')
+        self.tor_service.start_in_background(self._on_tor_progress, self._on_tor_ready, self._on_tor_error)
+        return True
+
+    def _when_transport_ready(self, submit, *args):
+        """Call submit(*args) now, or once Tor has published our onion service"""
+        with self.transport_lock:
+            if not self.transport_ready.is_set():
+                self.waiting_for_transport.append((submit, args))
+                if len(self.waiting_for_transport) > self.MAX_WAITING_FOR_TRANSPORT:
+                    self.waiting_for_transport.popleft()
+                    self.logger.warning("Too many sends waiting for Tor, dropped the oldest; "
+                                        "messages in the outbox are retried from there")
+                return
+        submit(*args)
+
     def get_connection_info(self):
         """Get connection information for sharing"""
         return {
-            'onion_address': self.onion_address,
+            'onion_address': self.onion_address or '',
             'public_key': self.public_key.encode(HexEncoder).decode(),
             'user_id': self.user_id
         }
 
-    def start_message_server(self):
-        """Start the Flask server to receive messages"""
+    def _create_app(self):
+        """Create the Flask app with the receive endpoints"""
         app = Flask(__name__)
+        app.config['MAX_CONTENT_LENGTH'] = self.max_request_size
+
+        @app.after_request
+        def advertise_features(response):
+            # Lets senders know they can use the binary envelope with us
+            response.headers[wire_format.FEATURES_HEADER] = ','.join(self.SUPPORTED_FEATURES)
+            return response
+
+        @app.route("/ping", methods=["GET"])
+        def ping():
+            # Lets peers build a circuit and keep-alive connection to us before they need one
+            return jsonify({"status": "success"}), 200
 
         @app.route("/receive", methods=["POST"])
         def receive():
+            if request.mimetype == wire_format.CONTENT_TYPE:
+                result, status_code = self._accept_envelope(
+                    request.get_data(), request.headers.get(wire_format.MESSAGE_ID_HEADER),
+                    reply_address=request.headers.get(wire_format.REPLY_TO_HEADER))
+                return jsonify(result), status_code
+
             try:
+                # Legacy JSON body with hex encoded ciphertext
                 data = request.get_json()
                 sender_public_key = data["sender_public_key"]
                 encrypted_message = data["encrypted_message"]
-                sender_id = data["sender_public_key"]
+                message_id = data.get("message_id")
+                bytes.fromhex(sender_public_key)
+                bytes.fromhex(encrypted_message)
 
-                decrypted_message = self.decrypt_message(encrypted_message, sender_public_key)
+                if self.rate_limiter.rejected_by(sender_public_key):
+                    return jsonify({"status": "error", "message": "rate_limited"}), 429
 
-                # Try to parse as JSON to check for special message types
-                try:
-                    # Try to parse the message as JSON to check for group message
-                    message_data = json.loads(decrypted_message)
-                    if isinstance(message_data, dict):
-                        # Check for group invitation
-                        if message_data.get('type') == 'group_invitation':
-                            # Notify the UI
-                            if self.message_callback:
-                                wx.CallAfter(self.message_callback, {
-                                    'sender_id': sender_id,
-                                    'sender_public_key': sender_public_key,
-                                    'is_group_invitation': True,
-                                    'group_id': message_data.get('group_id'),
-                                    'group_name': message_data.get('group_name'),
-                                    'group_description': message_data.get('group_description', ''),
-                                    'created_by': message_data.get('created_by'),
-                                    'members': message_data.get('members', []),
-                                    'avatar_path': message_data.get('avatar_path', ''),
-                                    'timestamp': message_data.get('timestamp', time.time())
-                                })
-
-                                return jsonify({"status": "success"}), 200
-
-                        # Check for group message
-                        elif message_data.get('type') == 'group_message':
-                            is_group_message = True
-                            group_id = message_data.get('group_id')
-                            actual_message = message_data.get('content')
-                            # Use the actual message content for group messages
-                            decrypted_message = actual_message
-
-                            # Notify the UI if a callback is set
-                            if self.message_callback:
-                                message_data = {
-                                    'sender_id': sender_id,
-                                    'message': decrypted_message,
-                                    'timestamp': message_data.get('timestamp', time.time()),
-                                    'sender_public_key': sender_public_key,
-                                    'is_group_message': True,
-                                    'group_id': group_id
-                                }
-
-                                wx.CallAfter(self.message_callback, message_data)
-
-                            return jsonify({"status": "success"}), 200
-                except json.JSONDecodeError:
-                    # Not a JSON message, treat as regular message
-                    pass
-
-                # Regular direct message handling
-                if self.message_callback:
-                    message_data = {
-                        'sender_id': sender_id,
-                        'message': decrypted_message,
-                        'timestamp': time.time(),
-                        'sender_public_key': sender_public_key
-                    }
-
-                    wx.CallAfter(self.message_callback, message_data)
+                if message_id and self.deduplicator.seen(sender_public_key, message_id):
+                    return jsonify({"status": "success"}), 200
 
+                item = ('legacy', sender_public_key, encrypted_message, message_id, None)
+                if not self.receive_pipeline.submit(item):
+                    return jsonify({"status": "error", "message": "busy"}), 503
                 return jsonify({"status": "success"}), 200
 
             except Exception as e:
                 self.logger.error(f"Error receiving message: {e}")
                 return jsonify({"status": "error", "message": str(e)}), 400
 
+        @app.route("/receive_batch", methods=["POST"])
+        def receive_batch():
+            try:
+                envelopes = wire_format.decode_batch(request.get_data())
+            except wire_format.EnvelopeError as e:
+                self.logger.error(f"Error receiving batch: {e}")
+                return jsonify({"status": "error", "message": str(e)}), 400
+
+            # One result per envelope, in the order they were sent
+            reply_address = request.headers.get(wire_format.REPLY_TO_HEADER)
+            results = [self._accept_envelope(envelope, reply_address=reply_address)[0] for envelope in envelopes]
+            return jsonify({"status": "success", "results": results}), 200
+
+        @app.route("/group_relay", methods=["POST"])
+        def group_relay():
+            result, status_code = self._accept_relay(request.get_data())
+            return jsonify(result), status_code
+
+        @app.route("/group_sync", methods=["POST"])
+        def group_sync():
+            result, status_code = self._serve_group_sync(request.get_data())
+            if status_code != 200:
+                return jsonify(result), status_code
+            return Response(result, status=200, mimetype=wire_format.CONTENT_TYPE)
+
+        @app.route("/attachment/offer", methods=["POST"])
+        def attachment_offer():
+            result, status_code = self._receive_attachment(request.get_data(), self._accept_attachment_offer)
+            return jsonify(result), status_code
+
+        @app.route("/attachment/chunk", methods=["POST"])
+        def attachment_chunk():
+            result, status_code = self._receive_attachment(request.get_data(), self._accept_attachment_chunk)
+            return jsonify(result), status_code
+
+        return app
+
+    def _accept_envelope(self, data, message_id=None, rate_limit=True, reply_address=None):
+        """
+        Validate one binary envelope and queue it for decryption, returning the result body and HTTP status
+
+        reply_address is where the sender asked receipts to go; it is only remembered once
+        the envelope decrypts, so it can't be set for someone else's key.
+        """
+        try:
+            started = time.perf_counter()
+            envelope = wire_format.decode_envelope(data)
+            sender_public_key = self._resolve_sender_key(envelope)
+            if not sender_public_key:
+                # Ask the sender to repeat the message with its full public key
+                return {"status": "error", "message": "unknown_sender_key"}, 409
+
+            if rate_limit and self.rate_limiter.rejected_by(sender_public_key):
+                # Shed before any lookup or decryption; the sender's outbox retries later
+                return {"status": "error", "message": "rate_limited"}, 429
+
+            if envelope['group_key_id'] is not None and not envelope['wrapped_key'] and \
+                    not self.group_keys.can_open(sender_public_key, envelope['group_key_id']):
+                # Ask the sender to include its group key and signing key, wrapped for us
+                return {"status": "error", "message": "unknown_group_key"}, 409
+
+            message_id = envelope['message_id'] or message_id
+            if message_id and self.deduplicator.seen(sender_public_key, message_id):
+                # A retry of something we already have; acknowledge it so the sender stops, and
+                # confirm it again in case our earlier receipt was lost
+                if envelope['group_key_id'] is None:
+                    self.receipts.add(sender_public_key, ('delivered', message_id))
+                return {"status": "success"}, 200
+
+            item = ('envelope', sender_public_key, envelope, message_id, reply_address)
+            if not self.receive_pipeline.submit(item):
+                # Decrypt workers are behind; the sender retries later
+                return {"status": "error", "message": "busy"}, 503
+
+            self.metrics.record('receive_accept', time.perf_counter() - started, sender_public_key)
+            return {"status": "success"}, 200
+
+        except Exception as e:
+            self.logger.error(f"Error receiving message: {e}")
+            return {"status": "error", "message": str(e)}, 400
+
+    def _accept_relay(self, data):
+        """
+        Accept a group message a member relayed to us, queue our copy and forward it down our subtree
+
+        Only forwards between members of the group in our own group_members table, so a
+        relay can't be used to send to arbitrary addresses. Members we don't know are
+        returned as 'rejected' and the member that relayed to us sends to them itself.
+        """
+        try:
+            envelope = wire_format.decode_envelope(data)
+            relayer_public_key = self._resolve_sender_key(envelope)
+            if not relayer_public_key:
+                return {"status": "error", "message": "unknown_sender_key"}, 409
+
+            if self.rate_limiter.rejected_by(relayer_public_key):
+                return {"status": "error", "message": "rate_limited"}, 429
+
+            plaintext = self.decrypt_bytes(envelope['ciphertext'], relayer_public_key)
+            header, group_envelope = wire_format.decode_relay(plaintext)
+            header = json.loads(header)
+            inner = wire_format.decode_envelope(group_envelope)
+            if inner['group_key_id'] is None or inner['sender_public_key'] is None:
+                return {"status": "error", "message": "not_a_group_envelope"}, 400
+
+            members = self._group_member_addresses(header['group_id'])
+            if members is not None and (relayer_public_key not in members or
+                                        inner['sender_public_key'].hex() not in members):
+                return {"status": "error", "message": "not_a_member"}, 403
+
+            # Our copy, with the group key wrapped for us if the sender included it
+            result, status_code = self._accept_envelope(self._encode_group_envelope(
+                inner, bytes.fromhex(header.get('wrapped_key') or '')))
+            if status_code != 200:
+                # The member that relayed to us takes over our subtree
+                return result, status_code
+
+            forward, rejected = [], []
+            for route in header.get('routes', []):
+                if members is None:
+                    forward.append(route)
+                elif route['key'].lower() in members:
+                    # Use the address we have for this member rather than the one we were given
+                    forward.append(dict(route, address=self._normalize_address(members[route['key'].lower()])))
+                else:
+                    rejected.append(route)
+
+            self._forward_relay(header['group_id'], forward, group_envelope)
+            return {"status": "success", "rejected": rejected}, 200
+
+        except Exception as e:
+            self.logger.error(f"Error receiving relayed group message: {e}")
+            return {"status": "error", "message": str(e)}, 400
+
+    def _group_member_addresses(self, group_id):
+        """Public key -> onion address of the group's members we know, or None without a database"""
+        if not self.db:
+            return None
+        return {member['public_key'].lower(): member['onion_address']
+                for member in self.db.get_group_members(group_id)
+                if member.get('public_key') and member.get('onion_address')}
+
+    def _encode_group_envelope(self, envelope, wrapped_key=b'', sender_public_key=None, message_id=None):
+        """Re-encode a decoded group envelope with the full sender key and the group key wrapped for one member"""
+        return wire_format.encode_envelope(sender_public_key or envelope['sender_public_key'], envelope['ciphertext'],
+                                           True, envelope['group_key_id'], wrapped_key,
+                                           bool(envelope['flags'] & wire_format.FLAG_COMPRESSED),
+                                           message_id or envelope['message_id'])
+
+    def _serve_group_sync(self, data):
+        """Answer a member's /group_sync request with the next page of stored group envelopes after its cursors"""
+        if not self.db:
+            return {"status": "error", "message": "sync_unavailable"}, 404
+
+        try:
+            envelope = wire_format.decode_envelope(data)
+            requester_public_key = self._resolve_sender_key(envelope)
+            if not requester_public_key:
+                return {"status": "error", "message": "unknown_sender_key"}, 409
+
+            if self.rate_limiter.rejected_by(requester_public_key):
+                return {"status": "error", "message": "rate_limited"}, 429
+
+            query = json.loads(self.decrypt_bytes(envelope['ciphertext'], requester_public_key))
+            group_id = query['group_id']
+            if requester_public_key not in self._group_member_addresses(group_id):
+                return {"status": "error", "message": "not_a_member"}, 403
+
+            cursors = {sender_key: {'after': int(cursor['after']),
+                                    'missing': [[int(first), int(last)] for first, last in cursor.get('missing', [])[:20]]}
+                       for sender_key, cursor in query.get('cursors', {}).items()}
+            limit = max(1, min(int(query.get('limit', self.SYNC_PAGE_SIZE)), self.SYNC_PAGE_SIZE))
+            rows, more = self.db.get_group_envelopes_after(group_id, cursors, limit)
+
+            # Pass on the sender keys too, for members who joined after a sender's key was handed out
+            next_cursors = {}
+            keys = {}
+            for sender_key, seq, stored in rows:
+                next_cursors[sender_key] = seq
+                group_key_id = wire_format.decode_envelope(stored)['group_key_id']
+                if (sender_key, group_key_id) not in keys:
+                    entry = self.group_keys.lookup(sender_key, group_key_id)
+                    if entry and entry['group_id'] == group_id:
+                        keys[(sender_key, group_key_id)] = entry['key'].hex()
+
+            header = json.dumps({
+                'cursors': next_cursors,
+                'more': more,
+                'keys': [{'owner': owner, 'key': key} for (owner, _), key in keys.items()],
+                # Only our own; other senders' signing keys have to come from those senders
+                'signing_key': self.group_keys.own_verify_key().hex()
+            }).encode()
+            page = wire_format.encode_sync_page(header, [bytes(stored) for _, _, stored in rows])
+            return wire_format.encode_envelope(bytes(self.public_key), self.encrypt_bytes(page, requester_public_key)), 200
+
+        except Exception as e:
+            self.logger.error(f"Error serving group sync: {e}")
+            return {"status": "error", "message": str(e)}, 400
+
+    def _process_received(self, item, queued_at):
+        """Decrypt and classify an accepted message on a receive worker"""
+        kind, sender_public_key, payload, message_id, reply_address = item
+        self.metrics.record('receive_queue', time.perf_counter() - queued_at, sender_public_key)
+
+        with self.metrics.span('receive_decrypt', sender_public_key):
+            if kind == 'legacy':
+                decrypted_message = self.decrypt_message(payload, sender_public_key)
+            elif payload['group_key_id'] is not None:
+                decrypted_message = self._open_group_envelope(payload, sender_public_key)
+            else:
+                plaintext = self.decrypt_bytes(payload['ciphertext'], sender_public_key)
+                decrypted_message = self._decompress_payload(payload, plaintext).decode()
+
+        if decrypted_message is None:
+            self.logger.error(f"Dropping group message from {sender_public_key}: group key or signing key not available")
+            return
+
+        if reply_address:
+            self._remember_reply_address(sender_public_key, reply_address)
+
+        # Only recorded once decrypted, so a forged envelope can't mark a real message id as seen
+        if message_id and not self.deduplicator.check_and_add(sender_public_key, message_id):
+            self.logger.info(f"Dropping duplicate message {message_id} from {sender_public_key}")
+            return
+
+        self._handle_incoming_message(sender_public_key, decrypted_message, message_id,
+                                      payload if kind == 'envelope' else None)
+
+    def _deliver_to_ui(self, messages):
+        """Runs on the main thread with every message received since the last frame"""
+        if self.message_batch_callback:
+            self.message_batch_callback(messages)
+            return
+
+        for message_data in messages:
+            try:
+                self.message_callback(message_data)
+            except Exception as e:
+                self.logger.error(f"Error in message callback: {e}")
+
+    def _receive_attachment(self, data, handler):
+        """Decrypt an attachment offer or chunk envelope and pass it to handler(sender_public_key, plaintext)"""
+        if not self.attachment_store:
+            return {"status": "error", "message": "attachments_disabled"}, 404
+
+        try:
+            envelope = wire_format.decode_envelope(data)
+            sender_public_key = self._resolve_sender_key(envelope)
+            if not sender_public_key:
+                return {"status": "error", "message": "unknown_sender_key"}, 409
+
+            if self.rate_limiter.rejected_by(sender_public_key):
+                return {"status": "error", "message": "rate_limited"}, 429
+
+            return handler(sender_public_key, self.decrypt_bytes(envelope['ciphertext'], sender_public_key))
+
+        except attachment_store.TransferLimit:
+            # The sender's outbox offers it again once earlier transfers have finished
+            return {"status": "error", "message": "too_many_transfers"}, 429
+
+        except attachment_store.UnknownTransfer:
+            # The partial file expired; the sender has to offer the attachment again
+            return {"status": "error", "message": "unknown_transfer"}, 404
+
+        except attachment_store.OffsetMismatch as e:
+            # Tell the sender where to resume
+            return {"status": "error", "message": "offset_mismatch", "offset": e.offset}, 409
+
+        except Exception as e:
+            self.logger.error(f"Error receiving attachment: {e}")
+            return {"status": "error", "message": str(e)}, 400
+
+    def _accept_attachment_offer(self, sender_public_key, plaintext):
+        offset = self.attachment_store.begin(sender_public_key, json.loads(plaintext))
+        return {"status": "success", "offset": offset}, 200
+
+    def _accept_attachment_chunk(self, sender_public_key, plaintext):
+        transfer_id, offset, data = wire_format.decode_chunk(plaintext)
+        offset, completed = self.attachment_store.write_chunk(sender_public_key, transfer_id, offset, data)
+
+        if completed:
+            self.logger.info(f"Received attachment {completed['name']} ({completed['size']} bytes)")
+            # Show up in the chat like any other message, pointing at the file on disk
+            self._handle_incoming_message(sender_public_key, json.dumps({
+                'type': 'img' if completed['file_type'] == 'image' else 'file',
+                'path': completed['path'],
+                'name': completed['name'],
+                'size': completed['size'],
+                'file_type': completed['file_type']
+            }))
+
+        return {"status": "success", "offset": offset, "complete": completed is not None}, 200
+
+    def _decompress_payload(self, envelope, plaintext):
+        """Undo the sender's compression stage if the envelope is flagged as compressed"""
+        if envelope['flags'] & wire_format.FLAG_COMPRESSED:
+            return compression.decompress(plaintext)
+        return plaintext
+
+    def _open_group_envelope(self, envelope, sender_public_key):
+        """
+        Decrypt a group envelope with the sender's group key and check the sender's signature
+
+        Returns None if we don't have the key or the sender's signing key. Every member
+        holds the group key, so only the signature shows the sender named in the
+        (unauthenticated) envelope header really sealed the message.
+        """
+        if envelope['wrapped_key']:
+            # Group key, signing key and group id, boxed for us by the sender
+            material = self.decrypt_bytes(envelope['wrapped_key'], sender_public_key)
+            self.group_keys.add_key_material(sender_public_key, material)
+
+        opened = self.group_keys.open(sender_public_key, envelope['group_key_id'], envelope['ciphertext'])
+        if not opened:
+            return None
+
+        group_id, plaintext = opened
+        decrypted_message = self._decompress_payload(envelope, plaintext).decode()
+
+        # A member's key for one group must not be usable to post into another
+        if json.loads(decrypted_message).get('group_id') != group_id:
+            raise ValueError("Group message does not match the group of its key")
+
+        return decrypted_message
+
+    def start_message_server(self):
+        """Serve the receive endpoints until close() is called"""
+        app = self._create_app()
+        host = "127.0.0.1" if self.transport == 'loopback' else "0.0.0.0"
+
         try:
-            app.run(host="0.0.0.0", port=self.socks_port)  # Use self.SERVER_PORT here
+            try:
+                from waitress.server import create_server
+            except ImportError:
+                create_server = None
+
+            if create_server:
+                # Fixed worker pool, bounded request bodies and HTTP/1.1 keep-alive
+                self.server = create_server(
+                    app,
+                    host=host,
+                    port=self.socks_port,
+                    threads=self.server_threads,
+                    max_request_body_size=self.max_request_size,
+                    channel_timeout=self.keepalive_timeout,
+                    cleanup_interval=min(self.SERVER_CLEANUP_INTERVAL, self.keepalive_timeout),
+                    ident="JustSocial"
+                )
+                self.logger.info(f"Receive server listening on port {self.socks_port} "
+                                 f"with {self.server_threads} worker threads")
+                self.server.run()
+            else:
+                self.logger.warning("waitress is not installed, falling back to the Werkzeug development server")
+                from werkzeug.serving import make_server
+                self.server = make_server(host, self.socks_port, app, threaded=True)
+                self.server.serve_forever()
         except Exception as e:
             self.logger.error(f"Failed to start server on port {self.socks_port}: {e}")
 
+    def stop_message_server(self):
+        """Stop accepting messages, letting in-flight requests finish"""
+        server = self.server
+        self.server = None
+        if not server:
+            return
+
+        if hasattr(server, 'task_dispatcher'):
+            # Finish running requests, then close the listening socket. Keep-alive connections still
+            # open are left to the peer; while we run, waitress closes idle ones after channel_timeout
+            server.task_dispatcher.shutdown(cancel_pending=False, timeout=5)
+            server.close()
+        else:
+            server.shutdown()
+
+    def _resolve_sender_key(self, envelope):
+        """Return the hex public key of an envelope's sender, or None if we only have an unknown key id"""
+        if envelope['sender_public_key']:
+            # Only remembered once something from this key decrypts, see decrypt_bytes
+            return envelope['sender_public_key'].hex()
+
+        return self.known_sender_keys.get(envelope['sender_key_id'])
+
+    def _register_peer_key(self, public_key):
+        """Remember a peer's public key so envelopes carrying only its key id can be resolved"""
+        self.known_sender_keys.add(public_key)
+
+    def _handle_incoming_message(self, sender_public_key, decrypted_message, message_id=None, envelope=None):
+        """Classify a decrypted message and hand it to the UI; envelope is the decoded binary envelope, if any"""
+        sender_id = sender_public_key
+
+        # Try to parse as JSON to check for special message types
+        try:
+            # Try to parse the message as JSON to check for group message
+            message_data = json.loads(decrypted_message)
+            if isinstance(message_data, dict):
+                # Check for group invitation
+                if message_data.get('type') == 'group_invitation':
+                    # The inviter's group key lets us read its group messages without per-message wrapping
+                    if message_data.get('sender_key') and message_data.get('group_id'):
+                        self.group_keys.add_peer_key(message_data['group_id'], sender_public_key,
+                                                     bytes.fromhex(message_data['sender_key']))
+                    if message_data.get('signing_key'):
+                        self.group_keys.add_verify_key(sender_public_key, bytes.fromhex(message_data['signing_key']))
+
+                    if message_id:
+                        self.receipts.add(sender_public_key, ('delivered', message_id))
+
+                    # Notify the UI
+                    if self.message_callback or self.message_batch_callback:
+                        self.ui_dispatcher.put({
+                            'sender_id': sender_id,
+                            'sender_public_key': sender_public_key,
+                            'is_group_invitation': True,
+                            'group_id': message_data.get('group_id'),
+                            'group_name': message_data.get('group_name'),
+                            'group_description': message_data.get('group_description', ''),
+                            'created_by': message_data.get('created_by'),
+                            'members': message_data.get('members', []),
+                            'avatar_path': message_data.get('avatar_path', ''),
+                            'timestamp': message_data.get('timestamp', time.time())
+                        }, sender_public_key)
+
+                        return
+
+                # Delivery or read receipts for messages we sent to this peer
+                elif message_data.get('type') == 'receipt':
+                    self._apply_receipts(sender_public_key, message_data)
+                    return
+
+                # Check for group message
+                elif message_data.get('type') == 'group_message':
+                    group_id = message_data.get('group_id')
+
+                    # Relayed copies carry the sender's base message id instead of our per-member one
+                    base_message_id = message_data.get('message_id')
+                    if base_message_id and base_message_id != message_id and \
+                            not self.deduplicator.check_and_add(sender_public_key, base_message_id):
+                        self.logger.info(f"Dropping duplicate group message {base_message_id}")
+                        return
+                    message_id = base_message_id or message_id
+
+                    # The sender tracks our copy under its own id, whether it reached us directly or relayed
+                    if message_id:
+                        self.receipts.add(sender_public_key, ('delivered', recipient_message_id(
+                            message_id, self.public_key.encode(HexEncoder).decode())))
+
+                    # Only a copy boxed for us proves the key is the sender's; a sealed copy
+                    # could have been made by any member
+                    if message_data.get('signing_key') and (not envelope or envelope['group_key_id'] is None):
+                        self.group_keys.add_verify_key(sender_public_key, bytes.fromhex(message_data['signing_key']))
+
+                    # Numbered messages move our sync cursor for this sender, and are kept
+                    # sealed so we can pass them on to members who missed them
+                    seq = message_data.get('seq')
+                    if self.db and group_id and isinstance(seq, int):
+                        shareable = None
+                        if envelope and envelope['group_key_id'] is not None:
+                            shareable = self._encode_group_envelope(envelope, b'', bytes.fromhex(sender_public_key),
+                                                                    message_id)
+                        self.db.add_group_envelope(group_id, sender_public_key, seq, message_id, shareable)
+                    # Use the actual message content for group messages
+                    decrypted_message = message_data.get('content')
+
+                    # Notify the UI if a callback is set
+                    if self.message_callback or self.message_batch_callback:
+                        message_data = {
+                            'sender_id': sender_id,
+                            'message': decrypted_message,
+                            'timestamp': message_data.get('timestamp', time.time()),
+                            'sender_public_key': sender_public_key,
+                            'is_group_message': True,
+                            'group_id': group_id,
+                            'message_id': message_id
+                        }
+
+                        self.ui_dispatcher.put(message_data, sender_public_key)
+
+                    return
+        except json.JSONDecodeError:
+            # Not a JSON message, treat as regular message
+            pass
+
+        # Regular direct message handling
+        if message_id:
+            self.receipts.add(sender_public_key, ('delivered', message_id))
+
+        if self.message_callback or self.message_batch_callback:
+            message_data = {
+                'sender_id': sender_id,
+                'message': decrypted_message,
+                'timestamp': time.time(),
+                'sender_public_key': sender_public_key,
+                'message_id': message_id
+            }
+
+            self.ui_dispatcher.put(message_data, sender_public_key)
+
     def send_message(self, recipient_address, recipient_public_key, message, message_id=None):
         """
         Send a message asynchronously and update status when response is received
@@ -214,34 +959,49 @@ class TorMessenger:
         Returns:
             bool: True if the message was queued successfully, False otherwise
         """
+        return self._queue_message(recipient_address, recipient_public_key, message, message_id)
+
+    def _track_message(self, recipient_address, recipient_public_key, message_id, payload):
+        """Mark a message as sending and persist it in the outbox before the first attempt"""
+        self.logger.info(f"Queueing message {message_id} for {recipient_address}")
+
+        # Track status only; the payload itself lives in the outbox
+        self.pending_messages.add(message_id, recipient_address)
+
+        # Persist first so the message survives a crash or restart mid-send
+        if self.db:
+            with self.transport_lock:
+                if not self.transport_ready.is_set():
+                    self.queued_before_transport.append(message_id)
+            now = time.time()
+            self.db.add_outbox_message(
+                message_id,
+                recipient_address,
+                recipient_public_key,
+                payload,
+                now + self.OUTBOX_IN_FLIGHT_GRACE,
+                now + self.retry_deadline
+            )
+
+        # Update UI immediately if callback exists
+        self._set_message_status(message_id, 'sending')
+
+    def _queue_message(self, recipient_address, recipient_public_key, message, message_id=None, group=None):
+        """Track, persist and queue a message; group carries the payload pre-sealed with a group key"""
         try:
             # Create a unique ID for this message if none provided
             if not message_id:
-                message_id = f"msg_{int(time.time())}_{hash(message)}"
+                message_id = new_message_id()
 
-            self.logger.info(f"Queueing message {message_id} for {recipient_address}")
+            self._track_message(recipient_address, recipient_public_key, message_id, message)
 
-            # Add to pending messages with 'sending' status
-            self.pending_messages[message_id] = {
-                'status': 'sending',
-                'timestamp': time.time(),
-                'recipient': recipient_address,
-                'message': message
-            }
-
-            # Update UI immediately if callback exists
-            if self.status_update_callback:
-                self.logger.info(f"Calling status update callback for message {message_id}: sending")
-                wx.CallAfter(self.status_update_callback, message_id, 'sending')
-
-            # Submit the async task to thread pool
-            self.executor.submit(
-                self._send_message_thread,
-                recipient_address,
-                recipient_public_key,
-                message,
-                message_id
-            )
+            # Coalesce with anything else queued for this peer in the next few milliseconds
+            self.coalescer.add(self._normalize_address(recipient_address), {
+                'message_id': message_id,
+                'recipient_public_key': recipient_public_key,
+                'message': message,
+                'group': group
+            })
 
             return True
 
@@ -249,11 +1009,45 @@ class TorMessenger:
             self.logger.error(f"Error queueing message: {e}")
 
             # Update status if there was an error
-            if message_id and self.status_update_callback:
-                wx.CallAfter(self.status_update_callback, message_id, 'failed')
+            if message_id:
+                self._set_message_status(message_id, 'failed', str(e))
 
             return False
 
+    def send_attachment(self, recipient_address, recipient_public_key, file_path, message_id=None, file_type=None,
+                        sha256=None):
+        """
+        Send a file in encrypted chunks, resuming where the recipient left off after a failure
+
+        Args:
+            recipient_address: The .onion address of the recipient
+            recipient_public_key: The public key of the recipient
+            file_path: Local file to send; it is read one chunk at a time
+            message_id: Optional ID to track the transfer for status updates
+            file_type: 'image', 'video', 'pdf' or 'file', decides where the recipient stores it
+            sha256: Hex digest of the file if the caller already computed it, to avoid hashing it again
+
+        Returns:
+            bool: True if the transfer was queued successfully, False otherwise
+        """
+        try:
+            if not message_id:
+                message_id = new_message_id()
+
+            transfer = attachment_store.describe_attachment(file_path, file_type, sha256)
+            self._track_message(recipient_address, recipient_public_key, message_id, json.dumps(transfer))
+
+            recipient_address = self._normalize_address(recipient_address)
+            self._when_transport_ready(self.scheduler.submit, recipient_address, self._send_attachment_thread,
+                                       recipient_address, recipient_public_key, transfer, message_id)
+            return True
+
+        except Exception as e:
+            self.logger.error(f"Error queueing attachment: {e}")
+            if message_id:
+                self._set_message_status(message_id, 'failed', str(e))
+            return False
+
     def send_group_message(self, group_id, members, message, message_id=None):
         """
         Send a message to multiple group members
@@ -268,50 +1062,72 @@ class TorMessenger:
             dict: Dictionary of results by member ID
         """
         if not message_id:
-            message_id = f"grp_{uuid.uuid4().hex}"
+            message_id = new_message_id()
 
         # Store the base message ID for database tracking
         base_message_id = message_id
 
         results = {}
-        sent_count = 0
 
         # Create group message wrapper
+        seq = self.group_seq.next(group_id)
         group_message = json.dumps({
             'type': 'group_message',
             'group_id': group_id,
             'sender_id': self.user_id,
             'content': message,
             'timestamp': time.time(),
-            'message_id': base_message_id  # Include the base message ID here
+            'message_id': base_message_id,  # Include the base message ID here
+            'seq': seq,  # Lets members find out which of our messages they missed
+            # Members that get this boxed rather than sealed learn our signing key from it
+            'signing_key': self.group_keys.own_verify_key().hex()
         })
 
-        # Send to each member
-        for member in members:
-            # Skip sending to ourselves
-            if member.get('id') == self.user_id:
-                continue
+        # Sign and encrypt the payload once with our group key; members only get a small wrapped key
+        # The sealed payload is shared by every member, so only zlib is used; members that
+        # can't decompress it get the message sealed for them individually instead
+        plaintext, compressed = compression.compress(group_message.encode(), ('zlib',))
+        key_id, key, ciphertext = self.group_keys.seal(group_id, plaintext)
+        group = {
+            'group_id': group_id,
+            'key_id': key_id,
+            'key': key,
+            'ciphertext': ciphertext,
+            'compressed': compressed
+        }
 
-            # Only send to members with connection info
-            if member.get('onion_address') and member.get('public_key'):
-                # Create a unique message ID for each recipient
-                member_message_id = f"{base_message_id}_{member.get('id')}"
+        # Keep our own message for members who sync later
+        envelope = wire_format.encode_envelope(bytes(self.public_key), group['ciphertext'], True, key_id,
+                                               compressed=compressed, message_id=base_message_id)
+        if self.db:
+            self.db.add_group_envelope(group_id, self.public_key.encode(HexEncoder).decode(), seq, base_message_id,
+                                       envelope)
 
-                # Send the message
-                result = self.send_message(
-                    member.get('onion_address'),
-                    member.get('public_key'),
-                    group_message,
-                    member_message_id
-                )
+        recipients = [member for member in members if member.get('id') != self.user_id and
+                      member.get('onion_address') and member.get('public_key')]
 
-                results[member.get('id')] = result
-                if result:
-                    sent_count += 1
+        if self.group_relay_fanout and len(recipients) > self.group_relay_fanout:
+            # Post to a few members and let them forward to the rest
+            recipients = self._send_group_relayed(group, envelope, base_message_id, group_message, recipients,
+                                                  results)
+
+        # Send to each member
+        for member in recipients:
+            # Send the message, tracked under this member's copy of the message ID
+            result = self._queue_message(
+                member.get('onion_address'),
+                member.get('public_key'),
+                group_message,
+                recipient_message_id(base_message_id, member['public_key']),
+                group
+            )
+
+            results[member.get('id')] = result
+
+        sent_count = sum(1 for result in results.values() if result)
 
         # Update the status of the base message ID to indicate it's been sent
-        if self.status_update_callback:
-            wx.CallAfter(self.status_update_callback, base_message_id, 'sent')
+        self.message_statuses.update(base_message_id, 'sent')
 
         # Return success if at least one message was sent
         return {
@@ -322,6 +1138,93 @@ class TorMessenger:
             'message_id': base_message_id
         }
 
+    def _send_group_relayed(self, group, envelope, base_message_id, group_message, members, results):
+        """
+        Hand a sealed group message to the members along a relay tree
+
+        Members known not to support relaying are returned for direct sending. A member
+        we fail to relay to gets the message through the outbox instead, and we forward
+        to its subtree ourselves.
+        """
+        direct = []
+        by_key = {}
+        routes = []
+        for member in members:
+            address = self._normalize_address(member['onion_address'])
+            features = self.peer_features.get(address)
+            if features is not None and ('relay' not in features or not self._group_for_peer(group, features)):
+                direct.append(member)
+                continue
+
+            public_key = member['public_key'].lower()
+            wrapped_key = b''
+            if not self.group_keys.is_distributed(group['group_id'], public_key):
+                wrapped_key = self.encrypt_bytes(self.group_keys.key_material(group['group_id'], group['key']),
+                                                 public_key)
+            routes.append({'key': public_key, 'address': address, 'wrapped_key': wrapped_key.hex()})
+            by_key[public_key] = member
+            results[member.get('id')] = True
+
+        def deliver_directly(route):
+            member = by_key.get(route['key'])
+            if member:
+                self._queue_message(member['onion_address'], member['public_key'], group_message,
+                                    recipient_message_id(base_message_id, member['public_key']), group)
+
+        # Shuffle so the same members don't always carry the forwarding load
+        tree = plan_relay_tree(random.sample(routes, len(routes)), self.group_relay_fanout)
+        self._forward_relay(group['group_id'], tree, envelope, deliver_directly)
+        return direct
+
+    def _forward_relay(self, group_id, routes, envelope, deliver_directly=None):
+        """Start a relay flow for each route"""
+        for route in routes:
+            self._submit_flow(route['address'], self._relay_flow(group_id, route, envelope, deliver_directly))
+
+    def sync_group(self, group_id, members):
+        """
+        Fetch the group messages we missed from a member that is online
+
+        Only what comes after our per-sender cursors is sent, so this is cheap enough to
+        call whenever we come back online or open a group. The fetched messages go
+        through the normal receive path. Does nothing without a database or if the
+        group was synced less than SYNC_MIN_INTERVAL seconds ago.
+
+        Args:
+            group_id: The ID of the group
+            members: List of member dictionaries with contact info
+
+        Returns:
+            bool: True if a sync was started
+        """
+        if not self.db:
+            return False
+
+        own_public_key = self.public_key.encode(HexEncoder).decode()
+        candidates = [(self._normalize_address(member['onion_address']), member['public_key'].lower())
+                      for member in members
+                      if member.get('onion_address') and member.get('public_key') and
+                      member.get('id') != self.user_id and member['public_key'].lower() != own_public_key]
+        if not candidates:
+            return False
+
+        now = time.time()
+        with self.sync_lock:
+            if now - self.last_group_sync.get(group_id, 0) < self.SYNC_MIN_INTERVAL:
+                return False
+            self.last_group_sync[group_id] = now
+
+        # Members we already have a connection to answer fastest
+        random.shuffle(candidates)
+        candidates.sort(key=lambda candidate: not self.send_pool.is_warm(candidate[0]))
+        self._submit_flow(candidates[0][0], self._group_sync_flow(group_id, candidates))
+        return True
+
+    def rotate_group_key(self, group_id):
+        """Switch to a new sender key for a group so a removed member can't read our later messages"""
+        key_id, _ = self.group_keys.rotate(group_id)
+        self.logger.info(f"Rotated sender key for group {group_id} to {key_id.hex()}")
+
     def send_group_invitation(self, group_data, members):
         """
         Send group invitation to all members
@@ -336,6 +1239,9 @@ class TorMessenger:
         results = {}
         sent_count = 0
 
+        # Our group key and signing key travel inside the (per-member encrypted) invitation
+        _, key = self.group_keys.get_own_key(group_data['id'])
+
         # Create invitation message
         invitation = {
             'type': 'group_invitation',
@@ -345,6 +1251,8 @@ class TorMessenger:
             'created_by': group_data['created_by'],
             'members': [m['id'] for m in members],
             'avatar_path': group_data.get('avatar_path', ''),
+            'sender_key': key.hex(),
+            'signing_key': self.group_keys.own_verify_key().hex(),
             'timestamp': time.time()
         }
 
@@ -368,6 +1276,7 @@ class TorMessenger:
                 results[member.get('id')] = result
                 if result:
                     sent_count += 1
+                    self.group_keys.mark_distributed(group_data['id'], member['public_key'])
 
         # Return results
         return {
@@ -377,144 +1286,895 @@ class TorMessenger:
             'results': results
         }
 
-    def _send_message_thread(self, recipient_address, recipient_public_key, message, message_id):
-        """Background thread to send message and handle response"""
+    def _set_message_status(self, message_id, status, error=None, retryable=None, final=None):
+        """Record a status change, notify the UI and keep the outbox up to date"""
+        self.message_statuses.update(message_id, status)
+
+        if retryable is None:
+            retryable = status in self.RETRYABLE_STATUSES
+
+        # Without an outbox nothing is retried, so any outcome is final
+        if final is None:
+            final = status not in ('sending', 'sent') and not (self.db and retryable)
+        pending = self.pending_messages.update(message_id, status, error, final)
+        if pending and status == 'delivered':
+            # End to end, including any retries
+            self.metrics.record('delivery', pending['delivered_at'] - pending['timestamp'],
+                                self._normalize_address(pending['recipient']))
+
+        if self.db and (final or status not in ('sending', 'sent')):
+            try:
+                if retryable:
+                    self._schedule_retry(message_id, error or status)
+                else:
+                    self.db.remove_outbox_message(message_id)
+            except Exception as e:
+                self.logger.error(f"Error updating outbox for message {message_id}: {e}")
+
+    def _set_message_accepted(self, message_id, recipient_address):
+        """The recipient took the message; peers that can send receipts back confirm delivery themselves later"""
+        features = self.peer_features.get(recipient_address, ())
+        if 'receipts' in features and 'reply_to' in features and self.onion_address:
+            self._set_message_status(message_id, 'sent', final=True)
+        else:
+            self._set_message_status(message_id, 'delivered')
+
+    def _schedule_retry(self, message_id, error):
+        """Schedule the next attempt with jittered exponential backoff, or give up past the deadline"""
+        entry = self.db.get_outbox_message(message_id)
+        if not entry:
+            return
+
+        now = time.time()
+        attempts = entry['attempts'] + 1
+        if now >= entry['deadline']:
+            self.logger.info(f"Giving up on message {message_id} after {attempts} attempts")
+            self._set_message_status(message_id, 'failed', error, retryable=False)
+            return
+
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** (attempts - 1)))
+        next_attempt_at = min(now + random.uniform(delay / 2, delay), entry['deadline'])
+        self.logger.info(f"Retrying message {message_id} in {next_attempt_at - now:.0f}s (attempt {attempts})")
+        self.db.reschedule_outbox_message(message_id, next_attempt_at, attempts, error)
+
+    def _outbox_loop(self):
+        """Periodically resend outbox entries whose next attempt is due"""
+        while not self.outbox_stop_event.wait(self.OUTBOX_POLL_INTERVAL):
+            if not self.transport_ready.is_set():
+                # Entries due now are sent once Tor is up; retrying them before that only duplicates them
+                continue
+            try:
+                now = time.time()
+                for entry in self.db.get_due_outbox_messages(now):
+                    # Push the entry out while this attempt is in flight so it isn't picked up twice
+                    self.db.reschedule_outbox_message(entry['message_id'], now + self.OUTBOX_IN_FLIGHT_GRACE)
+
+                    self.logger.info(f"Retrying message {entry['message_id']} to {entry['recipient_address']}")
+                    transfer = self._parse_attachment_transfer(entry['payload'])
+                    if transfer:
+                        # Picks up from whatever the recipient already has
+                        address = self._normalize_address(entry['recipient_address'])
+                        self.scheduler.submit(address, self._send_attachment_thread, address,
+                                              entry['recipient_public_key'], transfer, entry['message_id'])
+                        continue
+
+                    self.coalescer.add(self._normalize_address(entry['recipient_address']), {
+                        'message_id': entry['message_id'],
+                        'recipient_public_key': entry['recipient_public_key'],
+                        'message': entry['payload']
+                    })
+            except Exception as e:
+                self.logger.error(f"Error processing outbox: {e}")
+
+    def _parse_attachment_transfer(self, payload):
+        """Return the transfer record if an outbox payload is an attachment rather than a message"""
+        if attachment_store.TRANSFER_TYPE not in payload:
+            return None
         try:
-            print("==========Before encrypting============")
-            print(message)
-            encrypted_message = self.encrypt_message(message, recipient_public_key)
-            print("==========encrypted_message============")
-            print(encrypted_message)
-
-            payload = {
-                "sender_public_key": self.public_key.encode(HexEncoder).decode(),
-                "encrypted_message": encrypted_message,
-                "sender_id": self.user_id
-            }
+            transfer = json.loads(payload)
+        except json.JSONDecodeError:
+            return None
+        if isinstance(transfer, dict) and transfer.get('type') == attachment_store.TRANSFER_TYPE:
+            return transfer
+        return None
+
+    def _record_queue_time(self, message_id, recipient_address):
+        """Record how long a message waited before its first send attempt"""
+        queued_at = self.pending_messages.pop_queued_at(message_id)
+        if queued_at is not None:
+            self.metrics.record('queue', time.perf_counter() - queued_at, recipient_address)
+
+    def _deliver_statuses(self, statuses):
+        """Hand a batch of status changes to the UI (runs on the main thread)"""
+        if self.status_batch_callback:
+            self.status_batch_callback(statuses)
+        elif self.status_update_callback:
+            for message_id, status in statuses.items():
+                self.status_update_callback(message_id, status)
+
+    def _call_ui(self, stage, peer, callback, *args):
+        """Run a UI callback on the wx main thread, timing how long it waited there and ran"""
+        call_after(self._run_ui_callback, stage, peer, time.perf_counter(), callback, args)
+
+    def _run_ui_callback(self, stage, peer, queued_at, callback, args):
+        try:
+            callback(*args)
+        finally:
+            self.metrics.record(stage, time.perf_counter() - queued_at, peer)
 
-            # Make sure recipient address has the correct format
-            # Remove any http:// prefix if present
-            if recipient_address.startswith("http://"):
-                recipient_address = recipient_address[7:]
+    def get_latency_stats(self, peer=None):
+        """
+        Latency percentiles per delivery stage
 
-            # If no port is specified, add port 5000
-            if ":" not in recipient_address:
-                recipient_address = f"{recipient_address}:5000"
+        Stages: queue, encrypt, post_cold (includes SOCKS connect and rendezvous), post_warm,
+        delivery (end to end including retries), ping_cold and ping_warm (pre-warming),
+        status_callback, receive_accept, receive_queue, receive_decrypt and receive_callback.
+        Durations are in seconds.
 
-            # Configure the requests session to use the Tor SOCKS proxy
-            session = requests.Session()
-            session.proxies = {
-                'http': f'socks5h://127.0.0.1:{self.TOR_PORT}',
-                'https': f'socks5h://127.0.0.1:{self.TOR_PORT}'
-            }
+        Args:
+            peer: Onion address (send stages) or sender public key (receive stages), or None for all peers
 
-            url = f"http://{recipient_address}/receive"
-            self.logger.info(f"Sending message {message_id} to {url} through Tor proxy on port {self.TOR_PORT}")
+        Returns:
+            dict: stage -> {'count', 'mean', 'p50', 'p95', 'p99', 'max'}
+        """
+        return self.metrics.snapshot(peer)
 
-            # Update status to 'sent' before sending
-            if self.status_update_callback:
-                self.logger.info(f"Calling status update callback for message {message_id}: sent")
-                wx.CallAfter(self.status_update_callback, message_id, 'sent')
+    def get_pending_counts(self):
+        """Number of tracked outgoing messages per status"""
+        return self.pending_messages.counts_by_status()
 
-            # If pending_messages exists, update it
-            if message_id in self.pending_messages:
-                self.pending_messages[message_id]['status'] = 'sent'
+    def get_backlog(self):
+        """Outgoing messages still being delivered and how long the oldest of them has been waiting"""
+        oldest = self.pending_messages.oldest_in_flight()
+        return {
+            'in_flight': self.pending_messages.in_flight_count(),
+            'oldest_message_id': oldest[0] if oldest else None,
+            'oldest_age': time.time() - oldest[1]['timestamp'] if oldest else None
+        }
 
-            # Increase the timeout for Tor connections, which can be slow
-            response = session.post(url, json=payload, timeout=60)
+    def get_receive_stats(self):
+        """
+        Incoming messages accepted and shed since startup
 
-            if response.status_code == 200:
-                self.logger.info(f"Message {message_id} delivered successfully")
+        Returns:
+            dict: accepted, queued, duplicates, and shed_sender, shed_global and shed_busy
+                  for messages rejected by the per-sender limit, the global limit or a full receive queue
+        """
+        pipeline = self.receive_pipeline.get_stats()
+        shed = self.rate_limiter.get_shed_counts()
+        return {
+            'accepted': pipeline['accepted'],
+            'queued': pipeline['queued'],
+            'duplicates': self.deduplicator.duplicates,
+            'shed_sender': shed.get('sender', 0),
+            'shed_global': shed.get('global', 0),
+            'shed_busy': pipeline['rejected']
+        }
 
-                # Update status to 'delivered'
-                if self.status_update_callback:
-                    self.logger.info(f"Calling status update callback for message {message_id}: delivered")
-                    wx.CallAfter(self.status_update_callback, message_id, 'delivered')
+    def get_latency_peers(self):
+        """Peers that have latency samples, most recently active last"""
+        return self.metrics.get_peers()
 
-                # Update pending_messages
-                if message_id in self.pending_messages:
-                    self.pending_messages[message_id]['status'] = 'delivered'
-                    self.pending_messages[message_id]['delivered_at'] = time.time()
+    def _flush_peer_messages(self, recipient_address, items):
+        """Called by the coalescer with everything queued for one peer"""
+        self._submit_flow(recipient_address, self._send_items_flow(recipient_address, items))
 
-                return True
-            else:
-                self.logger.error(f"Error sending message {message_id}: HTTP {response.status_code} - {response.text}")
+    def _submit_flow(self, recipient_address, flow):
+        """Run a send flow on the asyncio engine if it is enabled, else on a send scheduler thread"""
+        self._when_transport_ready(self._start_flow, recipient_address, flow)
+
+    def _start_flow(self, recipient_address, flow):
+        if self.async_engine:
+            self.async_engine.submit(recipient_address, flow)
+        else:
+            self.scheduler.submit(recipient_address, self._run_flow, recipient_address, flow)
+
+    def _run_flow(self, recipient_address, flow):
+        """
+        Drive a send flow with blocking requests on the calling thread
 
-                # Update status to 'failed'
-                if self.status_update_callback:
-                    self.logger.info(f"Calling status update callback for message {message_id}: failed")
-                    wx.CallAfter(self.status_update_callback, message_id, 'failed')
+        Flows are generators that yield request dicts and are sent back the response,
+        so the same send logic runs on worker threads and on the asyncio engine.
 
-                # Update pending_messages
-                if message_id in self.pending_messages:
-                    self.pending_messages[message_id]['status'] = 'failed'
-                    self.pending_messages[message_id]['error'] = f"HTTP {response.status_code}"
+        Returns:
+            The flow's return value
+        """
+        try:
+            request = next(flow)
+            while True:
+                # Reuse the keep-alive session for this peer so we skip the SOCKS handshake
+                # and rendezvous circuit setup when the connection is still warm
+                session = self.connection_pool.get_session(recipient_address)
+                try:
+                    response = session.request(request['method'], request['url'], data=request.get('data'),
+                                               headers=request.get('headers'), timeout=request.get('timeout', 60))
+                except requests.exceptions.RequestException as e:
+                    request = flow.throw(e)
+                else:
+                    request = flow.send(response)
+        except StopIteration as stop:
+            return stop.value
+
+    def _send_items_flow(self, recipient_address, items):
+        """
+        Send flow delivering coalesced messages, batched when the peer supports it
+
+        Returns:
+            bool: False if the peer could not be reached, so the scheduler can throttle it
+        """
+        reachable = True
+        remaining = list(items)
+        while remaining:
+            features = self.peer_features.get(recipient_address)
+            if len(remaining) > 1 and features and 'batch' in features:
+                return (yield from self._send_batch_flow(recipient_address, remaining))
+
+            # Unknown or older peers get single messages; the first reply tells us their features
+            item = remaining.pop(0)
+            yield from self._send_message_flow(recipient_address, item['recipient_public_key'],
+                                               item['message'], item['message_id'], item.get('group'))
+            reachable = self.pending_messages.status(item['message_id']) not in self.RETRYABLE_STATUSES
+
+        return reachable
+
+    def _send_batch_flow(self, recipient_address, items, attempt=0):
+        """Send flow POSTing several messages to /receive_batch and applying each result; False if unreachable"""
+        # Message ids whose outcome is already recorded, so a failure in a later chunk leaves them alone
+        settled = set()
+        try:
+            for item in items:
+                self._record_queue_time(item['message_id'], recipient_address)
+
+            warm = self.send_pool.is_warm(recipient_address)
+            include_full_key = recipient_address not in self.peers_knowing_key
+            features = self.peer_features.get(recipient_address, set())
+
+            with self.metrics.span('encrypt', recipient_address):
+                envelopes = [
+                    self._build_envelope(item['message'], item['recipient_public_key'], include_full_key,
+                                         self._group_for_peer(item.get('group'), features), features,
+                                         item['message_id'])
+                    for item in items
+                ]
+
+            for item in items:
+                self._set_message_status(item['message_id'], 'sent')
+
+            # Split very large bursts (e.g. several images) so no single request gets too big
+            chunks = []
+            chunk = []
+            chunk_bytes = 0
+            for item, envelope in zip(items, envelopes):
+                if chunk and chunk_bytes + len(envelope) > self.MAX_BATCH_BYTES:
+                    chunks.append(chunk)
+                    chunk = []
+                    chunk_bytes = 0
+                chunk.append((item, envelope))
+                chunk_bytes += len(envelope)
+            chunks.append(chunk)
+
+            retry = []
+            for chunk in chunks:
+                self.logger.info(f"Sending batch of {len(chunk)} messages to {recipient_address}")
+                with self.metrics.span('post_warm' if warm else 'post_cold', recipient_address):
+                    response = yield {
+                        'method': 'POST',
+                        'url': f"http://{recipient_address}/receive_batch",
+                        'data': wire_format.encode_batch([envelope for _, envelope in chunk]),
+                        'headers': self._with_reply_to({'Content-Type': wire_format.BATCH_CONTENT_TYPE}),
+                        'timeout': 60
+                    }
+                warm = True
+
+                if response.status_code == 404:
+                    # Peer dropped batch support; deliver the rest one by one
+                    self.peer_features.get(recipient_address, set()).discard('batch')
+                    for item, _ in chunk:
+                        yield from self._send_message_flow(recipient_address, item['recipient_public_key'],
+                                                           item['message'], item['message_id'], item.get('group'))
+                        settled.add(item['message_id'])
+                    continue
+
+                if response.status_code != 200:
+                    self.logger.error(f"Error sending batch to {recipient_address}: HTTP {response.status_code}")
+                    for item, _ in chunk:
+                        self._set_message_status(item['message_id'], 'failed', f"HTTP {response.status_code}",
+                                                 retryable=self._is_retryable_http_status(response.status_code))
+                        settled.add(item['message_id'])
+                    continue
+
+                results = response.json().get('results', [])
+                for index, (item, _) in enumerate(chunk):
+                    result = results[index] if index < len(results) else {}
+                    if result.get('status') == 'success':
+                        self.peers_knowing_key.add(recipient_address)
+                        self._mark_group_key_distributed(self._group_for_peer(item.get('group'), features),
+                                                         item['recipient_public_key'])
+                        self._set_message_accepted(item['message_id'], recipient_address)
+                    elif result.get('message') == 'unknown_sender_key' and attempt < 2:
+                        # Peer forgot our key id; resend with the full key
+                        self.peers_knowing_key.discard(recipient_address)
+                        retry.append(item)
+                    elif result.get('message') == 'unknown_group_key' and item.get('group') and attempt < 2:
+                        # Peer lost our group key; resend with the key wrapped for it
+                        self.group_keys.forget_distributed(item['group']['group_id'], item['recipient_public_key'])
+                        retry.append(item)
+                    elif result.get('message') in ('busy', 'rate_limited'):
+                        # Peer's receive queue was full or we are over its rate limit; worth another try later
+                        self._set_message_status(item['message_id'], 'failed', result['message'], retryable=True)
+                    else:
+                        self._set_message_status(item['message_id'], 'failed',
+                                                 result.get('message', 'missing batch result'))
+                    if item not in retry:
+                        settled.add(item['message_id'])
 
+        except requests.exceptions.Timeout:
+            self.logger.error(f"Timeout sending batch to {recipient_address}.")
+            for item in items:
+                if item['message_id'] not in settled:
+                    self._set_message_status(item['message_id'], 'timeout')
+            return False
+
+        except requests.exceptions.ConnectionError as e:
+            self.logger.error(f"Connection error sending batch to {recipient_address}: {e}")
+            self.send_pool.discard(recipient_address)
+            for item in items:
+                if item['message_id'] not in settled:
+                    self._set_message_status(item['message_id'], 'connection_error', str(e))
+            return False
+
+        except Exception as e:
+            self.logger.exception(f"Error sending batch to {recipient_address}: {e}")
+            for item in items:
+                if item['message_id'] not in settled:
+                    self._set_message_status(item['message_id'], 'error', str(e))
+            raise
+
+        # Outside the try so a failure in the retry isn't recorded a second time for the same items
+        if retry:
+            return (yield from self._send_batch_flow(recipient_address, retry, attempt + 1))
+        return True
+
+    def _send_message_flow(self, recipient_address, recipient_public_key, message, message_id, group=None):
+        """Send flow delivering one message and handling the response"""
+        try:
+            recipient_address = self._normalize_address(recipient_address)
+            self._record_queue_time(message_id, recipient_address)
+            warm = self.send_pool.is_warm(recipient_address)
+
+            self.logger.info(f"Sending message {message_id} to {recipient_address} through Tor proxy on port {self.TOR_PORT}")
+
+            # Update status to 'sent' before sending
+            self._set_message_status(message_id, 'sent')
+
+            # A cold post includes the SOCKS connect and hidden service rendezvous
+            with self.metrics.span('post_warm' if warm else 'post_cold', recipient_address):
+                response = yield from self._post_message_flow(recipient_address, recipient_public_key, message,
+                                                              group, message_id)
+
+            if response.status_code == 200:
+                self.logger.info(f"Message {message_id} delivered successfully")
+                self._set_message_accepted(message_id, recipient_address)
+                return True
+            else:
+                self.logger.error(f"Error sending message {message_id}: HTTP {response.status_code} - {response.text}")
+                self._set_message_status(message_id, 'failed', f"HTTP {response.status_code}",
+                                         retryable=self._is_retryable_http_status(response.status_code))
                 return False
 
         except requests.exceptions.Timeout:
             self.logger.error(
                 f"Timeout connecting to {recipient_address}. Tor connection may be slow or the address is unreachable.")
+            self._set_message_status(message_id, 'timeout')
+            return False
+
+        except requests.exceptions.ConnectionError as e:
+            self.logger.error(f"Connection error: {e}. Check if the recipient address is correct and online.")
 
-            # Update status to 'timeout'
-            if self.status_update_callback:
-                self.logger.info(f"Calling status update callback for message {message_id}: timeout")
-                wx.CallAfter(self.status_update_callback, message_id, 'timeout')
+            # Don't keep a broken connection around for the next message
+            self.send_pool.discard(self._normalize_address(recipient_address))
+            self._set_message_status(message_id, 'connection_error', str(e))
+            return False
 
-            # Update pending_messages
-            if message_id in self.pending_messages:
-                self.pending_messages[message_id]['status'] = 'timeout'
+        except Exception as e:
+            self.logger.error(f"Error sending message: {e}")
+            self._set_message_status(message_id, 'error', str(e))
 
+            import traceback
+            traceback.print_exc()
             return False
 
-        except requests.exceptions.ConnectionError as e:
-            self.logger.error(f"Connection error: {e}. Check if the recipient address is correct and online.")
+    def _send_attachment_thread(self, recipient_address, recipient_public_key, transfer, message_id):
+        """
+        Background thread to upload an attachment chunk by chunk
+
+        Returns:
+            bool: False if the peer could not be reached, so the scheduler can throttle it
+        """
+        try:
+            session = self.connection_pool.get_session(recipient_address)
+            offer = json.dumps({key: transfer[key] for key in ('transfer_id', 'name', 'size', 'sha256', 'file_type')})
+            transfer_id = bytes.fromhex(transfer['transfer_id'])
+
+            self._set_message_status(message_id, 'sent')
+
+            # The offer tells us how much the recipient already has from an earlier attempt
+            offset = self._post_attachment(session, recipient_address, recipient_public_key, 'offer',
+                                           offer.encode())['offset']
+            if offset:
+                self.logger.info(f"Resuming attachment {message_id} at byte {offset} of {transfer['size']}")
+
+            with open(transfer['path'], 'rb') as f:
+                while offset < transfer['size']:
+                    f.seek(offset)
+                    data = f.read(attachment_store.CHUNK_SIZE)
+                    if not data:
+                        raise IOError(f"{transfer['path']} is shorter than when it was queued")
+
+                    result = self._post_attachment(session, recipient_address, recipient_public_key, 'chunk',
+                                                   wire_format.encode_chunk(transfer_id, offset, data))
+                    if result.get('message') == 'unknown_transfer':
+                        result = self._post_attachment(session, recipient_address, recipient_public_key, 'offer',
+                                                       offer.encode())
+                    offset = result['offset']
+
+            self.logger.info(f"Attachment {message_id} delivered successfully")
+            self._set_message_status(message_id, 'delivered')
+            return True
 
-            # Update status to 'connection_error'
-            if self.status_update_callback:
-                self.logger.info(f"Calling status update callback for message {message_id}: connection_error")
-                wx.CallAfter(self.status_update_callback, message_id, 'connection_error')
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code
+            self.logger.error(f"Error sending attachment {message_id}: HTTP {status_code}")
+            self._set_message_status(message_id, 'failed', f"HTTP {status_code}",
+                                     retryable=self._is_retryable_http_status(status_code))
+            return True
 
-            # Update pending_messages
-            if message_id in self.pending_messages:
-                self.pending_messages[message_id]['status'] = 'connection_error'
-                self.pending_messages[message_id]['error'] = str(e)
+        except requests.exceptions.Timeout:
+            self.logger.error(f"Timeout sending attachment {message_id} to {recipient_address}.")
+            self._set_message_status(message_id, 'timeout')
+            return False
 
+        except requests.exceptions.ConnectionError as e:
+            self.logger.error(f"Connection error sending attachment {message_id}: {e}")
+            self.connection_pool.discard(recipient_address)
+            self._set_message_status(message_id, 'connection_error', str(e))
             return False
 
         except Exception as e:
-            self.logger.error(f"Error sending message: {e}")
+            self.logger.error(f"Error sending attachment: {e}")
+            self._set_message_status(message_id, 'error', str(e))
+            return True
 
-            # Update status to 'error'
-            if self.status_update_callback:
-                self.logger.info(f"Calling status update callback for message {message_id}: error")
-                wx.CallAfter(self.status_update_callback, message_id, 'error')
+    def _post_attachment(self, session, recipient_address, recipient_public_key, kind, plaintext):
+        """POST an encrypted attachment offer or chunk and return the recipient's reply"""
+        include_full_key = recipient_address not in self.peers_knowing_key
+
+        for _ in range(2):
+            body = wire_format.encode_envelope(bytes(self.public_key),
+                                               self.encrypt_bytes(plaintext, recipient_public_key),
+                                               include_full_key)
+            response = session.post(f"http://{recipient_address}/attachment/{kind}", data=body,
+                                    headers={'Content-Type': wire_format.CONTENT_TYPE}, timeout=60)
+            if response.status_code == 409 and not include_full_key and \
+                    response.json().get('message') == 'unknown_sender_key':
+                include_full_key = True
+                continue
+            break
+
+        if response.status_code == 200:
+            self.peers_knowing_key.add(recipient_address)
+            return response.json()
+
+        # Where to resume, or a request to offer the attachment again
+        if response.status_code in (404, 409) and \
+                response.headers.get('Content-Type', '').startswith('application/json'):
+            result = response.json()
+            if result.get('message') in ('offset_mismatch', 'unknown_transfer'):
+                return result
+
+        raise requests.exceptions.HTTPError(f"HTTP {response.status_code}", response=response)
+
+    def _is_retryable_http_status(self, status_code):
+        """Server errors and overload responses are worth retrying, client errors are not"""
+        return status_code >= 500 or status_code == 429
+
+    def _group_for_peer(self, group, features):
+        """The pre-sealed group payload if the peer can open it, else None to seal the message per member"""
+        if not group or not features or 'signed_group' not in features:
+            return None
+        if group.get('compressed') and 'zlib' not in features:
+            return None
+        return group
+
+    def _build_envelope(self, message, recipient_public_key, include_full_key, group=None, features=(),
+                        message_id=None):
+        """Encrypt a message into a binary envelope, or wrap a pre-sealed group payload"""
+        # Lets the recipient drop retries of a message it already has
+        if 'message_id' not in features:
+            message_id = None
+
+        if group:
+            wrapped_key = b''
+            if not self.group_keys.is_distributed(group['group_id'], recipient_public_key):
+                wrapped_key = self.encrypt_bytes(self.group_keys.key_material(group['group_id'], group['key']),
+                                                 recipient_public_key)
+            return wire_format.encode_envelope(bytes(self.public_key), group['ciphertext'], include_full_key,
+                                               group['key_id'], wrapped_key, group.get('compressed', False),
+                                               message_id)
+
+        # Compress before encrypting, since ciphertext doesn't compress; only for peers that advertised a codec
+        plaintext, compressed = compression.compress(message.encode(), features)
+        ciphertext = self.encrypt_bytes(plaintext, recipient_public_key)
+        return wire_format.encode_envelope(bytes(self.public_key), ciphertext, include_full_key,
+                                           compressed=compressed, message_id=message_id)
+
+    def _mark_group_key_distributed(self, group, recipient_public_key):
+        """After a successful group-key delivery the member holds our key, so stop wrapping it"""
+        if group:
+            self.group_keys.mark_distributed(group['group_id'], recipient_public_key)
+
+    def _post_message_flow(self, recipient_address, recipient_public_key, message, group=None, message_id=None):
+        """Send flow POSTing an encrypted message, as a binary envelope unless the peer only speaks legacy JSON"""
+        url = f"http://{recipient_address}/receive"
+        features = self.peer_features.get(recipient_address)
+
+        if features is None or 'envelope' in features:
+            include_full_key = recipient_address not in self.peers_knowing_key
+            # Until we know the peer understands group keys, seal group messages per member
+            item_group = self._group_for_peer(group, features)
+
+            headers = self._with_reply_to({'Content-Type': wire_format.CONTENT_TYPE})
+            if message_id and (features is None or 'message_id' not in features):
+                # Older receivers ignore the header, newer ones dedupe even our first message
+                headers[wire_format.MESSAGE_ID_HEADER] = message_id
+
+            for _ in range(3):
+                with self.metrics.span('encrypt', recipient_address):
+                    body = self._build_envelope(message, recipient_public_key, include_full_key, item_group,
+                                                features or (), message_id)
+
+                # Increase the timeout for Tor connections, which can be slow
+                response = yield {'method': 'POST', 'url': url, 'data': body, 'headers': headers, 'timeout': 60}
+                if response.status_code != 409:
+                    break
+
+                reason = response.json().get('message')
+                if reason == 'unknown_sender_key' and not include_full_key:
+                    # Peer restarted or never saw our key; resend with the full key
+                    include_full_key = True
+                elif reason == 'unknown_group_key' and item_group:
+                    # Peer lost our group key; resend with the key wrapped for it
+                    self.group_keys.forget_distributed(group['group_id'], recipient_public_key)
+                else:
+                    break
+
+            advertised = response.headers.get(wire_format.FEATURES_HEADER)
+            if advertised is not None:
+                self.peer_features[recipient_address] = set(advertised.split(','))
+                if response.status_code == 200:
+                    self.peers_knowing_key.add(recipient_address)
+                    self._mark_group_key_distributed(item_group, recipient_public_key)
+                return response
+
+            # No features header means an older client that only accepts JSON
+            self.logger.info(f"{recipient_address} does not support binary envelopes, falling back to JSON")
+            self.peer_features[recipient_address] = set()
+
+        payload = {
+            "sender_public_key": self.public_key.encode(HexEncoder).decode(),
+            "encrypted_message": self.encrypt_message(message, recipient_public_key),
+            "sender_id": self.user_id,
+            "message_id": message_id
+        }
+        return (yield {'method': 'POST', 'url': url, 'data': json.dumps(payload),
+                       'headers': {'Content-Type': 'application/json'}, 'timeout': 60})
+
+    def send_read_receipts(self, sender_public_key, message_ids):
+        """Tell a contact its messages were read; batched with other receipts for the same contact"""
+        for message_id in message_ids:
+            self.receipts.add(sender_public_key, ('read', message_id))
+
+    def _flush_receipts(self, sender_public_key, items):
+        """Called by the receipt coalescer with every receipt collected for one contact"""
+        contact = self.db.get_contact(sender_public_key) if self.db else None
+        address = contact.get('onion_address') if contact else None
+        if not address:
+            # Not a contact (yet), or no database: use the address the sender gave us
+            with self.reply_addresses_lock:
+                address = self.reply_addresses.get(sender_public_key)
+        if not address:
+            self.logger.debug(f"Dropping {len(items)} receipts for {sender_public_key}: no address known")
+            return
+
+        receipt = {'type': 'receipt'}
+        for status, message_id in items:
+            receipt.setdefault(status, []).append(message_id)
+
+        recipient_address = self._normalize_address(address)
+        self._submit_flow(recipient_address,
+                          self._send_receipt_flow(recipient_address, sender_public_key, json.dumps(receipt)))
+
+    def _with_reply_to(self, headers):
+        """Add our address for receipts to request headers, once we have one"""
+        if self.onion_address:
+            headers[wire_format.REPLY_TO_HEADER] = self.onion_address
+        return headers
+
+    def _remember_reply_address(self, sender_public_key, address):
+        if len(address) > 128 or any(char.isspace() or char in '/?#@' for char in address):
+            return
+        with self.reply_addresses_lock:
+            self.reply_addresses[sender_public_key] = address
+            self.reply_addresses.move_to_end(sender_public_key)
+            while len(self.reply_addresses) > self.MAX_REPLY_ADDRESSES:
+                self.reply_addresses.popitem(last=False)
+
+    def _send_receipt_flow(self, recipient_address, recipient_public_key, receipt):
+        """Send flow for one batch of receipts; best effort, since losing one only leaves a status behind"""
+        try:
+            if self.peer_features.get(recipient_address) is None:
+                response = yield {'method': 'GET', 'url': f"http://{recipient_address}/ping", 'timeout': 60}
+                advertised = response.headers.get(wire_format.FEATURES_HEADER)
+                self.peer_features[recipient_address] = set(advertised.split(',')) if advertised else set()
 
-            # Update pending_messages
-            if message_id in self.pending_messages:
-                self.pending_messages[message_id]['status'] = 'error'
-                self.pending_messages[message_id]['error'] = str(e)
+            # Older clients would show the receipt as a message
+            if 'receipts' not in self.peer_features[recipient_address]:
+                return True
 
-            import traceback
-            traceback.print_exc()
+            response = yield from self._post_message_flow(recipient_address, recipient_public_key, receipt)
+            if response.status_code != 200:
+                self.logger.info(f"Receipts to {recipient_address} rejected: HTTP {response.status_code}")
+            return True
+
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            self.logger.info(f"Could not send receipts to {recipient_address}: {e}")
+            self.send_pool.discard(recipient_address)
             return False
 
+    def _apply_receipts(self, sender_public_key, receipt):
+        """Apply a batch of receipts from a peer to the messages we sent it"""
+        for status in ('delivered', 'read'):
+            message_ids = [message_id for message_id in receipt.get(status) or [] if isinstance(message_id, str)]
+            if not message_ids:
+                continue
+
+            if status == 'delivered':
+                # Receipts can overtake each other; never move a read message back to delivered
+                message_ids = [message_id for message_id in message_ids
+                               if self.pending_messages.status(message_id) != 'read']
+
+            for message_id in message_ids:
+                pending = self.pending_messages.update(message_id, status, final=True)
+                if pending and status == 'delivered':
+                    self.metrics.record('delivery', pending['delivered_at'] - pending['timestamp'],
+                                        self._normalize_address(pending['recipient']))
+
+            if self.receipt_callback:
+                # The receipt callback stores these itself; keep a pending 'sent' from overwriting them
+                self.message_statuses.observe(message_ids, status)
+                self._call_ui('status_callback', sender_public_key, self.receipt_callback, sender_public_key,
+                              status, message_ids)
+            else:
+                for message_id in message_ids:
+                    self.message_statuses.update(message_id, status)
+
+    def prewarm(self, recipient_address):
+        """
+        Open a circuit and pooled connection to a peer in the background, unless one is already fresh
+
+        Returns:
+            bool: True if a warm-up ping was queued
+        """
+        if not self.transport_ready.is_set():
+            return False
+
+        recipient_address = self._normalize_address(recipient_address)
+        idle = self.send_pool.idle_for(recipient_address)
+        if idle is not None and idle < min(self.PREWARM_REFRESH, self.keepalive_timeout / 2):
+            return False
+
+        with self.warming_lock:
+            if recipient_address in self.warming:
+                return False
+            self.warming.add(recipient_address)
+
+        try:
+            self._submit_flow(recipient_address, self._ping_flow(recipient_address))
+        except RuntimeError:
+            # Shutting down
+            with self.warming_lock:
+                self.warming.discard(recipient_address)
+            return False
+        return True
+
+    def _relay_flow(self, group_id, route, envelope, deliver_directly=None):
+        """
+        Send flow handing a group envelope to a member along with the subtree it should forward to
+
+        If the member can't relay, or can't be reached, we forward to its subtree ourselves.
+        The member itself then gets the message through deliver_directly (the original
+        sender's outbox) or, on a relaying member, a plain post of the envelope.
+        """
+        address = route['address']
+        header = json.dumps({
+            'group_id': group_id,
+            'wrapped_key': route.get('wrapped_key', ''),
+            'routes': route.get('routes', [])
+        }).encode()
+
+        try:
+            features = self.peer_features.get(address)
+            if features is None or 'relay' in features:
+                include_full_key = address not in self.peers_knowing_key
+                for _ in range(2):
+                    with self.metrics.span('encrypt', address):
+                        ciphertext = self.encrypt_bytes(wire_format.encode_relay(header, envelope), route['key'])
+                        body = wire_format.encode_envelope(bytes(self.public_key), ciphertext, include_full_key)
+
+                    response = yield {'method': 'POST', 'url': f"http://{address}/group_relay", 'data': body,
+                                      'headers': {'Content-Type': wire_format.CONTENT_TYPE}, 'timeout': 60}
+                    if response.status_code != 409 or include_full_key or \
+                            response.json().get('message') != 'unknown_sender_key':
+                        break
+                    include_full_key = True
+
+                advertised = response.headers.get(wire_format.FEATURES_HEADER)
+                if advertised is not None:
+                    self.peer_features[address] = set(advertised.split(','))
+
+                if response.status_code == 200:
+                    self.peers_knowing_key.add(address)
+                    # Members the relay doesn't know are left to us
+                    self._forward_relay(group_id, response.json().get('rejected', []), envelope, deliver_directly)
+                    return True
+
+                self.logger.info(f"{address} did not relay group message: HTTP {response.status_code}")
+
+            self._forward_relay(group_id, route.get('routes', []), envelope, deliver_directly)
+            if deliver_directly:
+                deliver_directly(route)
+            elif 'signed_group' in self.peer_features.get(address, ()):
+                inner = wire_format.decode_envelope(envelope)
+                body = self._encode_group_envelope(inner, bytes.fromhex(route.get('wrapped_key') or ''))
+                yield {'method': 'POST', 'url': f"http://{address}/receive", 'data': body,
+                       'headers': {'Content-Type': wire_format.CONTENT_TYPE}, 'timeout': 60}
+            return True
+
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            self.logger.error(f"Could not relay group message to {address}: {e}")
+            if isinstance(e, requests.exceptions.ConnectionError):
+                self.send_pool.discard(address)
+
+            self._forward_relay(group_id, route.get('routes', []), envelope, deliver_directly)
+            if deliver_directly:
+                deliver_directly(route)
+            return False
+
+    def _group_sync_flow(self, group_id, candidates):
+        """Send flow fetching /group_sync pages from the first candidate member, moving on to the next if it fails"""
+        address, public_key = candidates[0]
+        cursors = self.db.get_group_sync_cursors(group_id)
+        fetched = 0
+        reachable = True
+
+        try:
+            while True:
+                query = json.dumps({'group_id': group_id, 'cursors': cursors, 'limit': self.SYNC_PAGE_SIZE}).encode()
+                body = wire_format.encode_envelope(bytes(self.public_key), self.encrypt_bytes(query, public_key))
+                response = yield {'method': 'POST', 'url': f"http://{address}/group_sync", 'data': body,
+                                  'headers': {'Content-Type': wire_format.CONTENT_TYPE}, 'timeout': 60}
+                if response.status_code != 200:
+                    raise wire_format.EnvelopeError(f"HTTP {response.status_code}")
+
+                # Only the member we asked can have encrypted the answer for us
+                answer = wire_format.decode_envelope(response.content)
+                header, envelopes = wire_format.decode_sync_page(self.decrypt_bytes(answer['ciphertext'], public_key))
+                header = json.loads(header)
+
+                for entry in header.get('keys', []):
+                    key = bytes.fromhex(entry['key'])
+                    if not self.group_keys.lookup(entry['owner'], wire_format.key_id(key)):
+                        self.group_keys.add_peer_key(group_id, entry['owner'], key)
+                # The member we asked vouches for its own signing key only; envelopes from
+                # senders whose signing key we don't have yet aren't stored, so a later sync
+                # fetches them again once that sender has sent us its key
+                if header.get('signing_key'):
+                    self.group_keys.add_verify_key(public_key, bytes.fromhex(header['signing_key']))
+
+                for envelope in envelopes:
+                    if wire_format.decode_envelope(envelope)['sender_public_key'] == bytes(self.public_key):
+                        continue
+                    _, status_code = self._accept_envelope(envelope, rate_limit=False)
+                    if status_code == 503:
+                        # Our decrypt workers are behind; the rest waits for the next sync
+                        self.logger.info(f"Receive queue full, pausing sync of group {group_id}")
+                        return True
+                fetched += len(envelopes)
+
+                # The page ends at the last number sent per sender; ask for what comes after it
+                for sender_key, last in header.get('cursors', {}).items():
+                    cursor = cursors.setdefault(sender_key, {'after': 0, 'missing': []})
+                    cursor['missing'] = [[max(first, last + 1), end] for first, end in cursor['missing'] if end > last]
+                    cursor['after'] = max(cursor['after'], last)
+                if not header.get('more') or not envelopes:
+                    break
+
+            self.logger.info(f"Synced group {group_id} from {address}: {fetched} message(s)")
+            return True
+
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            self.logger.info(f"Could not sync group {group_id} from {address}: {e}")
+            if isinstance(e, requests.exceptions.ConnectionError):
+                self.send_pool.discard(address)
+            reachable = False
+
+        except (ValueError, KeyError, CryptoError) as e:
+            # Includes older members without /group_sync and answers we can't decrypt
+            self.logger.info(f"Group sync of {group_id} from {address} failed: {e}")
+
+        if len(candidates) > 1:
+            self._submit_flow(candidates[1][0], self._group_sync_flow(group_id, candidates[1:]))
+        return reachable
+
+    def _ping_flow(self, recipient_address):
+        """Send flow: GET /ping, which fetches the descriptor and builds the rendezvous circuit"""
+        try:
+            warm = self.send_pool.is_warm(recipient_address)
+            with self.metrics.span('ping_warm' if warm else 'ping_cold', recipient_address):
+                response = yield {'method': 'GET', 'url': f"http://{recipient_address}/ping", 'timeout': 60}
+
+            # Any answer warms the circuit, even a 404 from an older client
+            advertised = response.headers.get(wire_format.FEATURES_HEADER)
+            if advertised is not None:
+                self.peer_features[recipient_address] = set(advertised.split(','))
+            return True
+
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            self.logger.info(f"Could not pre-warm connection to {recipient_address}: {e}")
+            self.send_pool.discard(recipient_address)
+            return False
+
+        finally:
+            with self.warming_lock:
+                self.warming.discard(recipient_address)
+
+    def _normalize_address(self, address):
+        """Strip any http:// prefix and add the default port if missing"""
+        if address.startswith("http://"):
+            address = address[7:]
+
+        # If no port is specified, add port 5000
+        if ":" not in address:
+            address = f"{address}:5000"
+
+        return address
+
     def encrypt_message(self, message, recipient_public_key):
         """Encrypt a message for a recipient"""
         try:
-            recipient_key = PublicKey(recipient_public_key.encode(), encoder=HexEncoder)
-            box = Box(self.private_key, recipient_key)
+            box = self.box_cache.get(recipient_public_key)
             encrypted = box.encrypt(message.encode(), encoder=HexEncoder)
             return encrypted.decode()
         except Exception as e:
             self.logger.error(f"Encryption error: {e}")
             raise
 
+    def encrypt_bytes(self, data, recipient_public_key):
+        """Encrypt raw bytes for a recipient, returning nonce and ciphertext without any text encoding"""
+        self._register_peer_key(recipient_public_key)
+        return bytes(self.box_cache.get(recipient_public_key).encrypt(data))
+
+    def decrypt_bytes(self, ciphertext, sender_public_key):
+        """Decrypt raw nonce and ciphertext from a sender"""
+        plaintext = self.box_cache.get(sender_public_key).decrypt(ciphertext)
+        # The box authenticated the sender, so its key id can stand in for the full key from now on
+        self._register_peer_key(sender_public_key)
+        return plaintext
+
     def decrypt_message(self, encrypted_message, sender_public_key):
         """Decrypt a message from a sender"""
         try:
-            sender_key = PublicKey(sender_public_key.encode(), encoder=HexEncoder)
-            box = Box(self.private_key, sender_key)
+            box = self.box_cache.get(sender_public_key)
             decrypted = box.decrypt(encrypted_message.encode(), encoder=HexEncoder)
             return decrypted.decode()
         except Exception as e:
@@ -524,9 +2184,41 @@ class TorMessenger:
     def close(self):
         """Clean up resources"""
         try:
-            # Shutdown the thread pool
-            if hasattr(self, 'executor'):
-                self.executor.shutdown(wait=False)
+            # Stop receiving before tearing down the rest
+            self.stop_message_server()
+
+            if self.prewarmer:
+                self.prewarmer.close()
+
+            # Finish decrypting what was already accepted, then stop the workers
+            if hasattr(self, 'receive_pipeline'):
+                self.receive_pipeline.close()
+            if hasattr(self, 'ui_dispatcher'):
+                self.ui_dispatcher.close()
+            if hasattr(self, 'message_statuses'):
+                self.message_statuses.close()
+                self.message_statuses.flush_all()
+
+            # Stop the outbox scheduler; undelivered messages stay in the database
+            self.outbox_stop_event.set()
+
+            # Hand anything still waiting in the coalescers to the send scheduler
+            if hasattr(self, 'coalescer'):
+                self.coalescer.close()
+                self.coalescer.flush_all()
+            if hasattr(self, 'receipts'):
+                self.receipts.close()
+                self.receipts.flush_all()
+
+            # Stop the send workers and event loop
+            if hasattr(self, 'scheduler'):
+                self.scheduler.shutdown()
+            if getattr(self, 'async_engine', None):
+                self.async_engine.close()
+
+            # Close pooled keep-alive connections
+            if hasattr(self, 'connection_pool'):
+                self.connection_pool.close()
 
             # Stop Tor service
             if hasattr(self, 'tor_service') and self.tor_service:
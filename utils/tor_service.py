@@ -1,42 +1,85 @@
 import os
+import re
+import base64
+import time
 import logging
+import threading
+from stem import HSDescAction
+from stem.control import Controller, EventType
 from stem.process import launch_tor_with_config
 
+BOOTSTRAP_PROGRESS = re.compile(r'PROGRESS=(\d+)')
+BOOTSTRAP_SUMMARY = re.compile(r'SUMMARY="([^"]*)"')
+
 
 class TorService:
-    def __init__(self, hidden_service_port=5000, socks_port=9050, tor_binary=None):  # Add socks_port here
+    def __init__(self, hidden_service_port=5000, socks_port=9050, tor_binary=None, control_port=9051,
+                 publish_timeout=120, use_existing_tor=False, control_password=None, key_file=None, local_port=None,
+                 user_hidden_service_dir=None):
         self.logger = logging.getLogger('JustSocial')
+        # Peers dial the onion address on hidden_service_port; Tor forwards that to our
+        # receive server on local_port, which differs per user when several share one Tor
         self.hidden_service_port = hidden_service_port
+        self.local_port = local_port or hidden_service_port
         self.hidden_service_dir = None
         self.onion_address = None
         self.tor_process = None
+        self.controller = None
         self.socks_port = socks_port  # Store the socks_port
         self.tor_binary = tor_binary  # Store the tor_binary path
+        self.control_port = control_port
+        self.publish_timeout = publish_timeout
+        self.progress_callback = None
+        self.published = threading.Event()
+        self.uploaded = set()
+
+        # Attach to a Tor that is already running on control_port and publish an ephemeral
+        # onion service there, with its key kept in key_file, instead of starting our own Tor
+        self.use_existing_tor = use_existing_tor
+        self.control_password = control_password
+        self.key_file = key_file
+        # This user's own hidden service directory: created for a new user when we start our own
+        # Tor, and the only one whose key is migrated when switching to a shared Tor
+        self.user_hidden_service_dir = os.path.abspath(user_hidden_service_dir) if user_hidden_service_dir else None
+
+    def start_in_background(self, progress_callback=None, ready_callback=None, error_callback=None):
+        """
+        Start Tor on a background thread instead of blocking the caller
+
+        progress_callback(percent, summary) follows Tor's bootstrap status events,
+        ready_callback(onion_address) runs once the hidden service is published and
+        error_callback(exception) if Tor could not be started. All run on that thread.
+        """
+        def run():
+            try:
+                onion_address = self.start(progress_callback)
+            except Exception as e:
+                if error_callback:
+                    error_callback(e)
+                return
+            if ready_callback:
+                ready_callback(onion_address)
 
-    def start(self):
-        """Start Tor with hidden service configuration, logging details."""
+        thread = threading.Thread(target=run, name='tor-bootstrap', daemon=True)
+        thread.start()
+        return thread
+
+    def start(self, progress_callback=None):
+        """Start Tor with hidden service configuration and wait until the service is published"""
+        self.progress_callback = progress_callback
         try:
+            if self.use_existing_tor:
+                return self._start_ephemeral()
+
             # 1. Determine Hidden Service Directory (with logging)
-            potential_dirs = [
-                os.path.expanduser("~/.tor/hidden_service"),  # Common location
-                os.path.join(os.getcwd(), "hidden_service")  # In the current dir
-                # Add any other paths you want to check
-            ]
-
-            for directory in potential_dirs:
-                full_path = os.path.join(directory, "hostname")
-                if os.path.exists(full_path):
-                    self.hidden_service_dir = directory
-                    self.logger.info(f"Found existing hidden service directory: {self.hidden_service_dir}")
-                    self.logger.info(f"Hostname file found at: {full_path}")  # Log hostname file path
-                    break
+            potential_dirs = self._potential_hidden_service_dirs()
+            self.hidden_service_dir = self._find_hidden_service_dir()
 
             if self.hidden_service_dir is None:
                 try:
                     if not os.path.exists(potential_dirs[0]):
-                        os.mkdir(potential_dirs[0], mode=0o700)
+                        os.makedirs(potential_dirs[0], mode=0o700)
                     self.hidden_service_dir = potential_dirs[0]
-                   # self.hidden_service_dir = tempfile.mkdtemp()
                     self.logger.info(f"Creating NEW hidden service directory: {self.hidden_service_dir}")
                 except Exception as e:
                     self.logger.error(f"Failed to create hidden service directory: {e}")
@@ -45,53 +88,197 @@ class TorService:
             if self.hidden_service_dir is None:  # Double-check
                 raise Exception("Hidden service directory could not be created or found.")
 
+            # A returning user's address is known before Tor even starts
+            hostname_path = os.path.join(self.hidden_service_dir, 'hostname')
+            self._read_hostname(hostname_path)
+            self._report_progress(0, "Starting Tor")
+
             # 2. Configuration for Tor (log the directory being used)
-            print("as0adasdasdasdsadas")
-            print(self.hidden_service_dir )
             tor_config = {
                 #  'SocksPort': str(self.socks_port),  # Use the provided socks_port
-                'ControlPort': '9051',
+                'ControlPort': str(self.control_port),
                 'HiddenServiceDir': self.hidden_service_dir,  # Log this!
-                'HiddenServicePort': f'{self.hidden_service_port} 127.0.0.1:{self.hidden_service_port}'
+                'HiddenServicePort': f'{self.hidden_service_port} 127.0.0.1:{self.local_port}'
             }
             self.logger.info(f"Tor configuration: HiddenServiceDir = {tor_config['HiddenServiceDir']}")
 
-            # 3. Start Tor process
+            # 3. Start Tor process. Only wait until its control port is up; the rest of
+            # bootstrapping is followed through status events. stem's own timeout relies
+            # on SIGALRM, which is only available on the main thread.
+            launch_options = {'tor_cmd': self.tor_binary} if self.tor_binary else {}
             self.tor_process = launch_tor_with_config(
                 config=tor_config,
-                take_ownership=True
+                take_ownership=True,
+                completion_percent=0,
+                timeout=None,
+                **launch_options
             )
+            self._connect_controller()
 
             # 4. Read the onion address (from the correct location)
-            hostname_path = os.path.join(self.hidden_service_dir, 'hostname')  # Use correct path!
             self.logger.info(f"Looking for hostname file at: {hostname_path}")  # Log the full path
 
             # 5. Wait for hostname file (improved logging)
             max_attempts = 30
             attempts = 0
-            while not os.path.exists(hostname_path) and attempts < max_attempts:
+            while not self.onion_address and not self._read_hostname(hostname_path) and attempts < max_attempts:
                 self.logger.info(f"Waiting for hostname file (attempt {attempts + 1}/{max_attempts})...")
-                import time
                 time.sleep(1)
                 attempts += 1
 
-            if os.path.exists(hostname_path):
-                with open(hostname_path, 'r') as f:
-                    self.onion_address = f.read().strip()
-                self.logger.info(f"Tor hidden service running at: {self.onion_address}")
-            else:
+            if not self.onion_address:
                 self.logger.error(f"Hostname file NOT found at: {hostname_path}")  # Log the error
                 raise Exception(f"Hostname file not created after waiting {max_attempts} seconds.")
 
+            # 6. Wait until the descriptor is uploaded, so peers can actually reach us
+            self._wait_for_publication()
             return self.onion_address
 
         except Exception as e:
             self.logger.error(f"Error starting Tor service: {e}")
+            self.stop()
             raise
 
+    def _potential_hidden_service_dirs(self):
+        user_dirs = [self.user_hidden_service_dir] if self.user_hidden_service_dir else []
+        return user_dirs + [
+            os.path.expanduser("~/.tor/hidden_service"),  # Common location
+            os.path.join(os.getcwd(), "hidden_service")  # In the current dir
+            # Add any other paths you want to check
+        ]
+
+    def _find_hidden_service_dir(self):
+        """An existing hidden service directory from an earlier run, if there is one"""
+        for directory in self._potential_hidden_service_dirs():
+            full_path = os.path.join(directory, "hostname")
+            if os.path.exists(full_path):
+                self.logger.info(f"Found existing hidden service directory: {directory}")
+                self.logger.info(f"Hostname file found at: {full_path}")  # Log hostname file path
+                return directory
+        return None
+
+    def _start_ephemeral(self):
+        """Publish the hidden service on an already running Tor and wait until it is published"""
+        self._report_progress(0, "Connecting to Tor")
+        self._connect_controller()
+
+        key_type, key_content = self._load_onion_key()
+        # Not detached: Tor removes the service again when our control connection closes
+        response = self.controller.create_ephemeral_hidden_service(
+            {self.hidden_service_port: f'127.0.0.1:{self.local_port}'},
+            key_type=key_type,
+            key_content=key_content,
+            await_publication=False
+        )
+        self.onion_address = f"{response.service_id}.onion"
+        self.logger.info(f"Ephemeral hidden service created at: {self.onion_address}")
+        if key_type == 'NEW':
+            self._save_onion_key(response.private_key_type, response.private_key)
+
+        if response.service_id in self.uploaded:
+            self.published.set()
+        self._wait_for_publication()
+        return self.onion_address
+
+    def _load_onion_key(self):
+        """
+        The key to publish the ephemeral service with, as (key_type, key_content) for ADD_ONION
+
+        Reuses the key of this user's hidden service directory from an earlier run, so switching
+        to a shared Tor keeps the onion address contacts already have. The global directories
+        aren't tied to one user, so every user sharing the Tor would publish the same address.
+        """
+        if self.key_file and os.path.exists(self.key_file):
+            with open(self.key_file, 'r') as f:
+                key_type, key_content = f.read().strip().split(':', 1)
+            return key_type, key_content
+
+        directory = self.user_hidden_service_dir
+        secret_key_path = os.path.join(directory, 'hs_ed25519_secret_key') if directory else None
+        if secret_key_path and os.path.exists(secret_key_path):
+            # A 32 byte header followed by the expanded ed25519 key ADD_ONION expects
+            with open(secret_key_path, 'rb') as f:
+                key_content = base64.b64encode(f.read()[32:]).decode('ascii')
+            self._save_onion_key('ED25519-V3', key_content)
+            return 'ED25519-V3', key_content
+
+        return 'NEW', 'ED25519-V3'
+
+    def _save_onion_key(self, key_type, key_content):
+        if not self.key_file:
+            self.logger.warning("No key file for the ephemeral hidden service, its address changes every run")
+            return
+        try:
+            fd = os.open(self.key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(f"{key_type}:{key_content}")
+            self.logger.info(f"Hidden service key saved to {self.key_file}")
+        except Exception as e:
+            self.logger.error(f"Error saving hidden service key: {e}")
+
+    def _read_hostname(self, hostname_path):
+        if not os.path.exists(hostname_path):
+            return False
+        with open(hostname_path, 'r') as f:
+            self.onion_address = f.read().strip()
+        self.logger.info(f"Tor hidden service address: {self.onion_address}")
+        return True
+
+    def _connect_controller(self):
+        """Follow bootstrap progress and descriptor uploads through the control port"""
+        self.controller = Controller.from_port(port=self.control_port)
+        # Cookie authentication is picked up by stem; a shared Tor may want a password instead
+        self.controller.authenticate(password=self.control_password)
+        self.controller.add_event_listener(self._on_status_event, EventType.STATUS_CLIENT)
+        self.controller.add_event_listener(self._on_hs_desc_event, EventType.HS_DESC)
+
+        # Events only cover what happens from now on
+        phase = self.controller.get_info('status/bootstrap-phase', '')
+        progress = BOOTSTRAP_PROGRESS.search(phase)
+        summary = BOOTSTRAP_SUMMARY.search(phase)
+        if progress:
+            self._report_progress(int(progress.group(1)), summary.group(1) if summary else '')
+
+    def _on_status_event(self, event):
+        if event.action != 'BOOTSTRAP':
+            return
+        try:
+            progress = int(event.arguments.get('PROGRESS', 0))
+        except ValueError:
+            return
+        self._report_progress(progress, event.arguments.get('SUMMARY', ''))
+
+    def _on_hs_desc_event(self, event):
+        if event.action != HSDescAction.UPLOADED:
+            return
+        self.uploaded.add(event.address)
+        if self.onion_address and event.address == self.onion_address.replace('.onion', ''):
+            self.published.set()
+
+    def _wait_for_publication(self):
+        if self.published.wait(self.publish_timeout):
+            self.logger.info(f"Tor hidden service published at: {self.onion_address}")
+        else:
+            # Tor keeps retrying the upload on its own, so carry on rather than fail
+            self.logger.warning(f"No descriptor upload seen within {self.publish_timeout} seconds")
+
+    def _report_progress(self, progress, summary):
+        self.logger.info(f"Tor bootstrap {progress}%: {summary}")
+        if progress >= 100:
+            summary = "Publishing onion service"
+        if self.progress_callback:
+            try:
+                self.progress_callback(progress, summary)
+            except Exception as e:
+                self.logger.error(f"Error reporting Tor progress: {e}")
+
     def stop(self):
         """Stop Tor service"""
         try:
+            if self.controller:
+                self.controller.close()
+                self.controller = None
+
             if self.tor_process:
                 self.tor_process.kill()
                 self.tor_process = None
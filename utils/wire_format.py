@@ -0,0 +1,274 @@
+import hashlib
+import struct
+
+# Binary envelope used on the wire instead of hex ciphertext inside JSON.
+#
+#   magic    2 bytes   b'JS'
+#   version  1 byte
+#   flags    1 byte
+#   sender   32 byte raw public key if FLAG_FULL_KEY is set, else an 8 byte key id
+#   msg id   1 byte length and the sender's UTF-8 message id, only if FLAG_MESSAGE_ID is set
+#   payload  raw NaCl box output (nonce + ciphertext) up to the end of the body
+#
+# With FLAG_COMPRESSED the decrypted payload is a codec id byte followed by the
+# compressed message (see compression.py). It is only set for peers that advertised
+# the codec, so older clients never see it.
+#
+# Group messages (FLAG_GROUP) are encrypted once with the sender's symmetric group key.
+# Between the sender and the payload they carry:
+#
+#   group key id   8 bytes
+#   wrapped len    2 bytes, 0 once the member already holds the key
+#   wrapped key    group key, the sender's Ed25519 verify key and group id boxed for this member
+#
+# and the payload is SecretBox output shared by every member. Since every member can
+# seal with the key, the decrypted payload starts with the sender's 64 byte signature
+# (see group_keys.py) and only then holds the (possibly compressed) message.
+#
+# Several envelopes for the same peer can be sent to /receive_batch in one body:
+#
+#   magic    2 bytes   b'JB'
+#   version  1 byte
+#   count    2 bytes
+#   then per envelope a 4 byte length followed by the envelope itself
+#
+# Attachments are posted chunk by chunk to /attachment/chunk, each chunk in its own
+# envelope. The encrypted payload starts with a chunk header so the offset can't be
+# altered in transit:
+#
+#   transfer id  16 bytes
+#   offset        8 bytes
+#   data          up to the end of the payload
+#
+# Members relaying a group message (see group_relay.py) post it to /group_relay in an
+# envelope of their own. Its encrypted payload carries the forwarding instructions and
+# the original sender's group envelope untouched:
+#
+#   header len   4 bytes
+#   header       UTF-8 JSON with the group id, our wrapped key and the members to forward to
+#   envelope     the original group envelope, up to the end of the payload
+#
+# A member catching up on a group posts its per-sender cursors to /group_sync and gets
+# back one envelope from the member it asked, whose encrypted payload is a page of
+# stored group envelopes:
+#
+#   header len   4 bytes
+#   header       UTF-8 JSON with the next cursors, whether more pages follow, group keys
+#                and the answering member's own verify key
+#   batch        the group envelopes, framed like a /receive_batch body
+
+CONTENT_TYPE = 'application/x-justsocial-envelope'
+BATCH_CONTENT_TYPE = 'application/x-justsocial-batch'
+FEATURES_HEADER = 'X-JustSocial-Features'
+# Carries the message id of a single envelope posted before we know the peer reads FLAG_MESSAGE_ID
+MESSAGE_ID_HEADER = 'X-JustSocial-Message-Id'
+# Our own address, so a peer that doesn't have us as a contact can still send receipts back
+REPLY_TO_HEADER = 'X-JustSocial-Reply-To'
+
+MAGIC = b'JS'
+BATCH_MAGIC = b'JB'
+VERSION = 1
+
+FLAG_FULL_KEY = 0x01
+FLAG_GROUP = 0x02
+FLAG_COMPRESSED = 0x04
+FLAG_MESSAGE_ID = 0x08
+
+PUBLIC_KEY_SIZE = 32
+KEY_ID_SIZE = 8
+TRANSFER_ID_SIZE = 16
+
+_HEADER = struct.Struct('!2sBB')
+_BATCH_HEADER = struct.Struct('!2sBH')
+_LENGTH = struct.Struct('!I')
+_SHORT_LENGTH = struct.Struct('!H')
+_BYTE_LENGTH = struct.Struct('!B')
+_CHUNK_HEADER = struct.Struct('!16sQ')
+
+
+class EnvelopeError(ValueError):
+    """Raised when a binary envelope is malformed or uses an unknown version"""
+
+
+def key_id(public_key_bytes):
+    """Short identifier for a raw public key"""
+    return hashlib.blake2b(public_key_bytes, digest_size=KEY_ID_SIZE).digest()
+
+
+def encode_envelope(sender_public_key, ciphertext, include_full_key=True, group_key_id=None, wrapped_key=b'',
+                    compressed=False, message_id=None):
+    """Build a binary envelope from a raw sender public key and NaCl box (or group SecretBox) output"""
+    flags = FLAG_COMPRESSED if compressed else 0
+    if include_full_key:
+        flags |= FLAG_FULL_KEY
+        sender = sender_public_key
+    else:
+        sender = key_id(sender_public_key)
+
+    if message_id:
+        encoded_id = message_id.encode()
+        if len(encoded_id) > 255:
+            raise EnvelopeError("Message id too long")
+        flags |= FLAG_MESSAGE_ID
+        sender += _BYTE_LENGTH.pack(len(encoded_id)) + encoded_id
+
+    group = b''
+    if group_key_id is not None:
+        flags |= FLAG_GROUP
+        group = group_key_id + _SHORT_LENGTH.pack(len(wrapped_key)) + wrapped_key
+
+    return _HEADER.pack(MAGIC, VERSION, flags) + sender + group + ciphertext
+
+
+def decode_envelope(data):
+    """
+    Parse a binary envelope
+
+    Returns:
+        dict: flags, sender_public_key (raw bytes or None), sender_key_id, message_id (None
+              unless FLAG_MESSAGE_ID is set), group_key_id and wrapped_key (None unless
+              FLAG_GROUP is set) and ciphertext
+    """
+    if len(data) < _HEADER.size:
+        raise EnvelopeError("Envelope too short")
+
+    magic, version, flags = _HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise EnvelopeError("Not a JustSocial envelope")
+    if version != VERSION:
+        raise EnvelopeError(f"Unsupported envelope version {version}")
+
+    offset = _HEADER.size
+    if flags & FLAG_FULL_KEY:
+        sender_public_key = data[offset:offset + PUBLIC_KEY_SIZE]
+        if len(sender_public_key) != PUBLIC_KEY_SIZE:
+            raise EnvelopeError("Truncated sender key")
+        sender_key_id = key_id(sender_public_key)
+        offset += PUBLIC_KEY_SIZE
+    else:
+        sender_public_key = None
+        sender_key_id = data[offset:offset + KEY_ID_SIZE]
+        if len(sender_key_id) != KEY_ID_SIZE:
+            raise EnvelopeError("Truncated sender key id")
+        offset += KEY_ID_SIZE
+
+    message_id = None
+    if flags & FLAG_MESSAGE_ID:
+        if offset + _BYTE_LENGTH.size > len(data):
+            raise EnvelopeError("Truncated message id")
+        (id_length,) = _BYTE_LENGTH.unpack_from(data, offset)
+        offset += _BYTE_LENGTH.size
+        encoded_id = data[offset:offset + id_length]
+        if len(encoded_id) != id_length:
+            raise EnvelopeError("Truncated message id")
+        try:
+            message_id = encoded_id.decode()
+        except UnicodeDecodeError:
+            raise EnvelopeError("Invalid message id")
+        offset += id_length
+
+    group_key_id = None
+    wrapped_key = None
+    if flags & FLAG_GROUP:
+        if offset + KEY_ID_SIZE + _SHORT_LENGTH.size > len(data):
+            raise EnvelopeError("Truncated group header")
+        group_key_id = data[offset:offset + KEY_ID_SIZE]
+        offset += KEY_ID_SIZE
+        (wrapped_length,) = _SHORT_LENGTH.unpack_from(data, offset)
+        offset += _SHORT_LENGTH.size
+        wrapped_key = data[offset:offset + wrapped_length]
+        if len(wrapped_key) != wrapped_length:
+            raise EnvelopeError("Truncated wrapped group key")
+        offset += wrapped_length
+
+    return {
+        'flags': flags,
+        'sender_public_key': sender_public_key,
+        'sender_key_id': sender_key_id,
+        'message_id': message_id,
+        'group_key_id': group_key_id,
+        'wrapped_key': wrapped_key,
+        'ciphertext': data[offset:]
+    }
+
+
+def encode_batch(envelopes):
+    """Frame several envelopes into one /receive_batch body"""
+    parts = [_BATCH_HEADER.pack(BATCH_MAGIC, VERSION, len(envelopes))]
+    for envelope in envelopes:
+        parts.append(_LENGTH.pack(len(envelope)))
+        parts.append(envelope)
+    return b''.join(parts)
+
+
+def decode_batch(data):
+    """Split a /receive_batch body back into its envelopes"""
+    if len(data) < _BATCH_HEADER.size:
+        raise EnvelopeError("Batch too short")
+
+    magic, version, count = _BATCH_HEADER.unpack_from(data)
+    if magic != BATCH_MAGIC:
+        raise EnvelopeError("Not a JustSocial batch")
+    if version != VERSION:
+        raise EnvelopeError(f"Unsupported batch version {version}")
+
+    envelopes = []
+    offset = _BATCH_HEADER.size
+    for _ in range(count):
+        if offset + _LENGTH.size > len(data):
+            raise EnvelopeError("Truncated batch")
+        (length,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+        if offset + length > len(data):
+            raise EnvelopeError("Truncated batch entry")
+        envelopes.append(data[offset:offset + length])
+        offset += length
+
+    return envelopes
+
+
+def encode_chunk(transfer_id, offset, data):
+    """Prefix a slice of an attachment with its transfer id and offset, ready to be encrypted"""
+    return _CHUNK_HEADER.pack(transfer_id, offset) + data
+
+
+def decode_chunk(plaintext):
+    """Split a decrypted attachment chunk into (transfer_id, offset, data)"""
+    if len(plaintext) < _CHUNK_HEADER.size:
+        raise EnvelopeError("Chunk too short")
+
+    transfer_id, offset = _CHUNK_HEADER.unpack_from(plaintext)
+    return transfer_id, offset, plaintext[_CHUNK_HEADER.size:]
+
+
+def encode_relay(header, envelope):
+    """Prefix a group envelope with encoded relay instructions, ready to be encrypted for the next member"""
+    return _LENGTH.pack(len(header)) + header + envelope
+
+
+def decode_relay(plaintext):
+    """Split a decrypted /group_relay payload into (header, envelope)"""
+    return _split_header(plaintext)
+
+
+def _split_header(plaintext):
+    """Split a length-prefixed header off a decrypted payload"""
+    if len(plaintext) < _LENGTH.size:
+        raise EnvelopeError("Payload too short")
+
+    (header_length,) = _LENGTH.unpack_from(plaintext)
+    end = _LENGTH.size + header_length
+    if end > len(plaintext):
+        raise EnvelopeError("Truncated payload header")
+    return plaintext[_LENGTH.size:end], plaintext[end:]
+
+
+def encode_sync_page(header, envelopes):
+    """Frame a page of group envelopes and its encoded header, ready to be encrypted for the requesting member"""
+    return _LENGTH.pack(len(header)) + header + encode_batch(envelopes)
+
+
+def decode_sync_page(plaintext):
+    """Split a decrypted /group_sync answer into (header, envelopes)"""
+    header, batch = _split_header(plaintext)
+    return header, decode_batch(batch)